@@ -1,8 +1,10 @@
-from flask import session, redirect, url_for, flash
-from flask_admin import Admin, AdminIndexView, expose
+from flask import abort, current_app, session, redirect, request, url_for, flash
+from flask_admin import Admin, AdminIndexView, BaseView, expose
 from flask_admin.contrib.sqla import ModelView
 from flask_admin.form import BaseForm
 from models import db, User, Post, Comment
+from purge import delete_user
+from request_profiler import SESSION_KEY as PROFILE_SESSION_KEY
 
 
 class NoCSRFForm(BaseForm):
@@ -52,6 +54,12 @@ class BasicUserAdmin(AdminAuthMixin, ModelView):
         if is_created and not hasattr(model, 'password_hash'):
             model.set_password('123456')
 
+    def delete_model(self, model):
+        """Users with a lot of content are purged in the background"""
+        if not delete_user(current_app._get_current_object(), model):
+            flash(f'{model.username} has a lot of content, it is being deleted in the background.', 'success')
+        return True
+
 
 class BasicPostAdmin(AdminAuthMixin, ModelView):
     form_base_class = NoCSRFForm
@@ -67,6 +75,38 @@ class BasicCommentAdmin(AdminAuthMixin, ModelView):
     column_list = ['id', 'content', 'author', 'post', 'created_at']
 
 
+class ProfilesView(AdminAuthMixin, BaseView):
+    """Recent request profiles and a switch to profile your own requests"""
+
+    @property
+    def store(self):
+        return current_app.extensions['request_profiler']
+
+    @expose('/')
+    def index(self):
+        profiles = self.store.list()
+        for profile in profiles:
+            profile['top'] = self.store.top_functions(profile['name'], limit=3) or []
+        return self.render('admin/profiles.html',
+                           profiles=profiles,
+                           profiling=session.get(PROFILE_SESSION_KEY, False))
+
+    @expose('/toggle', methods=['POST'])
+    def toggle(self):
+        session[PROFILE_SESSION_KEY] = not session.get(PROFILE_SESSION_KEY, False)
+        flash('Your requests are now profiled.' if session[PROFILE_SESSION_KEY]
+              else 'Profiling of your requests is off.', 'success')
+        return redirect(request.referrer or url_for('.index'))
+
+    @expose('/<profile>')
+    def details(self, profile):
+        limit = max(1, min(request.args.get('limit', 40, type=int), 500))
+        functions = self.store.top_functions(profile, limit=limit)
+        if functions is None:
+            abort(404)
+        return self.render('admin/profile.html', name=profile, functions=functions)
+
+
 def init_basic_admin(app):
     """Initialize Flask-Admin"""
     admin = Admin(
@@ -79,5 +119,7 @@ def init_basic_admin(app):
     admin.add_view(BasicUserAdmin(User, db.session, name='Users'))
     admin.add_view(BasicPostAdmin(Post, db.session, name='Posts'))
     admin.add_view(BasicCommentAdmin(Comment, db.session, name='Comments'))
+    if 'request_profiler' in app.extensions:
+        admin.add_view(ProfilesView(name='Profiles', endpoint='profiles'))
 
     return admin
\ No newline at end of file
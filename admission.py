@@ -0,0 +1,288 @@
+import asyncio
+import collections
+import json
+import threading
+import time
+
+from metrics import admission_in_flight, admission_rejected, registry
+
+ROUTE_CLASSES = ('read', 'login', 'write', 'batch')
+# Share of the capacity each class may fill, reads can use all of it
+DEFAULT_SHARES = {'read': 1.0, 'login': 0.5, 'write': 0.6, 'batch': 0.2}
+# How long a request may wait for a slot before it is rejected
+DEFAULT_MAX_WAIT_MS = {'read': 1000, 'login': 500, 'write': 500, 'batch': 0}
+RETRY_AFTER = {'read': 1, 'login': 2, 'write': 2, 'batch': 10}
+
+LOGIN_PATHS = ('/login', '/register', '/api/auth/login')
+BATCH_PATHS = ('/async/batch',)
+EXEMPT_PATHS = ('/metrics', '/async/metrics', '/async/health', '/async/ready', '/static/')
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+OVERLOADED_MESSAGE = 'Server is overloaded, please retry later'
+
+
+def classify(method, path, query=None):
+    """Route class of a request, None for requests that are never shed"""
+    if path.startswith(EXEMPT_PATHS):
+        return None
+    if path in LOGIN_PATHS:
+        return 'login'
+    if path in BATCH_PATHS or (query is not None and query.get('stream')):
+        return 'batch'
+    return 'read' if method in READ_METHODS else 'write'
+
+
+class AdmissionController:
+    """Limits in-flight requests per route class and sheds the cheap-to-retry
+    ones first.
+
+    Every class may fill its share of ``capacity``. When reads get slower
+    than ``latency_target`` the shares of the other classes shrink, so
+    writes, logins and batch work back off before reads are rejected; they
+    grow back while reads are fast again. A request that finds no free slot
+    waits up to the max wait of its class, unless recent requests of that
+    class already waited that long, then it is rejected right away.
+    """
+
+    def __init__(self, capacity=64, latency_target=0.5, shares=None, max_wait_ms=None):
+        self.capacity = capacity
+        self.latency_target = latency_target
+        self.shares = {**DEFAULT_SHARES, **(shares or {})}
+        self.max_wait = {name: ms / 1000 for name, ms in {**DEFAULT_MAX_WAIT_MS, **(max_wait_ms or {})}.items()}
+        self.factor = 1.0
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+        self.stats = {name: {
+            'in_flight': 0,
+            'admitted': 0,
+            'rejected': 0,
+            'wait_ewma': 0.0,
+            'latency_ewma': 0.0
+        } for name in ROUTE_CLASSES}
+
+    def limit(self, route_class):
+        share = self.shares[route_class]
+        if route_class != 'read':
+            share *= self.factor
+        return max(1, int(self.capacity * share))
+
+    def _try_admit(self, route_class):
+        if self.in_flight >= self.limit(route_class):
+            return False
+        self.in_flight += 1
+        stats = self.stats[route_class]
+        stats['in_flight'] += 1
+        stats['admitted'] += 1
+        return True
+
+    def _should_queue(self, route_class):
+        max_wait = self.max_wait[route_class]
+        return max_wait > 0 and self.stats[route_class]['wait_ewma'] < max_wait
+
+    def _record_wait(self, route_class, waited):
+        stats = self.stats[route_class]
+        stats['wait_ewma'] = stats['wait_ewma'] * 0.9 + waited * 0.1
+
+    def _reject(self, route_class, waited):
+        self._record_wait(route_class, waited)
+        self.stats[route_class]['rejected'] += 1
+        return False
+
+    def acquire(self, route_class):
+        """Take a slot, blocking up to the max wait of the class"""
+        started = time.monotonic()
+        with self._lock:
+            if self._try_admit(route_class):
+                self._record_wait(route_class, 0.0)
+                return True
+            if not self._should_queue(route_class):
+                return self._reject(route_class, 0.0)
+            deadline = started + self.max_wait[route_class]
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return self._reject(route_class, time.monotonic() - started)
+                self._released.wait(remaining)
+                if self._try_admit(route_class):
+                    self._record_wait(route_class, time.monotonic() - started)
+                    return True
+
+    async def acquire_async(self, route_class, released):
+        """Same as acquire for an event loop, ``released`` is an asyncio.Condition"""
+        started = time.monotonic()
+        with self._lock:
+            if self._try_admit(route_class):
+                self._record_wait(route_class, 0.0)
+                return True
+            if not self._should_queue(route_class):
+                return self._reject(route_class, 0.0)
+        deadline = started + self.max_wait[route_class]
+        async with released:
+            while True:
+                with self._lock:
+                    if self._try_admit(route_class):
+                        self._record_wait(route_class, time.monotonic() - started)
+                        return True
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return self._reject(route_class, time.monotonic() - started)
+                try:
+                    await asyncio.wait_for(released.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+
+    def release(self, route_class, latency):
+        with self._lock:
+            self.in_flight -= 1
+            stats = self.stats[route_class]
+            stats['in_flight'] -= 1
+            stats['latency_ewma'] = stats['latency_ewma'] * 0.9 + latency * 0.1
+            if route_class == 'read':
+                if stats['latency_ewma'] > self.latency_target:
+                    self.factor = max(0.1, self.factor * 0.9)
+                else:
+                    self.factor = min(1.0, self.factor + 0.01)
+            # Wake every waiter, only some classes may be under their limit
+            self._released.notify_all()
+
+    def retry_after(self, route_class):
+        return RETRY_AFTER[route_class]
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'capacity': self.capacity,
+                'in_flight': self.in_flight,
+                'factor': round(self.factor, 3),
+                'classes': {name: {
+                    **{key: round(value, 4) if isinstance(value, float) else value
+                       for key, value in stats.items()},
+                    'limit': self.limit(name)
+                } for name, stats in self.stats.items()}
+            }
+
+
+class TokenBuckets:
+    """Per-client token buckets, the least recently seen clients are dropped"""
+
+    def __init__(self, rate, burst, max_clients=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, client, tokens=1):
+        """Take tokens for ``client``, returns the seconds to wait or 0"""
+        now = time.monotonic()
+        with self._lock:
+            available, updated = self._buckets.pop(client, (self.burst, now))
+            available = min(self.burst, available + (now - updated) * self.rate)
+            if available >= tokens:
+                available -= tokens
+                wait = 0
+            else:
+                wait = (tokens - available) / self.rate
+            self._buckets[client] = (available, now)
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+def controller_from_config(config, app_name, threads=None):
+    """Controller for an app, ``threads`` caps the capacity: requests past
+    the worker's threads queue in the server where no limit applies"""
+    capacity = config.get('ADMISSION_CAPACITY', 64)
+    controller = AdmissionController(
+        capacity=min(capacity, threads) if threads else capacity,
+        latency_target=config.get('ADMISSION_LATENCY_TARGET_MS', 500) / 1000,
+        shares=config.get('ADMISSION_SHARES'),
+        max_wait_ms=config.get('ADMISSION_MAX_WAIT_MS'))
+
+    def collect_admission_metrics():
+        for name, stats in controller.snapshot()['classes'].items():
+            admission_in_flight.set(stats['in_flight'], app=app_name, route_class=name)
+            admission_rejected.set(stats['rejected'], app=app_name, route_class=name)
+
+    registry.add_collector(collect_admission_metrics)
+    return controller
+
+
+def init_admission(app):
+    """Load shedding for the Flask app and rate limits for the JWT API"""
+    from flask import g, jsonify, request
+    from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+
+    if not app.config.get('ADMISSION_ENABLED', True):
+        return None
+
+    controller = controller_from_config(app.config, 'flask', app.config.get('SERVE_THREADS'))
+    buckets = TokenBuckets(app.config.get('API_RATE_LIMIT_PER_SECOND', 10),
+                           app.config.get('API_RATE_LIMIT_BURST', 20))
+    app.extensions['admission'] = controller
+
+    def too_many(status, retry_after, message):
+        response = jsonify({'message': message})
+        response.status_code = status
+        response.headers['Retry-After'] = str(max(1, int(retry_after + 0.999)))
+        return response
+
+    @app.before_request
+    def admit_request():
+        if request.path.startswith('/api/') and request.headers.get('Authorization', '').startswith('Bearer '):
+            try:
+                verify_jwt_in_request(optional=True)
+                client = get_jwt_identity()
+            except Exception:
+                client = None  # invalid tokens are rejected by the view itself
+            if client is not None:
+                wait = buckets.consume(str(client))
+                if wait:
+                    return too_many(429, wait, 'Rate limit exceeded')
+
+        route_class = classify(request.method, request.path, request.args)
+        if route_class is None:
+            return None
+        if not controller.acquire(route_class):
+            return too_many(503, controller.retry_after(route_class), OVERLOADED_MESSAGE)
+        g.admission = (route_class, time.perf_counter())
+
+    @app.teardown_request
+    def release_request(exc):
+        admission = g.pop('admission', None)
+        if admission is not None:
+            route_class, started = admission
+            controller.release(route_class, time.perf_counter() - started)
+
+    return controller
+
+
+def make_admission_middleware(config):
+    """aiohttp middleware with the same route classes as the Flask app"""
+    from aiohttp import web
+
+    controller = controller_from_config(config, 'aiohttp')
+    released = None
+
+    @web.middleware
+    async def admission_middleware(request, handler):
+        nonlocal released
+        route_class = classify(request.method, request.path, request.query)
+        if route_class is None:
+            return await handler(request)
+        if released is None:
+            released = asyncio.Condition()
+        if not await controller.acquire_async(route_class, released):
+            return web.Response(
+                text=json.dumps({'message': OVERLOADED_MESSAGE}), status=503, content_type='application/json',
+                headers={'Retry-After': str(controller.retry_after(route_class))})
+        started = time.perf_counter()
+        try:
+            return await handler(request)
+        finally:
+            controller.release(route_class, time.perf_counter() - started)
+            async with released:
+                released.notify_all()
+
+    admission_middleware.controller = controller
+    return admission_middleware
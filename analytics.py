@@ -0,0 +1,294 @@
+import collections
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, distinct, event, func, insert, select, update
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.orm import Session
+
+from commit_hooks import on_cascade
+from models import (db, Post, Comment, ActivityRollup, AuthorActivity, PostCommentCount,
+                    CommentCountBucket)
+
+GRANULARITIES = ('hour', 'day')
+METRICS = ('posts', 'comments')
+# (lowest, highest, label) of the comments-per-post distribution
+COMMENT_BUCKETS = ((0, 0, '0'), (1, 1, '1'), (2, 5, '2-5'), (6, 10, '6-10'), (11, 50, '11-50'),
+                   (51, 100, '51-100'), (101, 1000, '101-1000'), (1001, None, '1001+'))
+DEFAULT_WINDOWS = {'hour': timedelta(hours=48), 'day': timedelta(days=30)}
+MAX_WINDOWS = {'hour': timedelta(days=31), 'day': timedelta(days=366)}
+# Rollup deltas of rows a flush removes by ON DELETE CASCADE
+CASCADE_KEY = 'analytics_cascade'
+
+
+def comment_bucket(count):
+    for lowest, highest, label in COMMENT_BUCKETS:
+        if highest is None or count <= highest:
+            return label
+
+
+def truncate(moment, granularity):
+    if granularity == 'day':
+        return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def _add(connection, model, keys, values):
+    """Insert the row or add ``values`` to its counters, in one statement"""
+    table = model.__table__
+    row = {**keys, **values}
+    dialect = connection.dialect.name
+    if dialect == 'sqlite':
+        statement = sqlite.insert(table).values(row)
+        statement = statement.on_conflict_do_update(
+            index_elements=list(keys), set_={name: table.c[name] + statement.excluded[name] for name in values})
+    elif dialect in ('mysql', 'mariadb'):
+        statement = mysql.insert(table).values(row)
+        statement = statement.on_duplicate_key_update(
+            {name: table.c[name] + statement.inserted[name] for name in values})
+    else:
+        result = connection.execute(
+            update(table).where(*[table.c[name] == value for name, value in keys.items()])
+            .values({name: table.c[name] + value for name, value in values.items()}))
+        if result.rowcount:
+            return
+        statement = insert(table).values(row)
+    connection.execute(statement)
+
+
+class RollupChanges:
+    """Counter deltas collected from one flush.
+
+    ``apply`` writes the tables in a fixed order and the rows of each
+    table sorted by key, so concurrent transactions lock the hot rows in
+    the same order and cannot deadlock on each other.
+    """
+
+    def __init__(self):
+        self.activity = collections.Counter()
+        self.authors = collections.defaultdict(collections.Counter)
+        self.new_posts = []
+        self.comment_deltas = collections.Counter()
+        self.deleted_posts = set()
+
+    def __bool__(self):
+        return bool(self.activity or self.new_posts or self.comment_deltas or self.deleted_posts)
+
+    def created(self, metric, created_at, user_id, delta=1):
+        created_at = created_at or datetime.utcnow()
+        for granularity in GRANULARITIES:
+            self.activity[(granularity, metric, truncate(created_at, granularity))] += delta
+        self.authors[(created_at.date(), user_id)][metric] += delta
+
+    def post_deleted(self, post_id, user_id, created_at):
+        self.created('posts', created_at, user_id, -1)
+        self.deleted_posts.add(post_id)
+
+    def comment_deleted(self, post_id, user_id, created_at):
+        self.created('comments', created_at, user_id, -1)
+        self.comment_deltas[post_id] -= 1
+
+    def apply(self, connection):
+        for (granularity, metric, bucket_start), count in sorted(self.activity.items()):
+            if count:
+                _add(connection, ActivityRollup,
+                     {'granularity': granularity, 'metric': metric, 'bucket_start': bucket_start}, {'count': count})
+        emptied = []
+        for (day, user_id), counts in sorted(self.authors.items()):
+            _add(connection, AuthorActivity, {'day': day, 'user_id': user_id},
+                 {'posts': counts['posts'], 'comments': counts['comments']})
+            if counts['posts'] < 0 or counts['comments'] < 0:
+                emptied.append((day, user_id))
+        for day, user_id in emptied:
+            # an author with nothing left that day is no longer active on it
+            connection.execute(delete(AuthorActivity.__table__).where(
+                AuthorActivity.day == day, AuthorActivity.user_id == user_id,
+                AuthorActivity.posts <= 0, AuthorActivity.comments <= 0))
+        # Bucket moves are summed up and written last, once per bucket
+        buckets = collections.Counter()
+        for post_id in sorted(self.new_posts):
+            connection.execute(insert(PostCommentCount.__table__).values(post_id=post_id, comments=0))
+        buckets[comment_bucket(0)] += len(self.new_posts)
+        for post_id, delta in sorted(self.comment_deltas.items()):
+            if post_id not in self.deleted_posts and delta:
+                add_comments(connection, post_id, delta, buckets)
+        if self.deleted_posts:
+            _drop_post_counts(connection, self.deleted_posts, buckets)
+        for lowest, highest, label in COMMENT_BUCKETS:
+            if buckets[label]:
+                _add(connection, CommentCountBucket, {'bucket': label}, {'posts': buckets[label]})
+
+
+def add_comments(connection, post_id, delta, buckets):
+    """Change the comment count of a post and count its move between
+    buckets in ``buckets``.
+
+    The UPDATE locks the row, so reading the new count right after it is
+    safe against concurrent comments on the same post.
+    """
+    table = PostCommentCount.__table__
+    result = connection.execute(update(table).where(table.c.post_id == post_id)
+                                .values(comments=table.c.comments + delta))
+    if not result.rowcount:
+        return
+    new_count = connection.scalar(select(table.c.comments).where(table.c.post_id == post_id))
+    buckets[comment_bucket(new_count - delta)] -= 1
+    buckets[comment_bucket(new_count)] += 1
+
+
+def _drop_post_counts(connection, post_ids, buckets):
+    """Take deleted posts out of the comments-per-post distribution"""
+    table = PostCommentCount.__table__
+    post_ids = sorted(post_ids)
+    rows = connection.execute(select(table.c.post_id, table.c.comments).where(table.c.post_id.in_(post_ids))).all()
+    buckets.subtract(comment_bucket(comments) for post_id, comments in rows)
+    connection.execute(delete(table).where(table.c.post_id.in_(post_ids)))
+
+
+def forget_comments(connection, rows):
+    """Account for comments deleted in bulk, rows of (post_id, user_id, created_at)"""
+    changes = RollupChanges()
+    for post_id, user_id, created_at in rows:
+        changes.comment_deleted(post_id, user_id, created_at)
+    changes.apply(connection)
+
+
+def forget_posts(connection, rows):
+    """Account for posts deleted in bulk, rows of (id, user_id, created_at)"""
+    changes = RollupChanges()
+    for post_id, user_id, created_at in rows:
+        changes.post_deleted(post_id, user_id, created_at)
+    changes.apply(connection)
+
+
+@on_cascade
+def _cascaded_deletes(session, cascade):
+    """Rows removed by ON DELETE CASCADE never reach the session, account
+    for them while they still exist. The deltas are written together with
+    the flush's own in after_flush"""
+    changes = session.info.setdefault(CASCADE_KEY, RollupChanges())
+    for row in cascade.posts:
+        changes.post_deleted(row.id, row.user_id, row.created_at)
+    for row in cascade.comments:
+        changes.comment_deleted(row.post_id, row.user_id, row.created_at)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_cascade(session, previous_transaction):
+    session.info.pop(CASCADE_KEY, None)
+
+
+@event.listens_for(Session, 'after_flush')
+def _update_rollups(session, flush_context):
+    changes = session.info.pop(CASCADE_KEY, None) or RollupChanges()
+    for obj in session.new:
+        if isinstance(obj, Post):
+            changes.created('posts', obj.created_at, obj.user_id)
+            changes.new_posts.append(obj.id)
+        elif isinstance(obj, Comment):
+            changes.created('comments', obj.created_at, obj.user_id)
+            changes.comment_deltas[obj.post_id] += 1
+    for obj in session.deleted:
+        if isinstance(obj, Post):
+            changes.post_deleted(obj.id, obj.user_id, obj.created_at)
+        elif isinstance(obj, Comment):
+            changes.comment_deleted(obj.post_id, obj.user_id, obj.created_at)
+    if changes:
+        changes.apply(session.connection())
+
+
+def rebuild_rollups(chunk_size=5000):
+    """Recompute every rollup from the base tables, for existing data"""
+    activity = collections.Counter()
+    authors = collections.defaultdict(collections.Counter)
+    post_counts = {}
+
+    def created(metric, created_at, user_id):
+        for granularity in GRANULARITIES:
+            activity[(granularity, metric, truncate(created_at, granularity))] += 1
+        authors[(created_at.date(), user_id)][metric] += 1
+
+    for post_id, user_id, created_at in db.session.query(Post.id, Post.user_id, Post.created_at).yield_per(chunk_size):
+        created('posts', created_at, user_id)
+        post_counts[post_id] = 0
+    for post_id, user_id, created_at in (db.session.query(Comment.post_id, Comment.user_id, Comment.created_at)
+                                         .yield_per(chunk_size)):
+        created('comments', created_at, user_id)
+        post_counts[post_id] = post_counts.get(post_id, 0) + 1
+    buckets = collections.Counter(comment_bucket(count) for count in post_counts.values())
+
+    for model in (ActivityRollup, AuthorActivity, PostCommentCount, CommentCountBucket):
+        db.session.execute(delete(model))
+    rows = {
+        ActivityRollup: [{'granularity': g, 'metric': m, 'bucket_start': b, 'count': c}
+                         for (g, m, b), c in activity.items()],
+        AuthorActivity: [{'day': day, 'user_id': user_id, 'posts': c['posts'], 'comments': c['comments']}
+                         for (day, user_id), c in authors.items()],
+        PostCommentCount: [{'post_id': post_id, 'comments': count} for post_id, count in post_counts.items()],
+        CommentCountBucket: [{'bucket': bucket, 'posts': posts} for bucket, posts in buckets.items()],
+    }
+    for model, model_rows in rows.items():
+        for start in range(0, len(model_rows), chunk_size):
+            db.session.execute(insert(model.__table__), model_rows[start:start + chunk_size])
+    db.session.commit()
+    return {model.__tablename__: len(model_rows) for model, model_rows in rows.items()}
+
+
+def parse_window(args):
+    """(start, end, granularity) from ?from=&to=&granularity=, raises ValueError"""
+    granularity = args.get('granularity') or 'day'
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"granularity must be one of: {', '.join(GRANULARITIES)}")
+    try:
+        end = datetime.fromisoformat(args['to']) if args.get('to') else datetime.utcnow()
+        start = datetime.fromisoformat(args['from']) if args.get('from') else end - DEFAULT_WINDOWS[granularity]
+    except ValueError:
+        raise ValueError('from and to must be ISO dates, e.g. 2026-01-31 or 2026-01-31T12:00')
+    if start > end:
+        raise ValueError('from must be before to')
+    if end - start > MAX_WINDOWS[granularity]:
+        raise ValueError(f'Window too large for {granularity} granularity')
+    return start, end, granularity
+
+
+def query_analytics(start, end, granularity='day'):
+    """Activity series, active authors and the comments-per-post distribution
+    for a window, read from the rollup tables only"""
+    first = truncate(start, granularity)
+    step = timedelta(hours=1) if granularity == 'hour' else timedelta(days=1)
+
+    counts = collections.defaultdict(dict)
+    for bucket_start, metric, count in db.session.execute(
+            select(ActivityRollup.bucket_start, ActivityRollup.metric, ActivityRollup.count)
+            .where(ActivityRollup.granularity == granularity,
+                   ActivityRollup.metric.in_(METRICS),
+                   ActivityRollup.bucket_start.between(first, end))):
+        counts[bucket_start][metric] = count
+
+    window = (AuthorActivity.day >= start.date(), AuthorActivity.day <= end.date())
+    authors_per_day = dict(db.session.execute(
+        select(AuthorActivity.day, func.count()).where(*window).group_by(AuthorActivity.day)).all())
+    active_authors = db.session.scalar(select(func.count(distinct(AuthorActivity.user_id))).where(*window))
+
+    series = []
+    bucket_start = first
+    while bucket_start <= end:
+        row = {'bucket': bucket_start.isoformat(),
+               'posts': counts[bucket_start].get('posts', 0) if bucket_start in counts else 0,
+               'comments': counts[bucket_start].get('comments', 0) if bucket_start in counts else 0}
+        if granularity == 'day':
+            row['active_authors'] = authors_per_day.get(bucket_start.date(), 0)
+        series.append(row)
+        bucket_start += step
+
+    distribution = dict(db.session.execute(select(CommentCountBucket.bucket, CommentCountBucket.posts)).all())
+    return {
+        'window': {'from': start.isoformat(), 'to': end.isoformat(), 'granularity': granularity},
+        'totals': {
+            'posts': sum(row['posts'] for row in series),
+            'comments': sum(row['comments'] for row in series),
+            'active_authors': active_authors
+        },
+        'series': series,
+        'comments_per_post': [{'comments': label, 'posts': distribution.get(label, 0)}
+                              for lowest, highest, label in COMMENT_BUCKETS]
+    }
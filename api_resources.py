@@ -1,7 +1,20 @@
-from flask_restful import Api, Resource, reqparse
+from flask_restful import Api, Resource, reqparse, abort
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from flask import jsonify
+from flask import jsonify, current_app
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
 from models import db, User, Post, Comment
+from autocomplete import autocomplete
+from availability import availability, find_conflict
+from shared_cache import POST_NAMESPACE, shared_cache
+from streaming import stream_response, STREAM_FORMATS
+from fieldsets import Field, FieldSet, usernames_by, counts_by
+from db_routing import use_primary, use_replica
+from pagination import paginate_desc
+from purge import delete_user
+from changefeed import CursorExpired, read_changes
+from timeline import timelines
+from geo import clusters, parse_bbox, within
 from datetime import datetime
 
 api = Api()
@@ -12,42 +25,183 @@ user_parser.add_argument('username', type=str, required=True, help='Username is
 user_parser.add_argument('email', type=str, required=True, help='Email is required')
 user_parser.add_argument('password', type=str, required=True, help='Password is required')
 
+# Parser for username/email availability checks
+availability_parser = reqparse.RequestParser()
+availability_parser.add_argument('username', type=str, location='args')
+availability_parser.add_argument('email', type=str, location='args')
+
 # Parser for posts
 post_parser = reqparse.RequestParser()
 post_parser.add_argument('title', type=str, required=True, help='Title is required')
 post_parser.add_argument('content', type=str, required=True, help='Content is required')
+post_parser.add_argument('latitude', type=float, help='Latitude must be a number')
+post_parser.add_argument('longitude', type=float, help='Longitude must be a number')
 
 # Parser for comments
 comment_parser = reqparse.RequestParser()
 comment_parser.add_argument('content', type=str, required=True, help='Content is required')
 
+# Parser for collection listings
+list_parser = reqparse.RequestParser()
+list_parser.add_argument('stream', type=str, choices=STREAM_FORMATS, location='args',
+                         help='Stream format must be json or ndjson')
+list_parser.add_argument('fields', type=str, location='args')
+
+# Parser for single resources
+item_parser = reqparse.RequestParser()
+item_parser.add_argument('fields', type=str, location='args')
+
+# Parser for comment pages
+comments_parser = reqparse.RequestParser()
+comments_parser.add_argument('fields', type=str, location='args')
+comments_parser.add_argument('cursor', type=str, location='args')
+comments_parser.add_argument('limit', type=int, location='args', help='Limit must be a number')
+
+# Parser for the change feed
+changes_parser = reqparse.RequestParser()
+changes_parser.add_argument('since', type=str, location='args')
+changes_parser.add_argument('limit', type=int, location='args', help='Limit must be a number')
+
+# Parser for timeline pages
+timeline_parser = reqparse.RequestParser()
+timeline_parser.add_argument('cursor', type=str, location='args')
+timeline_parser.add_argument('limit', type=int, location='args', help='Limit must be a number')
+
+# Parser for map viewport queries
+within_parser = reqparse.RequestParser()
+within_parser.add_argument('bbox', type=str, required=True, location='args',
+                           help='bbox=west,south,east,north is required')
+within_parser.add_argument('zoom', type=int, location='args', help='Zoom must be a number')
+within_parser.add_argument('limit', type=int, default=500, location='args', help='Limit must be a number')
+
+# Parser for autocomplete
+autocomplete_parser = reqparse.RequestParser()
+autocomplete_parser.add_argument('q', type=str, required=True, location='args', help='Query prefix is required')
+autocomplete_parser.add_argument('type', type=str, default='posts', choices=('posts', 'users'), location='args')
+autocomplete_parser.add_argument('limit', type=int, default=10, location='args')
+
+# Selectable fields (?fields=id,title,...), only the columns they need are loaded
+user_fields = FieldSet(User, {
+    'id': Field(),
+    'username': Field(columns=(User.username,)),
+    'email': Field(columns=(User.email,)),
+    'created_at': Field(columns=(User.created_at,)),
+    'posts_count': Field(bulk=counts_by(Post, Post.user_id)),
+    'comments_count': Field(bulk=counts_by(Comment, Comment.user_id))
+}, default=['id', 'username', 'email', 'created_at'])
+
+comment_fields = FieldSet(Comment, {
+    'id': Field(),
+    'content': Field(columns=(Comment.content,)),
+    'author': Field(columns=(Comment.user_id,), bulk=usernames_by('user_id')),
+    'user_id': Field(columns=(Comment.user_id,)),
+    'post_id': Field(columns=(Comment.post_id,)),
+    'created_at': Field(columns=(Comment.created_at,))
+}, default=['id', 'content', 'author', 'created_at'])
+
+
+def comments_of_posts(posts):
+    """Bulk load the comments of several posts"""
+    post_ids = [post.id for post in posts]
+    names = comment_fields.default + ['post_id']
+    comments = (comment_fields.query(names)
+                .filter(Comment.post_id.in_(post_ids))
+                .order_by(Comment.created_at)
+                .all())
+    grouped = {post_id: [] for post_id in post_ids}
+    for row in comment_fields.serialize(comments, names):
+        grouped[row.pop('post_id')].append(row)
+    return grouped
+
+
+def comments_page(post_id, names, cursor=None, limit=None):
+    """One page of a post's comments, newest first, and the next page cursor"""
+    config = current_app.config
+    limit = min(limit or config.get('COMMENTS_PAGE_SIZE', 20), config.get('COMMENTS_MAX_PAGE_SIZE', 100))
+    query = comment_fields.query(names + ['created_at']).filter(Comment.post_id == post_id)
+    try:
+        comments, next_cursor = paginate_desc(query, [Comment.created_at, Comment.id], cursor, max(1, limit))
+    except ValueError as e:
+        abort(400, message=str(e))
+    return comment_fields.serialize(comments, names), next_cursor
+
+
+post_fields = FieldSet(Post, {
+    'id': Field(),
+    'title': Field(columns=(Post.title,)),
+    'content': Field(columns=(Post.content,)),
+    'excerpt': Field(columns=(Post.excerpt,)),
+    'author': Field(columns=(Post.user_id,), bulk=usernames_by('user_id')),
+    'user_id': Field(columns=(Post.user_id,)),
+    'created_at': Field(columns=(Post.created_at,)),
+    'updated_at': Field(columns=(Post.updated_at,)),
+    'latitude': Field(columns=(Post.latitude,)),
+    'longitude': Field(columns=(Post.longitude,)),
+    'comments_count': Field(bulk=counts_by(Comment, Comment.post_id)),
+    'comments': Field(bulk=comments_of_posts)
+}, default=['id', 'title', 'excerpt', 'author', 'created_at', 'comments_count'])
+
+
+def location_error(args):
+    """Message for invalid post coordinates, None when they are fine"""
+    latitude, longitude = args.get('latitude'), args.get('longitude')
+    if (latitude is None) != (longitude is None):
+        return 'Both latitude and longitude are required for a location'
+    if latitude is not None and not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return 'Latitude must be within -90..90 and longitude within -180..180'
+    return None
+
+
+def parse_fields(fieldset, raw):
+    """Parse ?fields= or abort with 400"""
+    try:
+        return fieldset.parse(raw)
+    except ValueError as e:
+        abort(400, message=str(e))
+
+
+def stream_statement(fieldset, names):
+    """Single statement for ?stream= or abort with 400"""
+    try:
+        return fieldset.stream_statement(names)
+    except ValueError as e:
+        abort(400, message=str(e))
+
 
 class UsersAPI(Resource):
+    method_decorators = {'get': [use_replica]}
+
     def get(self):
         """Get all users"""
-        users = User.query.all()
-        users_data = [{
-            'id': user.id,
-            'username': user.username,
-            'email': user.email,
-            'created_at': user.created_at.isoformat()
-        } for user in users]
-        return users_data
+        args = list_parser.parse_args()
+        names = parse_fields(user_fields, args['fields'])
+
+        if args['stream']:
+            statement = stream_statement(user_fields, names).order_by(User.id)
+            return stream_response(statement, lambda rows: user_fields.serialize_rows(rows, names),
+                                   args['stream'])
+
+        users = user_fields.query(names).all()
+        return user_fields.serialize(users, names)
 
     def post(self):
         """Create new user"""
         args = user_parser.parse_args()
 
-        # Check if user exists
-        if User.query.filter_by(username=args['username']).first():
-            return {'message': 'Username already exists'}, 400
-        if User.query.filter_by(email=args['email']).first():
-            return {'message': 'Email already exists'}, 400
-
         user = User(username=args['username'], email=args['email'])
         user.set_password(args['password'])
         db.session.add(user)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # The unique constraints decide, existing users are only looked up on conflict
+            db.session.rollback()
+            conflict = find_conflict(args['username'], args['email'])
+            if conflict == 'username':
+                return {'message': 'Username already exists'}, 400
+            if conflict == 'email':
+                return {'message': 'Email already exists'}, 400
+            raise
 
         return {
             'message': 'User created successfully',
@@ -60,17 +214,16 @@ class UsersAPI(Resource):
 
 
 class UserAPI(Resource):
+    method_decorators = {'get': [use_replica]}
+
     def get(self, user_id):
         """Get user by ID"""
-        user = User.query.get_or_404(user_id)
-        return {
-            'id': user.id,
-            'username': user.username,
-            'email': user.email,
-            'created_at': user.created_at.isoformat(),
-            'posts_count': len(user.posts),
-            'comments_count': len(user.comments)
-        }
+        args = item_parser.parse_args()
+        names = parse_fields(user_fields, args['fields'] or
+                             'id,username,email,created_at,posts_count,comments_count')
+
+        user = user_fields.query(names).filter(User.id == user_id).first_or_404()
+        return user_fields.serialize([user], names)[0]
 
     @jwt_required()
     def delete(self, user_id):
@@ -80,34 +233,41 @@ class UserAPI(Resource):
             return {'message': 'Access denied'}, 403
 
         user = User.query.get_or_404(user_id)
-        db.session.delete(user)
-        db.session.commit()
+        if not delete_user(current_app._get_current_object(), user):
+            return {'message': 'User deletion started'}, 202
         return {'message': 'User deleted successfully'}
 
 
 class PostsAPI(Resource):
+    method_decorators = {'get': [use_replica]}
+
     def get(self):
         """Get all posts"""
-        posts = Post.query.order_by(Post.created_at.desc()).all()
-        posts_data = [{
-            'id': post.id,
-            'title': post.title,
-            'content': post.content,
-            'author': post.author.username,
-            'created_at': post.created_at.isoformat(),
-            'comments_count': len(post.comments)
-        } for post in posts]
-        return posts_data
+        args = list_parser.parse_args()
+        names = parse_fields(post_fields, args['fields'])
+
+        if args['stream']:
+            statement = stream_statement(post_fields, names).order_by(Post.created_at.desc())
+            return stream_response(statement, lambda rows: post_fields.serialize_rows(rows, names),
+                                   args['stream'])
+
+        posts = post_fields.query(names).order_by(Post.created_at.desc()).all()
+        return post_fields.serialize(posts, names)
 
     @jwt_required()
     def post(self):
         """Create new post"""
         args = post_parser.parse_args()
         current_user_id = get_jwt_identity()
+        error = location_error(args)
+        if error:
+            return {'message': error}, 400
 
         post = Post(
             title=args['title'],
             content=args['content'],
+            latitude=args['latitude'],
+            longitude=args['longitude'],
             user_id=current_user_id
         )
         db.session.add(post)
@@ -119,29 +279,93 @@ class PostsAPI(Resource):
                 'id': post.id,
                 'title': post.title,
                 'content': post.content,
+                'latitude': post.latitude,
+                'longitude': post.longitude,
                 'author': post.author.username
             }
         }, 201
 
 
+class PostsWithinAPI(Resource):
+    method_decorators = {'get': [use_replica]}
+
+    def get(self):
+        """Geotagged posts in a map viewport, clustered when a zoom is given"""
+        args = within_parser.parse_args()
+        try:
+            bbox = parse_bbox(args['bbox'])
+        except ValueError as e:
+            abort(400, message=str(e))
+
+        if args['zoom'] is None:
+            limit = max(1, min(args['limit'], 2000))
+            names = ['id', 'title', 'latitude', 'longitude']
+            posts = (post_fields.query(names).filter(within(Post, bbox))
+                     .order_by(Post.created_at.desc()).limit(limit + 1).all())
+            return {
+                'bbox': bbox,
+                'posts': post_fields.serialize(posts[:limit], names),
+                'truncated': len(posts) > limit
+            }
+
+        zoom = max(0, min(args['zoom'], 22))
+        rows = clusters(db.session, Post, bbox, zoom)
+        # Single posts are shown as themselves, with their titles in one query
+        titles = dict(db.session.execute(select(Post.id, Post.title).where(
+            Post.id.in_([first_id for cell, count, lat, lon, first_id in rows if count == 1]))).all())
+        return {
+            'bbox': bbox,
+            'zoom': zoom,
+            'clusters': [{
+                'geohash': cell,
+                'count': count,
+                'latitude': latitude,
+                'longitude': longitude,
+                'post': {'id': first_id, 'title': titles.get(first_id)} if count == 1 else None
+            } for cell, count, latitude, longitude, first_id in rows]
+        }
+
+
+def post_representation(post_id, names):
+    """Serialized post with the requested fields, None if it does not exist"""
+    # Only the first page of comments is embedded, the rest comes from
+    # /api/posts/<id>/comments?cursor=
+    embed_comments = 'comments' in names
+    post_names = [name for name in names if name != 'comments']
+
+    post = post_fields.query(post_names).filter(Post.id == post_id).first()
+    if post is None:
+        return None
+    result = post_fields.serialize([post], post_names)[0]
+    if embed_comments:
+        result['comments'], result['comments_next_cursor'] = comments_page(post_id, comment_fields.default)
+    return result
+
+
 class PostAPI(Resource):
+    method_decorators = {'get': [use_replica]}
+
     def get(self, post_id):
         """Get post by ID"""
-        post = Post.query.get_or_404(post_id)
-        return {
-            'id': post.id,
-            'title': post.title,
-            'content': post.content,
-            'author': post.author.username,
-            'created_at': post.created_at.isoformat(),
-            'updated_at': post.updated_at.isoformat() if post.updated_at else None,
-            'comments': [{
-                'id': comment.id,
-                'content': comment.content,
-                'author': comment.author.username,
-                'created_at': comment.created_at.isoformat()
-            } for comment in post.comments]
-        }
+        args = item_parser.parse_args()
+        names = parse_fields(post_fields, args['fields'] or
+                             'id,title,content,author,created_at,updated_at,comments')
+
+        # The default representation is shared by all workers through the
+        # cache and dropped when the post, its comments or its author change.
+        # Misses are read from the primary, a lagging replica right after
+        # the invalidation would put the old version back for the whole TTL
+        def load():
+            with use_primary():
+                return post_representation(post_id, names)
+
+        if args['fields']:
+            result = post_representation(post_id, names)
+        else:
+            result = shared_cache.get_or_set(POST_NAMESPACE, post_id, load)
+        if result is None:
+            abort(404)
+        return result
 
     @jwt_required()
     def put(self, post_id):
@@ -152,9 +376,14 @@ class PostAPI(Resource):
         post = Post.query.get_or_404(post_id)
         if post.user_id != current_user_id:
             return {'message': 'Access denied'}, 403
+        error = location_error(args)
+        if error:
+            return {'message': error}, 400
 
         post.title = args['title']
         post.content = args['content']
+        post.latitude = args['latitude']
+        post.longitude = args['longitude']
         post.updated_at = datetime.utcnow()
         db.session.commit()
 
@@ -163,7 +392,9 @@ class PostAPI(Resource):
             'post': {
                 'id': post.id,
                 'title': post.title,
-                'content': post.content
+                'content': post.content,
+                'latitude': post.latitude,
+                'longitude': post.longitude
             }
         }
 
@@ -182,6 +413,20 @@ class PostAPI(Resource):
 
 
 class CommentsAPI(Resource):
+    method_decorators = {'get': [use_replica]}
+
+    def get(self, post_id):
+        """Get a page of comments of a post"""
+        args = comments_parser.parse_args()
+        names = parse_fields(comment_fields, args['fields'])
+
+        post_fields.query(['id']).filter(Post.id == post_id).first_or_404()
+        comments, next_cursor = comments_page(post_id, names, args['cursor'], args['limit'])
+        return {
+            'comments': comments,
+            'next_cursor': next_cursor
+        }
+
     @jwt_required()
     def post(self, post_id):
         """Add comment to post"""
@@ -224,10 +469,137 @@ class CommentAPI(Resource):
         return {'message': 'Comment deleted successfully'}
 
 
+# Fields of the current state embedded in change feed entries
+change_fields = {
+    'user': (user_fields, ['id', 'username', 'created_at']),
+    'post': (post_fields, ['id', 'title', 'content', 'excerpt', 'latitude', 'longitude', 'user_id',
+                           'created_at', 'updated_at']),
+    'comment': (comment_fields, ['id', 'content', 'user_id', 'post_id', 'created_at'])
+}
+
+
+class ChangesAPI(Resource):
+    def get(self):
+        """Users, posts and comments changed since a cursor"""
+        args = changes_parser.parse_args()
+        config = current_app.config
+        limit = min(args['limit'] or config.get('CHANGES_PAGE_SIZE', 100), config.get('CHANGES_MAX_PAGE_SIZE', 1000))
+
+        try:
+            entries, next_cursor, has_more = read_changes(args['since'], max(1, limit),
+                                                          config.get('CHANGES_SETTLE_SECONDS', 5),
+                                                          config.get('CHANGES_TOMBSTONE_DAYS', 30))
+        except ValueError as e:
+            abort(400, message=str(e))
+        except CursorExpired:
+            return {'message': 'Cursor expired, fetch everything again and sync from the start'}, 410
+
+        # One query per entity type for the current state of changed rows,
+        # rows deleted since the entry was written come back as None
+        current = {}
+        for entity, (fieldset, names) in change_fields.items():
+            ids = {entry.entity_id for entry in entries if entry.entity == entity and entry.op != 'delete'}
+            if ids:
+                rows = fieldset.query(names).filter(fieldset.model.id.in_(ids)).all()
+                current.update({(entity, row['id']): row for row in fieldset.serialize(rows, names)})
+
+        return {
+            'changes': [{
+                'seq': entry.id,
+                'entity': entry.entity,
+                'id': entry.entity_id,
+                'op': entry.op,
+                'at': entry.created_at,
+                'data': current.get((entry.entity, entry.entity_id))
+            } for entry in entries],
+            'next_cursor': next_cursor,
+            'has_more': has_more
+        }
+
+
+class TimelineAPI(Resource):
+    method_decorators = {'get': [use_replica]}
+
+    @jwt_required()
+    def get(self):
+        """Posts of the authors the current user follows, newest first"""
+        args = timeline_parser.parse_args()
+        config = current_app.config
+        limit = min(args['limit'] or config.get('TIMELINE_PAGE_SIZE', 20), 100)
+
+        try:
+            posts, next_cursor = timelines.page(int(get_jwt_identity()), args['cursor'], max(1, limit))
+        except ValueError as e:
+            abort(400, message=str(e))
+        return {
+            'posts': post_fields.serialize(posts, post_fields.default),
+            'next_cursor': next_cursor
+        }
+
+
+class FollowAPI(Resource):
+    @jwt_required()
+    def post(self, user_id):
+        """Follow a user"""
+        current_user_id = int(get_jwt_identity())
+        if current_user_id == user_id:
+            return {'message': 'You cannot follow yourself'}, 400
+
+        User.query.get_or_404(user_id)
+        if not timelines.follow(current_user_id, user_id):
+            return {'message': 'Already following'}
+        return {'message': 'User followed successfully'}, 201
+
+    @jwt_required()
+    def delete(self, user_id):
+        """Unfollow a user"""
+        if not timelines.unfollow(int(get_jwt_identity()), user_id):
+            return {'message': 'Not following'}, 404
+        return {'message': 'User unfollowed successfully'}
+
+
+class AutocompleteAPI(Resource):
+    method_decorators = {'get': [use_replica]}
+
+    def get(self):
+        """Type-ahead search on post titles or usernames"""
+        args = autocomplete_parser.parse_args()
+        limit = max(1, min(args['limit'], 50))
+
+        results = autocomplete.search(args['q'], kind=args['type'], limit=limit)
+        return {
+            'query': args['q'],
+            'type': args['type'],
+            'results': [{
+                'id': entity_id,
+                'text': text
+            } for entity_id, text, score in results]
+        }
+
+
+class AvailabilityAPI(Resource):
+    method_decorators = {'get': [use_replica]}
+
+    def get(self):
+        """Whether a username and/or email is still free, for live form validation"""
+        args = availability_parser.parse_args()
+        fields = [field for field in ('username', 'email') if args[field] and args[field].strip()]
+        if not fields:
+            return {'message': 'Pass username and/or email'}, 400
+        return {field: {'value': args[field], 'available': availability.is_available(field, args[field])}
+                for field in fields}
+
+
 # Register API routes
 api.add_resource(UsersAPI, '/api/users')
 api.add_resource(UserAPI, '/api/users/<int:user_id>')
+api.add_resource(AvailabilityAPI, '/api/users/availability')
 api.add_resource(PostsAPI, '/api/posts')
+api.add_resource(PostsWithinAPI, '/api/posts/within')
 api.add_resource(PostAPI, '/api/posts/<int:post_id>')
 api.add_resource(CommentsAPI, '/api/posts/<int:post_id>/comments')
-api.add_resource(CommentAPI, '/api/comments/<int:comment_id>')
\ No newline at end of file
+api.add_resource(CommentAPI, '/api/comments/<int:comment_id>')
+api.add_resource(FollowAPI, '/api/users/<int:user_id>/follow')
+api.add_resource(TimelineAPI, '/api/timeline')
+api.add_resource(ChangesAPI, '/api/changes')
+api.add_resource(AutocompleteAPI, '/api/autocomplete')
\ No newline at end of file
@@ -1,25 +1,83 @@
 import asyncio
 import aiohttp
 from aiohttp import web, ClientSession
-import json
-import aiofiles
 from datetime import datetime
+import logging
 import os
-
-
-async def get_external_data():
+import time
+
+from config import Config
+from loop_monitor import LoopLagMonitor
+from metrics import registry, http_requests, http_latency, http_in_flight, external_circuit_open
+from request_profiler import make_profile_middleware
+from admission import make_admission_middleware
+from compression import make_compression_middleware
+from log_setup import init_logging
+
+logger = logging.getLogger('async')
+# Request activity, also written to LOG_ACTIVITY_FILE
+activity_logger = logging.getLogger('async.activity')
+
+
+class CircuitBreaker:
+    """Stops calling a failing dependency for ``reset_timeout`` seconds after
+    ``failure_threshold`` failures in a row, then lets one trial call through"""
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+
+    def allow(self):
+        return self.state != 'open'
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        external_circuit_open.set(0, circuit=self.name)
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold or self.opened_at is not None:
+            self.opened_at = time.monotonic()
+            external_circuit_open.set(1, circuit=self.name)
+
+    def snapshot(self):
+        return {'state': self.state, 'failures': self.failures}
+
+
+async def get_external_data(app):
     """Get data from external API asynchronously"""
-    async with ClientSession() as session:
-        try:
-            # Example: get weather data
-            async with session.get('https://api.openweathermap.org/data/2.5/weather?q=Kyiv&appid=demo') as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    return {'status': 'success', 'data': data}
+    circuit = app['external_circuit']
+    if not circuit.allow():
+        return {'status': 'error', 'message': 'External API unavailable (circuit open)'}
+
+    try:
+        # Example: get weather data
+        async with app['external_session'].get('https://api.openweathermap.org/data/2.5/weather?q=Kyiv&appid=demo') as resp:
+            if resp.status == 200:
+                data = await resp.json()
+                circuit.record_success()
+                return {'status': 'success', 'data': data}
+            else:
+                if resp.status >= 500:
+                    circuit.record_failure()
                 else:
-                    return {'status': 'error', 'message': 'Failed to get weather data'}
-        except Exception as e:
-            return {'status': 'error', 'message': str(e)}
+                    circuit.record_success()
+                return {'status': 'error', 'message': 'Failed to get weather data'}
+    except Exception as e:
+        circuit.record_failure()
+        return {'status': 'error', 'message': str(e)}
 
 
 async def process_data_async(data):
@@ -34,26 +92,10 @@ async def process_data_async(data):
     return processed
 
 
-async def log_activity_async(activity):
-    """Log activity to file asynchronously"""
-    log_entry = {
-        'timestamp': datetime.utcnow().isoformat(),
-        'activity': activity
-    }
-
-    try:
-        async with aiofiles.open('async_logs.txt', 'a') as f:
-            await f.write(json.dumps(log_entry) + '\n')
-        return True
-    except Exception as e:
-        print(f"Logging error: {e}")
-        return False
-
-
 async def handle_async_posts(request):
     """Handle async posts endpoint"""
     try:
-        await log_activity_async('Async posts endpoint accessed')
+        activity_logger.info('Async posts endpoint accessed')
 
         # Simulate database query
         await asyncio.sleep(0.05)
@@ -88,7 +130,7 @@ async def handle_async_posts(request):
         })
 
     except Exception as e:
-        await log_activity_async(f'Error in async posts: {str(e)}')
+        activity_logger.exception('Error in async posts: %s', e)
         return web.json_response({
             'status': 'error',
             'message': str(e)
@@ -98,10 +140,10 @@ async def handle_async_posts(request):
 async def handle_external_data(request):
     """Handle external data fetching"""
     try:
-        await log_activity_async('External data fetch requested')
+        activity_logger.info('External data fetch requested')
 
         # Get data from external source
-        result = await get_external_data()
+        result = await get_external_data(request.app)
 
         if result['status'] == 'success':
             # Process the external data
@@ -116,7 +158,7 @@ async def handle_external_data(request):
             return web.json_response(result, status=400)
 
     except Exception as e:
-        await log_activity_async(f'Error fetching external data: {str(e)}')
+        activity_logger.exception('Error fetching external data: %s', e)
         return web.json_response({
             'status': 'error',
             'message': str(e)
@@ -129,7 +171,7 @@ async def handle_batch_processing(request):
         data = await request.json()
         items = data.get('items', [])
 
-        await log_activity_async(f'Batch processing {len(items)} items')
+        activity_logger.info('Batch processing %d items', len(items))
 
         # Process all items concurrently
         tasks = [process_data_async(item) for item in items]
@@ -142,7 +184,7 @@ async def handle_batch_processing(request):
         })
 
     except Exception as e:
-        await log_activity_async(f'Error in batch processing: {str(e)}')
+        activity_logger.exception('Error in batch processing: %s', e)
         return web.json_response({
             'status': 'error',
             'message': str(e)
@@ -150,62 +192,172 @@ async def handle_batch_processing(request):
 
 
 async def handle_async_analytics(request):
-    """Handle analytics data processing"""
-    try:
-        await log_activity_async('Analytics request received')
-
-        # Simulate multiple async operations
-        tasks = [
-            get_external_data(),
-            process_data_async({'type': 'user_activity'}),
-            process_data_async({'type': 'post_statistics'}),
-            process_data_async({'type': 'comment_analysis'})
-        ]
-
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-
-        analytics_data = {
-            'external_weather': results[0] if not isinstance(results[0], Exception) else {'error': str(results[0])},
-            'user_activity': results[1] if not isinstance(results[1], Exception) else {'error': str(results[1])},
-            'post_stats': results[2] if not isinstance(results[2], Exception) else {'error': str(results[2])},
-            'comment_analysis': results[3] if not isinstance(results[3], Exception) else {'error': str(results[3])},
-            'generated_at': datetime.utcnow().isoformat()
-        }
-
+    """Posts, comments and active authors per hour or day, and the
+    comments-per-post distribution, read from the rollup tables"""
+    analytics = request.app['analytics']
+    if analytics is None:
         return web.json_response({
-            'status': 'success',
-            'analytics': analytics_data
-        })
+            'status': 'error',
+            'message': 'Analytics need the database, start the service from main.py'
+        }, status=503)
 
+    from analytics import parse_window
+    try:
+        start, end, granularity = parse_window(request.query)
+    except ValueError as e:
+        return web.json_response({'status': 'error', 'message': str(e)}, status=400)
+
+    try:
+        data = await asyncio.get_running_loop().run_in_executor(None, analytics, start, end, granularity)
     except Exception as e:
-        await log_activity_async(f'Error in analytics: {str(e)}')
+        activity_logger.exception('Error in analytics: %s', e)
         return web.json_response({
             'status': 'error',
             'message': str(e)
         }, status=500)
 
+    return web.json_response({
+        'status': 'success',
+        'analytics': data
+    })
 
-async def handle_health_check(request):
-    """Health check endpoint"""
-    await log_activity_async('Health check requested')
 
+ENDPOINTS = {
+    'health': '/async/health',
+    'ready': '/async/ready',
+    'posts': '/async/posts',
+    'analytics': '/async/analytics',
+    'batch': '/async/batch',
+    'metrics': '/async/metrics'
+}
+
+
+async def handle_health_check(request):
+    """Liveness probe, answers from memory without any I/O"""
     return web.json_response({
         'status': 'healthy',
         'service': 'async_service',
         'timestamp': datetime.utcnow().isoformat(),
         'version': '1.0.0',
-        'endpoints': {
-            'health': '/async/health',
-            'posts': '/async/posts',
-            'analytics': '/async/analytics',
-            'batch': '/async/batch'
-        }
+        'endpoints': ENDPOINTS
     })
 
 
-def create_async_app():
-    """Create aiohttp application"""
-    app = web.Application()
+async def handle_readiness_check(request):
+    """Readiness probe: DB pool, external API circuit and event loop lag"""
+    app = request.app
+    checks = {
+        'event_loop': app['loop_monitor'].snapshot(),
+        'external_api': app['external_circuit'].snapshot()
+    }
+    ready = True
+
+    lag = checks['event_loop']['lag_ms'].get('0.99', 0.0)
+    if lag > app['max_loop_lag_ms']:
+        checks['event_loop']['status'] = 'lagging'
+        ready = False
+
+    if app['pool_status'] is not None:
+        try:
+            # Pool status only reads counters, run it off the loop anyway
+            # since it takes the Flask app context and the stats lock
+            checks['database'] = await asyncio.get_running_loop().run_in_executor(None, app['pool_status'])
+        except Exception as e:
+            checks['database'] = {'status': 'error', 'message': str(e)}
+            ready = False
+
+    status = 'ready' if ready else 'not_ready'
+    if ready and checks['external_api']['state'] != 'closed':
+        status = 'degraded'
+
+    return web.json_response({
+        'status': status,
+        'checks': checks,
+        'timestamp': datetime.utcnow().isoformat()
+    }, status=200 if ready else 503)
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    """Record latency, status and in-flight requests per route"""
+    started = time.perf_counter()
+    http_in_flight.inc(app='aiohttp')
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        http_in_flight.dec(app='aiohttp')
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource else '<unmatched>'
+        http_latency.observe(time.perf_counter() - started, app='aiohttp', route=route, method=request.method)
+        http_requests.inc(app='aiohttp', route=route, method=request.method, status=status)
+
+
+async def handle_metrics(request):
+    """Prometheus metrics endpoint"""
+    return web.Response(text=registry.render(), content_type='text/plain')
+
+
+async def external_session_ctx(app):
+    """One shared client session (and connection pool) for external calls"""
+    app['external_session'] = ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+    yield
+    await app['external_session'].close()
+
+
+async def loop_monitor_ctx(app):
+    app['loop_monitor'].start()
+    yield
+    await app['loop_monitor'].stop()
+
+
+def flask_bindings(flask_app):
+    """Callables that run database work inside the Flask app context"""
+    from db_routing import get_pool_status
+    from analytics import query_analytics
+    from models import db
+
+    def pool_status():
+        with flask_app.app_context():
+            return get_pool_status(db)
+
+    def analytics(start, end, granularity):
+        with flask_app.app_context():
+            return query_analytics(start, end, granularity)
+
+    return pool_status, analytics
+
+
+def create_async_app(config=Config, flask_app=None):
+    """Create aiohttp application
+
+    ``flask_app`` gives the service access to the database (pool state in
+    the readiness check, analytics); without it those parts are disabled.
+    """
+    settings = {key: getattr(config, key) for key in dir(config) if key.isupper()}
+    # Logging calls on the event loop only enqueue, a thread does the writing
+    init_logging(settings)
+    middlewares = [metrics_middleware]
+    if settings.get('ADMISSION_ENABLED', True):
+        middlewares.append(make_admission_middleware(settings))
+    middlewares.append(make_profile_middleware(settings))
+    if settings.get('COMPRESS_ENABLED', True):
+        middlewares.append(make_compression_middleware(settings))
+    app = web.Application(middlewares=middlewares)
+
+    app['pool_status'], app['analytics'] = flask_bindings(flask_app) if flask_app is not None else (None, None)
+    app['max_loop_lag_ms'] = settings.get('ASYNC_READY_MAX_LOOP_LAG_MS', 500)
+    app['loop_monitor'] = LoopLagMonitor(settings.get('ASYNC_LOOP_LAG_INTERVAL_MS', 100) / 1000)
+    app['external_circuit'] = CircuitBreaker('external_api',
+                                             settings.get('EXTERNAL_CIRCUIT_FAILURES', 5),
+                                             settings.get('EXTERNAL_CIRCUIT_RESET_SECONDS', 30))
+    app.cleanup_ctx.append(external_session_ctx)
+    app.cleanup_ctx.append(loop_monitor_ctx)
 
     # Add routes (removed WebSocket routes)
     app.router.add_get('/async/posts', handle_async_posts)
@@ -213,13 +365,15 @@ def create_async_app():
     app.router.add_post('/async/batch', handle_batch_processing)
     app.router.add_get('/async/analytics', handle_async_analytics)
     app.router.add_get('/async/health', handle_health_check)
+    app.router.add_get('/async/ready', handle_readiness_check)
+    app.router.add_get('/async/metrics', handle_metrics)
 
     return app
 
 
-async def run_async_server():
+async def run_async_server(flask_app=None):
     """Run the async server"""
-    app = create_async_app()
+    app = create_async_app(flask_app=flask_app)
 
     # Create logs directory if it doesn't exist
     os.makedirs('logs', exist_ok=True)
@@ -230,16 +384,16 @@ async def run_async_server():
     site = web.TCPSite(runner, 'localhost', 8080)
     await site.start()
 
-    print("🚀 Async server started on http://localhost:8080")
-    print("Available endpoints:")
-    print("  GET  /async/posts - Get posts asynchronously")
-    print("  GET  /async/external - Fetch external data")
-    print("  POST /async/batch - Batch processing")
-    print("  GET  /async/analytics - Analytics data")
-    print("  GET  /async/health - Health check")
-
-    await log_activity_async('Async server started')
+    logger.info('Async server started on http://localhost:8080',
+                extra={'endpoints': sorted({route.resource.canonical for route in app.router.routes()})})
+    activity_logger.info('Async server started')
 
 
 if __name__ == '__main__':
-    asyncio.run(run_async_server())
\ No newline at end of file
+    from main import create_app
+
+    async def serve_forever():
+        await run_async_server(create_app())
+        await asyncio.Event().wait()
+
+    asyncio.run(serve_forever())
\ No newline at end of file
@@ -0,0 +1,288 @@
+import bisect
+import collections
+import heapq
+import sys
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from commit_hooks import after_commit, on_cascade, on_commit
+from models import db, User, Post
+
+# Separates the normalized text from the entity id inside a sorted key,
+# it sorts before any printable character so "abc" < "abc\x00..." < "abcd"
+KEY_SEPARATOR = '\x00'
+PREFIX_END = '\U0010ffff'
+
+
+def normalize(text):
+    """Normalize text for prefix matching"""
+    return ' '.join((text or '').split()).casefold()
+
+
+class PrefixIndex:
+    """Compact prefix index over a sorted list of keys.
+
+    Every entry is stored once as ``"<normalized text>\\x00<id>"`` in a sorted
+    list, so a prefix lookup is two bisections. The label and score live in a
+    dict keyed by id. Results for prefixes that match more than
+    ``scan_threshold`` keys, or are no longer than ``short_prefix_length``,
+    are cached (up to ``max_cached`` prefixes) and invalidated on writes.
+    """
+
+    def __init__(self, max_entries=1000000, short_prefix_length=2, scan_threshold=1000, max_cached=10000):
+        self.max_entries = max_entries
+        self.short_prefix_length = short_prefix_length
+        self.scan_threshold = scan_threshold
+        self.max_cached = max_cached
+        self._keys = []
+        self._entries = {}
+        self._cache = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _make_key(text, entity_id):
+        return f'{normalize(text)}{KEY_SEPARATOR}{entity_id}'
+
+    def _invalidate(self, key):
+        if self._cache:
+            text = key.rsplit(KEY_SEPARATOR, 1)[0]
+            for length in range(1, len(text) + 1):
+                self._cache.pop(text[:length], None)
+
+    def _remove_locked(self, entity_id):
+        entry = self._entries.pop(entity_id, None)
+        if entry is None:
+            return
+        key = self._make_key(entry[1], entity_id)
+        position = bisect.bisect_left(self._keys, key)
+        if position < len(self._keys) and self._keys[position] == key:
+            del self._keys[position]
+        self._invalidate(key)
+
+    def add(self, entity_id, text, score):
+        """Insert or replace an entry"""
+        with self._lock:
+            self._remove_locked(entity_id)
+            key = self._make_key(text, entity_id)
+            bisect.insort(self._keys, key)
+            self._entries[entity_id] = (score, text)
+            self._invalidate(key)
+            if len(self._entries) > self.max_entries:
+                self._evict_locked()
+
+    def remove(self, entity_id):
+        """Remove an entry if present"""
+        with self._lock:
+            self._remove_locked(entity_id)
+
+    def load(self, rows):
+        """Replace the whole index with (id, text, score) rows"""
+        entries = {}
+        for entity_id, text, score in rows:
+            entries[entity_id] = (score, text)
+        keys = sorted(self._make_key(text, entity_id) for entity_id, (score, text) in entries.items())
+        with self._lock:
+            self._entries = entries
+            self._keys = keys
+            self._cache.clear()
+            if len(self._entries) > self.max_entries:
+                self._evict_locked()
+
+    def _evict_locked(self):
+        """Drop the lowest scored tenth of the entries to stay under max_entries"""
+        keep = int(self.max_entries * 0.9)
+        survivors = heapq.nlargest(keep, self._entries.items(), key=lambda item: item[1][0])
+        self._entries = dict(survivors)
+        self._keys = sorted(self._make_key(text, entity_id) for entity_id, (score, text) in survivors)
+        self._cache.clear()
+
+    def search(self, prefix, limit=10):
+        """Return up to ``limit`` (id, text, score) matches, best score first"""
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+
+        with self._lock:
+            cached = self._cache.get(prefix)
+            if cached is not None and (len(cached[0]) >= limit or cached[1]):
+                self._cache.move_to_end(prefix)
+                return cached[0][:limit]
+
+            start = bisect.bisect_left(self._keys, prefix)
+            end = bisect.bisect_right(self._keys, prefix + PREFIX_END, lo=start)
+
+            candidates = []
+            for key in self._keys[start:end]:
+                entity_id = int(key.rsplit(KEY_SEPARATOR, 1)[1])
+                score, text = self._entries[entity_id]
+                candidates.append((score, entity_id, text))
+
+            best = heapq.nlargest(limit, candidates)
+            results = [(entity_id, text, score) for score, entity_id, text in best]
+            if len(prefix) <= self.short_prefix_length or end - start > self.scan_threshold:
+                # (results, whether they are all the matches)
+                self._cache[prefix] = (results, len(results) == end - start)
+                while len(self._cache) > self.max_cached:
+                    self._cache.popitem(last=False)
+            return results
+
+    def memory_footprint(self):
+        """Approximate number of bytes held by the index"""
+        with self._lock:
+            total = sys.getsizeof(self._keys) + sys.getsizeof(self._entries)
+            total += sum(sys.getsizeof(key) for key in self._keys)
+            for entity_id, entry in self._entries.items():
+                total += sys.getsizeof(entity_id) + sys.getsizeof(entry)
+                total += sys.getsizeof(entry[0]) + sys.getsizeof(entry[1])
+            return total
+
+
+class AutocompleteService:
+    """Post title and username indexes kept in sync with committed writes.
+
+    Rebuilds run in a background thread and replace the indexes when
+    done, searches keep using the old ones (or the database, before the
+    first build) meanwhile. Writes committed during a rebuild are applied
+    to the new indexes too.
+    """
+
+    def __init__(self, max_entries=1000000, refresh_seconds=3600):
+        self.posts = PrefixIndex(max_entries=max_entries)
+        self.users = PrefixIndex(max_entries=max_entries)
+        self.refresh_seconds = refresh_seconds
+        self._built_at = None
+        # Changes committed while a rebuild runs, None when none runs
+        self._pending = None
+        self._build_lock = threading.Lock()
+
+    def ensure_built(self):
+        """Rebuild the indexes in the background when missing or old"""
+        if self._built_at is not None and time.time() - self._built_at < self.refresh_seconds:
+            return
+        with self._build_lock:
+            if self._pending is not None:
+                return
+            self._pending = []
+        app = current_app._get_current_object()
+
+        def run():
+            with app.app_context():
+                try:
+                    self.rebuild()
+                except Exception:
+                    with self._build_lock:
+                        self._pending = None
+                    app.logger.exception('Rebuilding the autocomplete indexes failed')
+
+        threading.Thread(target=run, name='autocomplete-rebuild', daemon=True).start()
+
+    def rebuild(self):
+        """Load both indexes from the database, reading only the needed columns"""
+        with self._build_lock:
+            if self._pending is None:
+                self._pending = []
+        posts = PrefixIndex(max_entries=self.posts.max_entries)
+        post_rows = db.session.query(Post.id, Post.title, Post.created_at).yield_per(5000)
+        posts.load((post_id, title, created_at.timestamp()) for post_id, title, created_at in post_rows)
+
+        users = PrefixIndex(max_entries=self.users.max_entries)
+        user_rows = db.session.query(User.id, User.username, User.created_at).yield_per(5000)
+        users.load((user_id, username, created_at.timestamp()) for user_id, username, created_at in user_rows)
+
+        with self._build_lock:
+            self.posts, self.users = posts, users
+            # Some may be in the loaded rows already, applying them again is harmless
+            self._apply_locked(self._pending)
+            self._pending = None
+            self._built_at = time.time()
+
+    def search(self, prefix, kind='posts', limit=10):
+        """Search one of the indexes"""
+        self.ensure_built()
+        if self._built_at is None:
+            return self._search_database(prefix, kind, limit)
+        index = self.users if kind == 'users' else self.posts
+        return index.search(prefix, limit)
+
+    @staticmethod
+    def _search_database(prefix, kind, limit):
+        """Newest matches straight from the database, until the first build"""
+        prefix = ' '.join((prefix or '').split())
+        if not prefix:
+            return []
+        model, column = (User, User.username) if kind == 'users' else (Post, Post.title)
+        pattern = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        rows = (db.session.query(model.id, column, model.created_at).filter(column.ilike(pattern, escape='\\'))
+                .order_by(model.created_at.desc(), model.id.desc()).limit(limit))
+        return [(entity_id, text, created_at.timestamp()) for entity_id, text, created_at in rows]
+
+    def apply(self, changes):
+        """Apply (action, model, id, text, created_at) changes after a commit"""
+        with self._build_lock:
+            if self._pending is not None:
+                self._pending.extend(changes)
+            if self._built_at is not None:
+                self._apply_locked(changes)
+
+    def _apply_locked(self, changes):
+        for action, model, entity_id, text, created_at in changes:
+            index = self.posts if model == 'posts' else self.users
+            if action == 'delete':
+                index.remove(entity_id)
+            else:
+                index.add(entity_id, text, created_at.timestamp() if created_at else time.time())
+
+
+autocomplete = AutocompleteService()
+
+
+def _collect_change(session, action, obj):
+    if isinstance(obj, Post):
+        change = (action, 'posts', obj.id, obj.title, obj.created_at)
+    elif isinstance(obj, User):
+        change = (action, 'users', obj.id, obj.username, obj.created_at)
+    else:
+        return
+    after_commit(session, 'autocomplete', [change])
+
+
+def remove_after_commit(session, model, ids):
+    """Drop entries deleted with bulk statements once the session commits"""
+    after_commit(session, 'autocomplete', [('delete', model, entity_id, None, None) for entity_id in ids])
+
+
+@on_cascade
+def _cascaded_posts(session, cascade):
+    remove_after_commit(session, 'posts', cascade.post_ids)
+
+
+@event.listens_for(Session, 'after_flush')
+def _track_changes(session, flush_context):
+    for obj in session.new:
+        _collect_change(session, 'upsert', obj)
+    for obj in session.dirty:
+        if session.is_modified(obj, include_collections=False):
+            _collect_change(session, 'upsert', obj)
+    for obj in session.deleted:
+        _collect_change(session, 'delete', obj)
+
+
+@on_commit('autocomplete')
+def _apply_changes(changes):
+    autocomplete.apply(changes)
+
+
+def init_autocomplete(app):
+    """Configure the autocomplete indexes from the app config"""
+    max_entries = app.config.get('AUTOCOMPLETE_MAX_ENTRIES', 1000000)
+    autocomplete.posts.max_entries = max_entries
+    autocomplete.users.max_entries = max_entries
+    autocomplete.refresh_seconds = app.config.get('AUTOCOMPLETE_REFRESH_SECONDS', 3600)
+    return autocomplete
@@ -0,0 +1,231 @@
+import hashlib
+import math
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.orm import Session
+
+from commit_hooks import after_commit, on_commit
+from db_routing import use_primary
+from models import db, User, Change
+
+
+def normalize(value):
+    """Normalize a username or email the way lookups compare them"""
+    return (value or '').strip().casefold()
+
+
+class BloomFilter:
+    """Set membership in a bit array with no false negatives.
+
+    ``might_contain`` returning False means the value was never added;
+    True means it probably was, with about ``error_rate`` chance of a
+    false positive while no more than ``capacity`` values are added.
+    Values cannot be removed, deletes are cleared by rebuilding.
+    """
+
+    def __init__(self, capacity=100000, error_rate=0.01):
+        self.capacity = max(1, capacity)
+        self.error_rate = error_rate
+        self.size = max(8, int(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / self.capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        # Two 64-bit hashes combined into hash_count positions (Kirsch-Mitzenmacher)
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    def add(self, value):
+        for position in self._positions(value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def might_contain(self, value):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+    def __contains__(self, value):
+        return self.might_contain(value)
+
+
+class AvailabilityService:
+    """Bloom filters of taken usernames and emails, kept in sync with
+    committed writes.
+
+    A value the filter has never seen is available without touching the
+    database; a possible hit is confirmed with one indexed lookup. Writes
+    of this process are added on commit, those of other processes are read
+    from the change log every ``sync_seconds``. A log entry that commits
+    more than ``settle_seconds`` after it was written can be missed until
+    the next rebuild, so the answer is a hint for form validation; the
+    unique constraints still decide at registration.
+
+    Rebuilds run in a background thread, requests keep using the old
+    filters (or the database, before the first build) meanwhile.
+    """
+
+    FIELDS = ('username', 'email')
+
+    def __init__(self, error_rate=0.01, refresh_seconds=3600, sync_seconds=2, settle_seconds=5):
+        self.error_rate = error_rate
+        self.refresh_seconds = refresh_seconds
+        self.sync_seconds = sync_seconds
+        self.settle_seconds = settle_seconds
+        self.filters = None
+        self.negatives = 0
+        self.database_checks = 0
+        self._built_at = None
+        self._synced_at = 0
+        # Change log entries up to this id are in the filters
+        self._last_change_id = 0
+        self._rebuilding = False
+        self._lock = threading.Lock()
+
+    def ensure_built(self):
+        """Rebuild the filters when missing, old or too full, and pick up
+        other processes' writes every ``sync_seconds``"""
+        if not self._fresh():
+            self._start_rebuild()
+        elif time.time() - self._synced_at >= self.sync_seconds:
+            self.sync()
+
+    def _fresh(self):
+        return (self._built_at is not None and time.time() - self._built_at < self.refresh_seconds
+                and all(bloom.count <= bloom.capacity for bloom in self.filters.values()))
+
+    def _start_rebuild(self):
+        with self._lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+        app = current_app._get_current_object()
+
+        def run():
+            with app.app_context():
+                try:
+                    self.rebuild()
+                except Exception:
+                    app.logger.exception('Rebuilding the availability filters failed')
+                finally:
+                    self._rebuilding = False
+
+        threading.Thread(target=run, name='availability-rebuild', daemon=True).start()
+
+    def rebuild(self):
+        """Load the filters from the primary, sized for twice the current
+        users, then add what was committed while loading"""
+        with use_primary():
+            settled = datetime.utcnow() - timedelta(seconds=self.settle_seconds)
+            last_change_id = db.session.scalar(select(Change.id).where(Change.created_at < settled)
+                                               .order_by(Change.id.desc()).limit(1)) or 0
+            total = db.session.scalar(select(func.count(User.id)))
+            filters = {field: BloomFilter(max(1000, total * 2), self.error_rate) for field in self.FIELDS}
+            for username, email in db.session.execute(select(User.username, User.email)
+                                                      .execution_options(yield_per=5000)):
+                filters['username'].add(normalize(username))
+                filters['email'].add(normalize(email))
+        with self._lock:
+            self.filters = filters
+            self._last_change_id = last_change_id
+            self._built_at = time.time()
+        self.sync()
+
+    def sync(self):
+        """Add the users created or renamed by any process since the last sync"""
+        if not self._lock.acquire(blocking=False):
+            return  # another thread is at it
+        try:
+            self._synced_at = time.time()
+            settled = datetime.utcnow() - timedelta(seconds=self.settle_seconds)
+            with use_primary():
+                rows = db.session.execute(
+                    select(Change.id, Change.created_at, User.username, User.email)
+                    .join(User, User.id == Change.entity_id)
+                    .where(Change.entity == 'user', Change.id > self._last_change_id).order_by(Change.id)).all()
+            advance = True
+            for row in rows:
+                self.filters['username'].add(normalize(row.username))
+                self.filters['email'].add(normalize(row.email))
+                # Entries with lower ids may still be uncommitted, recent ones are read again
+                advance = advance and row.created_at < settled
+                if advance:
+                    self._last_change_id = row.id
+        finally:
+            self._lock.release()
+
+    def is_available(self, field, value):
+        """Whether no user has this username or email"""
+        self.ensure_built()
+        filters = self.filters
+        if filters is not None and not filters[field].might_contain(normalize(value)):
+            self.negatives += 1
+            return True
+        self.database_checks += 1
+        column = getattr(User, field)
+        return db.session.scalar(select(User.id).where(column == value.strip()).limit(1)) is None
+
+    def apply(self, values):
+        """Add (field, value) pairs written by a commit"""
+        with self._lock:
+            if self.filters is None:
+                return
+            for field, value in values:
+                self.filters[field].add(normalize(value))
+
+    def stats(self):
+        return {
+            'negatives': self.negatives,
+            'database_checks': self.database_checks,
+            'users': {field: bloom.count for field, bloom in (self.filters or {}).items()}
+        }
+
+
+availability = AvailabilityService()
+
+
+@event.listens_for(Session, 'after_flush')
+def _track_users(session, flush_context):
+    # Deleted and renamed users stay in the filters as false positives
+    # until the next rebuild, which only costs a database check
+    for obj in list(session.new) + list(session.dirty):
+        if not isinstance(obj, User):
+            continue
+        state = inspect(obj)
+        after_commit(session, 'availability', [
+            (field, getattr(obj, field)) for field in AvailabilityService.FIELDS
+            if obj in session.new or state.attrs[field].history.deleted])
+
+
+@on_commit('availability')
+def _apply_users(values):
+    availability.apply(values)
+
+
+def find_conflict(username, email):
+    """Which of username/email an existing user already has, in one query.
+    Returns 'username', 'email' or None."""
+    # The database compares with the column collation, so a username that
+    # differs only in case is a username conflict wherever the unique index
+    # says so, comparing in Python would report it as the email
+    username_taken = (User.username == username).label('username_taken')
+    taken = db.session.execute(select(username_taken).where(
+        (User.username == username) | (User.email == email))).all()
+    if any(row.username_taken for row in taken):
+        return 'username'
+    if taken:
+        return 'email'
+    return None
+
+
+def init_availability(app):
+    """Configure the availability filters from the app config"""
+    availability.error_rate = app.config.get('AVAILABILITY_ERROR_RATE', 0.01)
+    availability.refresh_seconds = app.config.get('AVAILABILITY_REFRESH_SECONDS', 3600)
+    availability.sync_seconds = app.config.get('AVAILABILITY_SYNC_SECONDS', 2)
+    return availability
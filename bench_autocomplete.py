@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the autocomplete prefix index
+Measures build time, memory footprint per million entries and query latency
+"""
+
+import random
+import string
+import sys
+import time
+import tracemalloc
+
+from autocomplete import PrefixIndex
+
+
+def random_title(rng):
+    words = [''.join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 9)))
+             for _ in range(rng.randint(2, 6))]
+    return ' '.join(words).capitalize()
+
+
+def main():
+    entries = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    rng = random.Random(42)
+    rows = [(i, random_title(rng), float(i)) for i in range(1, entries + 1)]
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    index = PrefixIndex(max_entries=entries)
+    index.load(rows)
+    build_time = time.perf_counter() - started
+    traced, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    per_million = traced * 1000000 / entries
+    print(f"Entries: {entries}")
+    print(f"Build time: {build_time:.2f}s")
+    print(f"Traced memory: {traced / 1024 / 1024:.1f} MiB "
+          f"({per_million / 1024 / 1024:.1f} MiB per million entries)")
+    print(f"Estimated footprint: {index.memory_footprint() / 1024 / 1024:.1f} MiB")
+
+    for prefix in ['a', 'ab', 'abc', 'abcd']:
+        started = time.perf_counter()
+        for _ in range(100):
+            index.search(prefix, limit=10)
+        elapsed = (time.perf_counter() - started) / 100
+        print(f"Search '{prefix}': {elapsed * 1000:.3f} ms")
+
+    started = time.perf_counter()
+    for i in range(1000):
+        index.add(entries + i + 1, random_title(rng), float(entries + i + 1))
+    elapsed = (time.perf_counter() - started) / 1000
+    print(f"Incremental insert: {elapsed * 1000:.3f} ms")
+
+
+if __name__ == '__main__':
+    main()
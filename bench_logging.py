@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for the cost of a log call on the calling thread
+Compares print and a direct file handler with the queue pipeline from log_setup
+"""
+
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from log_setup import JsonFormatter, LogPipeline
+
+
+def measure(label, func, calls):
+    func(0)
+    started = time.perf_counter()
+    for i in range(calls):
+        func(i)
+    elapsed = (time.perf_counter() - started) / calls
+    print(f"{label:<36} {elapsed * 1e6:8.2f} us/call")
+    return elapsed
+
+
+def file_handler(path):
+    handler = logging.FileHandler(path, encoding='utf-8')
+    handler.setFormatter(JsonFormatter())
+    return handler
+
+
+def make_logger(name, handler):
+    logger = logging.getLogger(name)
+    logger.handlers = [handler]
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    return logger
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    data = {'username': 'user42', 'message': 'Hello from the chat, how is everyone doing?'}
+    directory = tempfile.mkdtemp()
+
+    print(f"{calls} calls, chat-sized payload")
+    with open(os.path.join(directory, 'print.log'), 'w') as out:
+        baseline = measure('print (old websocket_service)', lambda i: print(f"💬 Chat message: {data}", file=out), calls)
+
+    direct = make_logger('bench.direct', file_handler(os.path.join(directory, 'direct.log')))
+    measure('JSON FileHandler on the caller', lambda i: direct.info('Chat message', extra={'data': data}), calls)
+
+    # The listener starts after the timed loops, so the numbers are the
+    # caller's share only; its own share is timed while it drains the queue
+    pipeline = LogPipeline([file_handler(os.path.join(directory, 'queued.log'))],
+                           sample_rates={'bench.sampled': 0.1, 'bench.dropped': 0.0}, queue_size=calls * 3)
+    queued = make_logger('bench.queued', pipeline.handler)
+    elapsed = measure('queue pipeline (caller)', lambda i: queued.info('Chat message', extra={'data': data}), calls)
+    print(f"{'':<36} {baseline / elapsed:8.2f}x vs print")
+
+    sampled = make_logger('bench.sampled', pipeline.handler)
+    measure('queue pipeline, sampled at 10%', lambda i: sampled.info('Chat message', extra={'data': data}), calls)
+    dropped = make_logger('bench.dropped', pipeline.handler)
+    measure('queue pipeline, sampled at 0%', lambda i: dropped.info('Chat message', extra={'data': data}), calls)
+    measure('level disabled (debug)', lambda i: queued.debug('Chat message', extra={'data': data}), calls)
+
+    records = pipeline.handler.queue.qsize()
+    started = time.perf_counter()
+    pipeline.start()
+    pipeline.stop()
+    elapsed = (time.perf_counter() - started) / max(1, records)
+    print(f"{'listener thread, per record':<36} {elapsed * 1e6:8.2f} us/record ({records} records)")
+    print(f"dropped by sampling: {pipeline.sampling.dropped}")
+
+
+if __name__ == '__main__':
+    main()
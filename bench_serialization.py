@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for JSON serialization of API payloads
+Compares the stdlib encoder with the fast backend on realistic posts and comments
+"""
+
+import json
+import random
+import string
+import sys
+import time
+from datetime import datetime, timedelta
+
+import json_backend
+
+
+def random_text(rng, words):
+    return ' '.join(''.join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 10)))
+                    for _ in range(words))
+
+
+def make_payload(posts_count, comments_per_post):
+    rng = random.Random(7)
+    now = datetime(2024, 1, 1)
+    posts = []
+    for post_id in range(1, posts_count + 1):
+        created_at = now - timedelta(minutes=post_id)
+        posts.append({
+            'id': post_id,
+            'title': random_text(rng, 6).capitalize(),
+            'content': random_text(rng, rng.randint(50, 400)),
+            'author': f'user{rng.randint(1, 500)}',
+            'created_at': created_at,
+            'updated_at': created_at + timedelta(minutes=5),
+            'comments': [{
+                'id': post_id * 1000 + i,
+                'content': random_text(rng, rng.randint(5, 60)),
+                'author': f'user{rng.randint(1, 500)}',
+                'created_at': created_at + timedelta(seconds=i)
+            } for i in range(comments_per_post)]
+        })
+    return posts
+
+
+def stdlib_with_isoformat(payload):
+    """What api_resources.py did before: isoformat by hand, then json.dumps"""
+    rows = [{
+        **post,
+        'created_at': post['created_at'].isoformat(),
+        'updated_at': post['updated_at'].isoformat(),
+        'comments': [{**comment, 'created_at': comment['created_at'].isoformat()}
+                     for comment in post['comments']]
+    } for post in payload]
+    return json.dumps(rows).encode('utf-8')
+
+
+def measure(label, func, payload, rounds):
+    func(payload)
+    started = time.perf_counter()
+    for _ in range(rounds):
+        size = len(func(payload))
+    elapsed = (time.perf_counter() - started) / rounds
+    print(f"{label:<28} {elapsed * 1000:8.2f} ms   {size / 1024:8.1f} KiB")
+    return elapsed
+
+
+def main():
+    posts_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    payload = make_payload(posts_count, comments_per_post=10)
+
+    print(f"Payload: {posts_count} posts x 10 comments, {rounds} rounds")
+    baseline = measure('stdlib + isoformat', stdlib_with_isoformat, payload, rounds)
+
+    for name in json_backend.BACKENDS:
+        json_backend.use_backend(name)
+        elapsed = measure(f'json_backend ({name})', json_backend.dumps_bytes, payload, rounds)
+        print(f"{'':<28} {baseline / elapsed:8.2f}x vs baseline")
+
+
+if __name__ == '__main__':
+    main()
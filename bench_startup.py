@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark
+Reports import time, create_app() time and first-request latency in a fresh interpreter
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+HEAVY_MODULES = ['aiohttp', 'flask_admin', 'flask_socketio']
+
+PROBE = '''
+import json, sys, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+app = main.create_app()
+created = time.perf_counter()
+loaded_after_create = [name for name in {heavy!r} if name in sys.modules]
+client = app.test_client()
+first_requests = {{}}
+for path in {paths!r}:
+    request_started = time.perf_counter()
+    status = client.get(path).status_code
+    first_requests[path] = [status, (time.perf_counter() - request_started) * 1000]
+print(json.dumps({{
+    'import_ms': (imported - started) * 1000,
+    'create_app_ms': (created - imported) * 1000,
+    'loaded_after_create': loaded_after_create,
+    'first_requests': first_requests,
+    'loaded_at_exit': [name for name in {heavy!r} if name in sys.modules]
+}}))
+'''
+
+
+def run_probe(paths):
+    code = PROBE.format(heavy=HEAVY_MODULES, paths=paths)
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    paths = ['/api/test/technologies', '/map']
+
+    results = [run_probe(paths) for _ in range(runs)]
+
+    def median(values):
+        values = sorted(values)
+        return values[len(values) // 2]
+
+    print(f"Runs: {runs} (median)")
+    print(f"Import main:      {median([r['import_ms'] for r in results]):8.1f} ms")
+    print(f"create_app():     {median([r['create_app_ms'] for r in results]):8.1f} ms")
+    for path in paths:
+        print(f"First GET {path:<24} {median([r['first_requests'][path][1] for r in results]):8.1f} ms "
+              f"(status {results[0]['first_requests'][path][0]})")
+    print(f"Heavy modules loaded after create_app(): {', '.join(results[0]['loaded_after_create']) or 'none'}")
+    print(f"Heavy modules loaded after requests:     {', '.join(results[0]['loaded_at_exit']) or 'none'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, event, func, insert, select
+from sqlalchemy.orm import Session
+
+from commit_hooks import on_cascade
+from models import db, User, Post, Comment, Change
+from pagination import encode_cursor, decode_cursor
+
+ENTITIES = {User: 'user', Post: 'post', Comment: 'comment'}
+CURSOR_COLUMNS = (Change.id, Change.created_at)
+
+
+class CursorExpired(Exception):
+    """The cursor is older than the retention of delete entries"""
+
+
+def log_changes(connection, entity, ids, op):
+    """Append entries for rows changed in bulk, outside the ORM"""
+    now = datetime.utcnow()
+    rows = [{'entity': entity, 'entity_id': entity_id, 'op': op, 'created_at': now} for entity_id in ids]
+    if rows:
+        connection.execute(insert(Change.__table__), rows)
+
+
+@on_cascade
+def _log_cascaded_deletes(session, cascade):
+    """Rows removed by ON DELETE CASCADE never reach the session, log them
+    while they still exist"""
+    connection = session.connection()
+    log_changes(connection, 'post', cascade.post_ids, 'delete')
+    log_changes(connection, 'comment', cascade.comment_ids, 'delete')
+
+
+@event.listens_for(Session, 'after_flush')
+def _log_changes(session, flush_context):
+    now = datetime.utcnow()
+    rows = []
+
+    def add(obj, op):
+        entity = ENTITIES.get(type(obj))
+        if entity:
+            rows.append({'entity': entity, 'entity_id': obj.id, 'op': op, 'created_at': now})
+
+    for obj in session.new:
+        add(obj, 'create')
+    for obj in session.dirty:
+        if session.is_modified(obj, include_collections=False):
+            add(obj, 'update')
+    for obj in session.deleted:
+        add(obj, 'delete')
+    if rows:
+        session.connection().execute(insert(Change.__table__), rows)
+
+
+def read_changes(since=None, limit=100, settle_seconds=5, tombstone_days=30):
+    """Entries after the ``since`` cursor, oldest first.
+
+    Ids are handed out when a transaction inserts, not when it commits, so
+    a gap right before a recent entry may be a transaction that is still
+    running: the page stops there until the gap is ``settle_seconds`` old.
+    Returns (entries, next cursor, whether more entries are ready).
+    Raises ValueError for malformed cursors and CursorExpired when deletes
+    the client has not seen may already be compacted away.
+    """
+    now = datetime.utcnow()
+    last_id = None
+    if since:
+        last_id, synced_at = decode_cursor(since, CURSOR_COLUMNS)
+        if synced_at < now - timedelta(days=tombstone_days):
+            raise CursorExpired()
+
+    query = select(Change).order_by(Change.id).limit(limit)
+    if last_id is not None:
+        query = query.where(Change.id > last_id)
+    rows = db.session.scalars(query).all()
+
+    settled = now - timedelta(seconds=settle_seconds)
+    entries = []
+    for row in rows:
+        if last_id is not None and row.id != last_id + 1 and row.created_at > settled:
+            break
+        entries.append(row)
+        last_id = row.id
+
+    has_more = len(entries) < len(rows) or len(rows) == limit
+    if not entries and has_more:
+        return entries, since, has_more
+    if last_id is None:
+        return entries, None, has_more
+    # A client that caught up has seen everything committed until now
+    synced_at = entries[-1].created_at if has_more else now
+    return entries, encode_cursor([last_id, synced_at]), has_more
+
+
+def compact_changes(compact_after=timedelta(hours=24), tombstone_days=30, chunk_size=1000):
+    """Keep only the latest entry of each entity among entries older than
+    ``compact_after``, and drop delete entries older than ``tombstone_days``.
+
+    Works through the log in id order, one short transaction per chunk.
+    Returns the number of removed entries.
+    """
+    cutoff = datetime.utcnow() - compact_after
+    tombstone_cutoff = datetime.utcnow() - timedelta(days=tombstone_days)
+    removed = 0
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(Change.id, Change.entity, Change.entity_id, Change.op, Change.created_at)
+            .where(Change.id > last_id).order_by(Change.id).limit(chunk_size)).all()
+        rows = [row for row in rows if row.created_at < cutoff]
+        if not rows:
+            return removed
+        last_id = rows[-1].id
+
+        latest = {}
+        for entity in {row.entity for row in rows}:
+            entity_ids = {row.entity_id for row in rows if row.entity == entity}
+            for entity_id, newest in db.session.execute(
+                    select(Change.entity_id, func.max(Change.id))
+                    .where(Change.entity == entity, Change.entity_id.in_(entity_ids))
+                    .group_by(Change.entity_id)):
+                latest[(entity, entity_id)] = newest
+        stale = [row.id for row in rows
+                 if row.id < latest[(row.entity, row.entity_id)]
+                 or (row.op == 'delete' and row.created_at < tombstone_cutoff)]
+        if stale:
+            db.session.execute(delete(Change).where(Change.id.in_(stale)))
+        db.session.commit()
+        removed += len(stale)
@@ -1,6 +1,9 @@
 import click
+from flask import current_app
 from flask.cli import with_appcontext
-from models import db, User, Post, Comment
+from sqlalchemy import update
+from models import db, User, Post, Comment, Follow, make_excerpt
+from analytics import rebuild_rollups
 
 
 @click.command()
@@ -50,13 +53,22 @@ def seed_db():
 
     db.session.commit()
 
+    # Підписки для стрічки: user1 читає admin і blogger
+    db.session.add_all([
+        Follow(follower_id=users[2].id, followed_id=users[0].id),
+        Follow(follower_id=users[2].id, followed_id=users[3].id)
+    ])
+    db.session.commit()
+
     # Створити пости
     posts = [
         Post(title='Ласкаво просимо!',
              content='Це наш новий блог з картами та міграціями.',
+             latitude=50.4501, longitude=30.5234,  # Київ
              user_id=users[0].id),
         Post(title='Flask розробка',
              content='Все про Flask та його можливості.',
+             latitude=49.2331, longitude=28.4682,  # Вінниця
              user_id=users[3].id)
     ]
 
@@ -65,4 +77,117 @@ def seed_db():
 
     db.session.commit()
 
-    click.echo('Тестові дані додано успішно!')
\ No newline at end of file
+    # Дані вище частково видалялися масово, повз обробники аналітики
+    rebuild_rollups()
+
+    click.echo('Тестові дані додано успішно!')
+
+
+@click.command()
+@click.option('--chunk-size', default=1000, show_default=True, help='Кількість постів в одній транзакції.')
+@with_appcontext
+def backfill_excerpts(chunk_size):
+    """Заповнити excerpt для існуючих постів порціями."""
+    last_id = 0
+    updated = 0
+    while True:
+        rows = (db.session.query(Post.id, Post.content)
+                .filter(Post.id > last_id, Post.excerpt.is_(None))
+                .order_by(Post.id)
+                .limit(chunk_size)
+                .all())
+        if not rows:
+            break
+
+        db.session.execute(update(Post), [
+            {'id': post_id, 'excerpt': make_excerpt(content)} for post_id, content in rows
+        ])
+        db.session.commit()
+
+        last_id = rows[-1].id
+        updated += len(rows)
+        click.echo(f'Оновлено {updated} постів (останній id: {last_id})')
+
+    click.echo(f'Готово! Excerpt заповнено для {updated} постів.')
+
+
+@click.command()
+@click.option('--bind', help='Адреса та порт, наприклад 0.0.0.0:5000.')
+@click.option('--workers', type=int, help='Кількість процесів (за замовчуванням 1 із Socket.IO, інакше 2 * CPU + 1).')
+@click.option('--threads', type=int, help='Кількість потоків у кожному процесі.')
+@click.option('--max-requests', type=int, help='Перезапускати процес після N запитів.')
+@click.option('--max-requests-jitter', type=int, help='Випадковий розкид для --max-requests.')
+@click.option('--timeout', type=int, help='Таймаут запиту в секундах.')
+@click.option('--graceful-timeout', type=int, help='Час на завершення запитів при зупинці.')
+@with_appcontext
+def serve(bind, workers, threads, max_requests, max_requests_jitter, timeout, graceful_timeout):
+    """Запустити продакшн-сервер (gunicorn, pre-fork)."""
+    from serve import run_server
+    run_server(current_app._get_current_object(), bind=bind, workers=workers, threads=threads,
+               max_requests=max_requests, max_requests_jitter=max_requests_jitter,
+               timeout=timeout, graceful_timeout=graceful_timeout)
+
+
+@click.command('rebuild-analytics')
+@with_appcontext
+def rebuild_analytics():
+    """Перерахувати таблиці аналітики з постів і коментарів."""
+    counts = rebuild_rollups()
+    for table, rows in counts.items():
+        click.echo(f'{table}: {rows} рядків')
+    click.echo('Готово! Далі аналітика оновлюється при кожному записі.')
+
+
+@click.command('purge-user')
+@click.argument('user_id', type=int)
+@click.option('--chunk-size', default=1000, show_default=True, help='Кількість рядків в одній транзакції.')
+@click.option('--pause', default=0.0, show_default=True, help='Пауза між транзакціями в секундах.')
+@with_appcontext
+def purge_user_command(user_id, chunk_size, pause):
+    """Видалити користувача з усіма постами та коментарями короткими транзакціями."""
+    from purge import purge_user
+    if db.session.get(User, user_id) is None:
+        click.echo(f'Користувача {user_id} не знайдено.')
+        return
+    progress = purge_user(user_id, chunk_size, pause)
+    click.echo(f"Готово! Видалено {progress['posts']} постів і {progress['comments']} коментарів.")
+
+
+@click.command('compact-changes')
+@click.option('--chunk-size', default=1000, show_default=True, help='Кількість записів в одній транзакції.')
+@with_appcontext
+def compact_changes_command(chunk_size):
+    """Стиснути журнал змін: лишити останній запис кожного об'єкта."""
+    from datetime import timedelta
+    from changefeed import compact_changes
+    config = current_app.config
+    removed = compact_changes(timedelta(hours=config.get('CHANGES_COMPACT_AFTER_HOURS', 24)),
+                              config.get('CHANGES_TOMBSTONE_DAYS', 30), chunk_size)
+    click.echo(f'Готово! Видалено {removed} записів журналу змін.')
+
+
+@click.command('profile-token')
+@with_appcontext
+def profile_token():
+    """Видати заголовок для профілювання запиту (дійсний 5 хвилин)."""
+    from request_profiler import PROFILE_HEADER, make_profile_token
+    secret = current_app.config.get('PROFILE_SECRET') or current_app.config['SECRET_KEY']
+    click.echo(f'{PROFILE_HEADER}: {make_profile_token(secret)}')
+
+
+@click.command('cache-server')
+@click.option('--host', default='127.0.0.1', show_default=True, help='Адреса для підключення.')
+@click.option('--port', default=6390, show_default=True, help='Порт.')
+def cache_server(host, port):
+    """Запустити локальну заміну Redis для спільного кешу (для тестів і розробки)."""
+    from shared_cache import LocalCacheServer
+    server = LocalCacheServer(host, port)
+    click.echo(f'Кеш-сервер працює: CACHE_URL={server.url}')
+    server.serve_forever()
+
+
+def register_commands(app):
+    """Register CLI commands"""
+    for command in (init_db, reset_db, seed_db, backfill_excerpts, serve, rebuild_analytics,
+                    purge_user_command, compact_changes_command, profile_token, cache_server):
+        app.cli.add_command(command)
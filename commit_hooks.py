@@ -0,0 +1,96 @@
+import collections
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+from models import User, Post, Comment
+
+PENDING_KEY = 'on_commit_pending'
+
+_commit_handlers = {}
+_cascade_handlers = []
+
+
+class Cascade:
+    """Rows a flush removes by ON DELETE CASCADE, read before it runs.
+
+    ``posts`` are (id, user_id, created_at, latitude, longitude) rows of
+    the deleted users' posts, ``comments`` are (id, post_id, user_id,
+    created_at) rows of the comments on deleted posts or by deleted
+    users. Rows deleted through the session itself are not included.
+    """
+
+    def __init__(self, user_ids, posts, comments):
+        self.user_ids = user_ids
+        self.posts = posts
+        self.comments = comments
+
+    @property
+    def post_ids(self):
+        return [row.id for row in self.posts]
+
+    @property
+    def comment_ids(self):
+        return [row.id for row in self.comments]
+
+    def affected_post_ids(self):
+        """Posts that are gone or lost comments"""
+        return set(self.post_ids) | {row.post_id for row in self.comments}
+
+
+def on_commit(name):
+    """Register ``handler(items)`` for the items queued under ``name``"""
+    def decorator(handler):
+        _commit_handlers[name] = handler
+        return handler
+    return decorator
+
+
+def on_cascade(handler):
+    """Register ``handler(session, cascade)``, called in before_flush when
+    the flush deletes users or posts"""
+    _cascade_handlers.append(handler)
+    return handler
+
+
+def after_commit(session, name, items):
+    """Queue items for the ``name`` handler, dropped if the transaction rolls back"""
+    items = list(items)
+    if items:
+        session.info.setdefault(PENDING_KEY, collections.defaultdict(list))[name].extend(items)
+
+
+@event.listens_for(Session, 'before_flush')
+def _read_cascade(session, flush_context, instances):
+    user_ids = [obj.id for obj in session.deleted if isinstance(obj, User)]
+    post_ids = [obj.id for obj in session.deleted if isinstance(obj, Post)]
+    if not _cascade_handlers or (not user_ids and not post_ids):
+        return
+    comment_ids = [obj.id for obj in session.deleted if isinstance(obj, Comment)]
+    connection = session.connection()
+
+    posts = []
+    if user_ids:
+        posts = connection.execute(select(Post.id, Post.user_id, Post.created_at, Post.latitude, Post.longitude)
+                                   .where(Post.user_id.in_(user_ids), Post.id.not_in(post_ids))).all()
+    condition = Comment.post_id.in_(post_ids + [row.id for row in posts])
+    if user_ids:
+        condition = condition | Comment.user_id.in_(user_ids)
+    comments = connection.execute(select(Comment.id, Comment.post_id, Comment.user_id, Comment.created_at)
+                                  .where(condition, Comment.id.not_in(comment_ids))).all()
+
+    cascade = Cascade(user_ids, posts, comments)
+    for handler in _cascade_handlers:
+        handler(session, cascade)
+
+
+@event.listens_for(Session, 'after_commit')
+def _run_handlers(session):
+    pending = session.info.pop(PENDING_KEY, None)
+    for name, items in (pending or {}).items():
+        _commit_handlers[name](items)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard(session, previous_transaction):
+    session.info.pop(PENDING_KEY, None)
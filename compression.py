@@ -0,0 +1,175 @@
+import collections
+import gzip
+import hashlib
+import threading
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+COMPRESSIBLE_TYPES = (
+    'text/html', 'text/css', 'text/plain', 'text/javascript', 'application/javascript',
+    'application/json', 'application/geo+json', 'application/x-ndjson', 'image/svg+xml'
+)
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def choose_encoding(accept_encoding):
+    """Best encoding the client accepts, brotli before gzip, or None"""
+    accepted = {}
+    for part in (accept_encoding or '').lower().split(','):
+        name, _, params = part.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip()] = quality
+    for encoding in ENCODINGS:
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+def compress(body, encoding, gzip_level=6, brotli_quality=5):
+    if encoding == 'br':
+        return brotli.compress(body, quality=brotli_quality)
+    return gzip.compress(body, compresslevel=gzip_level, mtime=0)
+
+
+class CompressedBodyCache:
+    """LRU of compressed bodies keyed by the digest of the uncompressed body,
+    so pages that come out the same again are not compressed again"""
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_compress(self, body, encoding, compressor):
+        key = (hashlib.blake2b(body, digest_size=16).digest(), encoding)
+        with self._lock:
+            compressed = self._entries.get(key)
+            if compressed is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return compressed
+            self.misses += 1
+        compressed = compressor(body, encoding)
+        if len(compressed) > self.max_bytes // 8:
+            return compressed
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = compressed
+                self.size += len(compressed)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+        return compressed
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses}
+
+
+class Compressor:
+    """Negotiates and applies the content encoding of a response body"""
+
+    def __init__(self, min_size=1024, gzip_level=6, brotli_quality=5, cache_bytes=32 * 1024 * 1024):
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.cache = CompressedBodyCache(cache_bytes) if cache_bytes else None
+
+    def compressible(self, mimetype, status):
+        return 200 <= status < 300 and status != 204 and (mimetype or '') in COMPRESSIBLE_TYPES
+
+    def _compress(self, body, encoding):
+        return compress(body, encoding, self.gzip_level, self.brotli_quality)
+
+    def encode(self, body, encoding, cacheable=True):
+        """Compressed body, taken from the cache when the same body was seen"""
+        if self.cache is not None and cacheable:
+            return self.cache.get_or_compress(body, encoding, self._compress)
+        return self._compress(body, encoding)
+
+
+def compressor_from_config(config):
+    return Compressor(min_size=config.get('COMPRESS_MIN_SIZE', 1024),
+                      gzip_level=config.get('COMPRESS_GZIP_LEVEL', 6),
+                      brotli_quality=config.get('COMPRESS_BROTLI_QUALITY', 5),
+                      cache_bytes=config.get('COMPRESS_CACHE_BYTES', 32 * 1024 * 1024))
+
+
+def init_compression(app):
+    """gzip/brotli for Flask responses above COMPRESS_MIN_SIZE"""
+    from flask import request
+
+    if not app.config.get('COMPRESS_ENABLED', True):
+        return None
+
+    compressor = compressor_from_config(app.config)
+    app.extensions['compression'] = compressor
+
+    @app.after_request
+    def compress_response(response):
+        if not compressor.compressible(response.mimetype, response.status_code):
+            return response
+        response.vary.add('Accept-Encoding')
+        if (response.direct_passthrough or response.is_streamed
+                or 'Content-Encoding' in response.headers):
+            return response
+        encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+        if encoding is None:
+            return response
+        body = response.get_data()
+        if len(body) < compressor.min_size:
+            return response
+
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag(f'{etag}-{encoding}', weak)
+            # A conditional view compared If-None-Match with its own ETag,
+            # clients send back the encoded one, so compare again
+            response.make_conditional(request)
+            if response.status_code == 304:
+                return response
+        response.set_data(compressor.encode(body, encoding))
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    return compressor
+
+
+def make_compression_middleware(config):
+    """aiohttp middleware with the same thresholds and cache as the Flask app"""
+    from aiohttp import hdrs, web
+
+    compressor = compressor_from_config(config)
+
+    @web.middleware
+    async def compression_middleware(request, handler):
+        response = await handler(request)
+        if not isinstance(response, web.Response) or response.body is None:
+            return response
+        if not compressor.compressible(response.content_type, response.status):
+            return response
+        response.headers.add(hdrs.VARY, 'Accept-Encoding')
+        if hdrs.CONTENT_ENCODING in response.headers:
+            return response
+        encoding = choose_encoding(request.headers.get(hdrs.ACCEPT_ENCODING))
+        body = response.body
+        if encoding is None or not isinstance(body, bytes) or len(body) < compressor.min_size:
+            return response
+        response.body = compressor.encode(body, encoding)
+        response.headers[hdrs.CONTENT_ENCODING] = encoding
+        return response
+
+    compression_middleware.compressor = compressor
+    return compression_middleware
@@ -1,7 +1,17 @@
 import os
+from datetime import timedelta
+
+
+def env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def env_bool(name, default):
+    return os.environ.get(name, str(default)).lower() in ('1', 'true', 'yes', 'on')
+
 
 class Config:
-    SECRET_KEY = os.environ.get('SECRET_KEY') or 'your-secret-key-here'
+    SECRET_KEY = os.environ.get('SECRET_KEY') or 'your-secret-key-here-change-in-production'
 
     # MySQL database configuration
     MYSQL_HOST = os.environ.get('MYSQL_HOST') or 'localhost'
@@ -9,5 +19,174 @@ class Config:
     MYSQL_PASSWORD = os.environ.get('MYSQL_PASSWORD') or '1234567890'
     MYSQL_DB = os.environ.get('MYSQL_DB') or 'flask_crud'
 
-    SQLALCHEMY_DATABASE_URI = f'mysql+pymysql://{MYSQL_USER}:{MYSQL_PASSWORD}@{MYSQL_HOST}/{MYSQL_DB}'
-    SQLALCHEMY_TRACK_MODIFICATIONS = False
\ No newline at end of file
+    SQLALCHEMY_DATABASE_URI = (os.environ.get('DATABASE_URL') or
+                               f'mysql+pymysql://{MYSQL_USER}:{MYSQL_PASSWORD}@{MYSQL_HOST}/{MYSQL_DB}')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # Connection pool, applied to the primary and to every replica
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': env_int('DB_POOL_SIZE', 10),
+        'max_overflow': env_int('DB_MAX_OVERFLOW', 20),
+        'pool_timeout': env_int('DB_POOL_TIMEOUT', 10),
+        'pool_recycle': env_int('DB_POOL_RECYCLE', 1800),
+        'pool_pre_ping': env_bool('DB_POOL_PRE_PING', True),
+    }
+    if SQLALCHEMY_DATABASE_URI.startswith('mysql'):
+        SQLALCHEMY_ENGINE_OPTIONS['connect_args'] = {
+            'connect_timeout': env_int('DB_CONNECT_TIMEOUT', 5),
+            'read_timeout': env_int('DB_READ_TIMEOUT', 30),
+            'write_timeout': env_int('DB_WRITE_TIMEOUT', 30),
+        }
+
+    # Read replicas (comma separated URLs), read-only views are routed to them
+    DATABASE_REPLICA_URLS = [url.strip() for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+                             if url.strip()]
+    SQLALCHEMY_BINDS = {f'replica_{number}': url for number, url in enumerate(DATABASE_REPLICA_URLS)}
+    # After a write, the same browser session reads from the primary for this long
+    DB_READ_YOUR_WRITES_SECONDS = env_int('DB_READ_YOUR_WRITES_SECONDS', 5)
+
+    # SQL profiler: statements slower than this are always logged, per-request
+    # N+1 detection and the HTML panel are on in debug mode or when enabled
+    SQL_SLOW_QUERY_MS = env_int('SQL_SLOW_QUERY_MS', 200)
+    SQL_N_PLUS_ONE_THRESHOLD = env_int('SQL_N_PLUS_ONE_THRESHOLD', 5)
+    SQL_PROFILER_ENABLED = env_bool('SQL_PROFILER_ENABLED', False)
+
+    # Request profiler: requests with a signed X-Profile-Token header, requests
+    # of admins who switched it on and a random sample are profiled
+    PROFILE_DIR = os.environ.get('PROFILE_DIR') or 'profiles'
+    PROFILE_MAX_FILES = env_int('PROFILE_MAX_FILES', 100)
+    PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0.0))
+    PROFILE_SECRET = os.environ.get('PROFILE_SECRET')
+
+    # JSON encoder of jsonify and the REST API: 'auto' (orjson when
+    # installed), 'orjson' or 'stdlib'
+    JSON_BACKEND = os.environ.get('JSON_BACKEND', 'auto')
+
+    # In-memory prefix indexes behind /api/autocomplete, the lowest scored
+    # entries are evicted above AUTOCOMPLETE_MAX_ENTRIES per index
+    AUTOCOMPLETE_MAX_ENTRIES = env_int('AUTOCOMPLETE_MAX_ENTRIES', 1000000)
+    AUTOCOMPLETE_REFRESH_SECONDS = env_int('AUTOCOMPLETE_REFRESH_SECONDS', 3600)
+
+    # Comments are loaded in pages (view_post and /api/posts/<id>/comments)
+    COMMENTS_PAGE_SIZE = env_int('COMMENTS_PAGE_SIZE', 20)
+    COMMENTS_MAX_PAGE_SIZE = env_int('COMMENTS_MAX_PAGE_SIZE', 100)
+
+    # Users owning more posts and comments than PURGE_SYNC_LIMIT are deleted in
+    # the background, PURGE_CHUNK_SIZE rows per transaction
+    PURGE_SYNC_LIMIT = env_int('PURGE_SYNC_LIMIT', 1000)
+    PURGE_CHUNK_SIZE = env_int('PURGE_CHUNK_SIZE', 1000)
+    PURGE_PAUSE_SECONDS = float(os.environ.get('PURGE_PAUSE_SECONDS', 0.0))
+
+    # Change feed (/api/changes): entries wait CHANGES_SETTLE_SECONDS behind an
+    # id gap for slower transactions to commit; `flask compact-changes` keeps
+    # the latest entry per entity after CHANGES_COMPACT_AFTER_HOURS and drops
+    # deletes after CHANGES_TOMBSTONE_DAYS, older cursors must sync again
+    CHANGES_PAGE_SIZE = env_int('CHANGES_PAGE_SIZE', 100)
+    CHANGES_MAX_PAGE_SIZE = env_int('CHANGES_MAX_PAGE_SIZE', 1000)
+    CHANGES_SETTLE_SECONDS = env_int('CHANGES_SETTLE_SECONDS', 5)
+    CHANGES_COMPACT_AFTER_HOURS = env_int('CHANGES_COMPACT_AFTER_HOURS', 24)
+    CHANGES_TOMBSTONE_DAYS = env_int('CHANGES_TOMBSTONE_DAYS', 30)
+
+    # Home timelines: TIMELINE_BACKEND is 'memory' or the import path of a
+    # TimelineStore class; authors with more followers than the fan-out limit
+    # or more posts a day than the prolific limit are read with a query instead.
+    # The memory store is per worker, other workers see a new post only after
+    # TIMELINE_MAX_AGE_SECONDS, run several workers with a shared store
+    TIMELINE_BACKEND = os.environ.get('TIMELINE_BACKEND') or 'memory'
+    TIMELINE_PAGE_SIZE = env_int('TIMELINE_PAGE_SIZE', 20)
+    TIMELINE_MAX_LENGTH = env_int('TIMELINE_MAX_LENGTH', 800)
+    TIMELINE_MAX_USERS = env_int('TIMELINE_MAX_USERS', 100000)
+    TIMELINE_MAX_AGE_SECONDS = env_int('TIMELINE_MAX_AGE_SECONDS', 300)
+    TIMELINE_FANOUT_LIMIT = env_int('TIMELINE_FANOUT_LIMIT', 1000)
+    TIMELINE_PROLIFIC_POSTS_PER_DAY = env_int('TIMELINE_PROLIFIC_POSTS_PER_DAY', 50)
+
+    # Rendered GeoJSON map tiles, dropped when a post in them changes and
+    # after TILE_CACHE_SECONDS (also their HTTP max-age)
+    TILE_CACHE_MAX_TILES = env_int('TILE_CACHE_MAX_TILES', 10000)
+    TILE_CACHE_SECONDS = env_int('TILE_CACHE_SECONDS', 60)
+
+    # Bloom filters answering /api/users/availability, rebuilt from the
+    # database every AVAILABILITY_REFRESH_SECONDS and updated with other
+    # workers' registrations from the change log every AVAILABILITY_SYNC_SECONDS
+    AVAILABILITY_ERROR_RATE = float(os.environ.get('AVAILABILITY_ERROR_RATE', 0.01))
+    AVAILABILITY_REFRESH_SECONDS = env_int('AVAILABILITY_REFRESH_SECONDS', 3600)
+    AVAILABILITY_SYNC_SECONDS = env_int('AVAILABILITY_SYNC_SECONDS', 2)
+
+    # Jinja bytecode cache (defaults to instance/jinja_cache) and the
+    # {% cache %} fragment cache for post and comment cards
+    JINJA_BYTECODE_CACHE_DIR = os.environ.get('JINJA_BYTECODE_CACHE_DIR')
+    FRAGMENT_CACHE_MAX_BYTES = env_int('FRAGMENT_CACHE_MAX_BYTES', 16 * 1024 * 1024)
+    FRAGMENT_CACHE_SECONDS = env_int('FRAGMENT_CACHE_SECONDS', 3600)
+
+    # Flask-Admin is only imported and mounted when enabled
+    ADMIN_ENABLED = env_bool('ADMIN_ENABLED', True)
+
+    # Two-level cache: per-process LRU in front of a shared backend.
+    # CACHE_URL (redis://host:6379/0, or `flask cache-server` locally)
+    # shares it between workers and carries invalidations over pub/sub
+    CACHE_URL = os.environ.get('CACHE_URL')
+    CACHE_L1_MAX_ENTRIES = env_int('CACHE_L1_MAX_ENTRIES', 10000)
+    CACHE_L1_SECONDS = env_int('CACHE_L1_SECONDS', 30)
+    CACHE_DEFAULT_SECONDS = env_int('CACHE_DEFAULT_SECONDS', 300)
+    CACHE_LOCK_SECONDS = env_int('CACHE_LOCK_SECONDS', 10)
+
+    # Logging goes through a queue to a listener thread. LOG_SAMPLE_RATES
+    # keeps a fraction of the records of high-rate loggers as
+    # "logger=rate,..." (warnings and errors are always kept)
+    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+    LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+    LOG_FILE = os.environ.get('LOG_FILE')
+    LOG_ACTIVITY_FILE = os.environ.get('LOG_ACTIVITY_FILE', 'async_logs.txt')
+    LOG_SAMPLE_RATES = os.environ.get('LOG_SAMPLE_RATES',
+                                      'socketio.message=0.1,socketio.chat=0.1,socketio.test_data=0.1')
+    LOG_QUEUE_SIZE = env_int('LOG_QUEUE_SIZE', 10000)
+
+    # Socket.IO long-polling keeps the session in one process, so `flask serve`
+    # runs a single worker while it is mounted. To scale out, serve it from one
+    # process and run the other workers with SOCKETIO_ENABLED=0; the message
+    # queue (e.g. redis://localhost:6379/0) lets several Socket.IO processes broadcast
+    SOCKETIO_ENABLED = env_bool('SOCKETIO_ENABLED', True)
+    SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+
+    # Production server (`flask serve`)
+    SERVE_BIND = os.environ.get('SERVE_BIND') or '0.0.0.0:5000'
+    SERVE_WORKERS = env_int('SERVE_WORKERS', 0)  # 0 = 1 with Socket.IO, else 2 * CPU cores + 1
+    SERVE_THREADS = env_int('SERVE_THREADS', 32)
+    SERVE_MAX_REQUESTS = env_int('SERVE_MAX_REQUESTS', 10000)
+    SERVE_MAX_REQUESTS_JITTER = env_int('SERVE_MAX_REQUESTS_JITTER', 1000)
+    SERVE_TIMEOUT = env_int('SERVE_TIMEOUT', 60)
+    SERVE_GRACEFUL_TIMEOUT = env_int('SERVE_GRACEFUL_TIMEOUT', 30)
+    # With several workers each one writes its metrics to METRICS_DIR (a
+    # temporary directory when unset) and /metrics adds them all up
+    METRICS_DIR = os.environ.get('METRICS_DIR')
+    METRICS_DUMP_SECONDS = env_int('METRICS_DUMP_SECONDS', 5)
+
+    # Admission control: in-flight requests per process, reads get priority
+    # and the other route classes back off when reads exceed the latency target.
+    # The capacity is capped at SERVE_THREADS, a process never runs more
+    ADMISSION_ENABLED = env_bool('ADMISSION_ENABLED', True)
+    ADMISSION_CAPACITY = env_int('ADMISSION_CAPACITY', 64)
+    ADMISSION_LATENCY_TARGET_MS = env_int('ADMISSION_LATENCY_TARGET_MS', 500)
+    ADMISSION_SHARES = {'read': 1.0, 'login': 0.5, 'write': 0.6, 'batch': 0.2}
+    ADMISSION_MAX_WAIT_MS = {'read': 1000, 'login': 500, 'write': 500, 'batch': 0}
+    # Token bucket per JWT identity on the REST API
+    API_RATE_LIMIT_PER_SECOND = env_int('API_RATE_LIMIT_PER_SECOND', 10)
+    API_RATE_LIMIT_BURST = env_int('API_RATE_LIMIT_BURST', 20)
+
+    # Response compression (brotli when installed, else gzip) for bodies of
+    # at least COMPRESS_MIN_SIZE bytes; compressed bodies are cached by content
+    COMPRESS_ENABLED = env_bool('COMPRESS_ENABLED', True)
+    COMPRESS_MIN_SIZE = env_int('COMPRESS_MIN_SIZE', 1024)
+    COMPRESS_GZIP_LEVEL = env_int('COMPRESS_GZIP_LEVEL', 6)
+    COMPRESS_BROTLI_QUALITY = env_int('COMPRESS_BROTLI_QUALITY', 5)
+    COMPRESS_CACHE_BYTES = env_int('COMPRESS_CACHE_BYTES', 32 * 1024 * 1024)
+
+    # Async service: readiness fails when the event loop lags this much (p99),
+    # the external API circuit opens after this many failures in a row
+    ASYNC_LOOP_LAG_INTERVAL_MS = env_int('ASYNC_LOOP_LAG_INTERVAL_MS', 100)
+    ASYNC_READY_MAX_LOOP_LAG_MS = env_int('ASYNC_READY_MAX_LOOP_LAG_MS', 500)
+    EXTERNAL_CIRCUIT_FAILURES = env_int('EXTERNAL_CIRCUIT_FAILURES', 5)
+    EXTERNAL_CIRCUIT_RESET_SECONDS = env_int('EXTERNAL_CIRCUIT_RESET_SECONDS', 30)
+
+    JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY') or 'jwt-secret-key-change-in-production'
+    JWT_ACCESS_TOKEN_EXPIRES = timedelta(hours=24)
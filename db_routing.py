@@ -0,0 +1,181 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import Response, current_app, g, has_app_context, has_request_context, session as web_session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+
+REPLICA_PREFIX = 'replica_'
+PRIMARY_UNTIL_KEY = 'db_primary_until'
+
+
+class PoolStats:
+    """Checkout wait statistics per connection pool"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, name, waited, timed_out=False):
+        with self._lock:
+            stats = self._stats.setdefault(name, {
+                'checkouts': 0,
+                'timeouts': 0,
+                'wait_total': 0.0,
+                'wait_max': 0.0
+            })
+            stats['checkouts'] += 1
+            stats['wait_total'] += waited
+            stats['wait_max'] = max(stats['wait_max'], waited)
+            if timed_out:
+                stats['timeouts'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {name: dict(stats) for name, stats in self._stats.items()}
+
+
+pool_stats = PoolStats()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a connection"""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            timed_out = True
+            raise
+        finally:
+            pool_stats.record(self.logging_name or 'default', time.perf_counter() - started, timed_out)
+
+
+class RoutingSession(Session):
+    """Session that sends reads to a replica inside ``use_replica`` views.
+
+    Anything that flushes, any DML statement and everything after the first
+    write in the session goes to the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._use_replica(clause):
+            replicas = [key for key in self._db.engines if key and key.startswith(REPLICA_PREFIX)]
+            if replicas:
+                return self._db.engines[random.choice(replicas)]
+        return super().get_bind(mapper=mapper, clause=clause, **kwargs)
+
+    def _use_replica(self, clause):
+        if self._flushing or self.info.get('has_writes'):
+            return False
+        if isinstance(clause, UpdateBase):
+            return False
+        return has_app_context() and g.get('db_route') == 'replica'
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _mark_writes(session, flush_context):
+    session.info['has_writes'] = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _pin_to_primary(session):
+    if not session.info.pop('has_writes', False):
+        return
+    # Only browser sessions have somewhere to keep the pin, JWT clients
+    # are not pinned
+    if has_request_context() and 'user_id' in web_session:
+        web_session[PRIMARY_UNTIL_KEY] = time.time() + current_app.config.get('DB_READ_YOUR_WRITES_SECONDS', 5)
+
+
+def use_replica(f):
+    """Route the reads of a view to a read replica.
+
+    Browser sessions that wrote recently keep reading from the primary so
+    they always see their own changes. API clients authenticated with a
+    JWT are not pinned: right after a write they may read a replica that
+    has not caught up yet. Streamed responses keep the route until they
+    are closed, their queries run after the view returns.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if web_session.get(PRIMARY_UNTIL_KEY, 0) < time.time():
+            g.db_route = 'replica'
+        streamed = False
+        try:
+            response = f(*args, **kwargs)
+            streamed = isinstance(response, Response) and response.is_streamed
+            if streamed:
+                response.call_on_close(_release_route)
+            return response
+        finally:
+            if not streamed:
+                g.pop('db_route', None)
+    return decorated_function
+
+
+def _release_route():
+    if has_app_context():
+        g.pop('db_route', None)
+
+
+@contextmanager
+def use_primary():
+    """Read from the primary inside a ``use_replica`` view, e.g. to fill a
+    cache that outlives the replica's lag"""
+    route = g.pop('db_route', None)
+    try:
+        yield
+    finally:
+        if route is not None:
+            g.db_route = route
+
+
+def init_db_routing(app):
+    """Set up pool instrumentation, must run before db.init_app"""
+    engine_options = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options
+    in_memory = app.config['SQLALCHEMY_DATABASE_URI'] in ('sqlite://', 'sqlite:///:memory:')
+    if 'poolclass' not in engine_options and not in_memory:
+        engine_options['poolclass'] = TimedQueuePool
+        engine_options.setdefault('pool_logging_name', 'primary')
+
+    # Replicas share the pool settings of the primary and get their own pool
+    # name, so the wait statistics can tell them apart
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    app.config['SQLALCHEMY_BINDS'] = binds
+    for key, options in list(binds.items()):
+        if key.startswith(REPLICA_PREFIX):
+            options = {'url': options} if isinstance(options, str) else dict(options)
+            binds[key] = {**engine_options, 'pool_logging_name': key, **options}
+    return [key for key in binds if key.startswith(REPLICA_PREFIX)]
+
+
+def get_pool_status(db):
+    """Pool size, checked out connections and checkout wait statistics"""
+    waits = pool_stats.snapshot()
+    status = {}
+    for key, engine in db.engines.items():
+        pool = engine.pool
+        name = key or 'primary'
+        stats = waits.get(pool.logging_name or 'default', {})
+        status[name] = {
+            'status': pool.status(),
+            'size': pool.size() if hasattr(pool, 'size') else None,
+            'checked_out': pool.checkedout() if hasattr(pool, 'checkedout') else None,
+            'overflow': pool.overflow() if hasattr(pool, 'overflow') else None,
+            'checkouts': stats.get('checkouts', 0),
+            'timeouts': stats.get('timeouts', 0),
+            'wait_total_ms': round(stats.get('wait_total', 0.0) * 1000, 3),
+            'wait_avg_ms': round(stats['wait_total'] / stats['checkouts'] * 1000, 3) if stats.get('checkouts') else 0.0,
+            'wait_max_ms': round(stats.get('wait_max', 0.0) * 1000, 3)
+        }
+    return status
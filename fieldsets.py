@@ -0,0 +1,126 @@
+from sqlalchemy import func, select
+from sqlalchemy.orm import load_only
+
+from models import db, User
+
+
+class Field:
+    """One selectable field of an API resource.
+
+    ``columns`` are the model columns the field needs, they go into
+    ``load_only`` so every other column stays unloaded. Fields computed from
+    other tables use ``bulk``, a callable that receives the loaded objects and
+    returns ``{object id: value}`` with a single query. A ``bulk`` with a
+    ``column(model)`` attribute can also be selected in the main statement,
+    which streaming needs.
+    """
+
+    def __init__(self, columns=(), getter=None, bulk=None):
+        self.columns = columns
+        self.getter = getter
+        self.bulk = bulk
+
+
+class FieldSet:
+    """Parses ``?fields=`` and turns the selection into loader options"""
+
+    def __init__(self, model, fields, default=None):
+        self.model = model
+        self.fields = fields
+        self.default = default or list(fields)
+
+    def parse(self, raw):
+        """Return the requested field names, raises ValueError on unknown fields"""
+        if not raw:
+            return list(self.default)
+        names = []
+        for name in raw.split(','):
+            name = name.strip()
+            if name and name not in names:
+                names.append(name)
+        unknown = [name for name in names if name not in self.fields]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)}. "
+                             f"Available: {', '.join(self.fields)}")
+        return names or list(self.default)
+
+    def load_options(self, names):
+        """``load_only`` covering just the columns the selected fields need"""
+        columns = [self.model.id]
+        for name in names:
+            for column in self.fields[name].columns:
+                if column not in columns:
+                    columns.append(column)
+        return load_only(*columns)
+
+    def query(self, names):
+        """Model query restricted to the selected columns"""
+        return self.model.query.options(self.load_options(names))
+
+    def serialize(self, objects, names):
+        """Serialize loaded objects, running each bulk lookup once"""
+        bulk_values = {name: self.fields[name].bulk(objects)
+                       for name in names if self.fields[name].bulk and objects}
+        return [self._row(obj, names, lambda name, obj=obj: bulk_values[name].get(obj.id))
+                for obj in objects]
+
+    def stream_statement(self, names):
+        """Statement selecting the objects with every computed field as a
+        correlated subquery, raises ValueError for fields that have none.
+
+        Streamed rows come from an open server-side cursor, bulk queries per
+        chunk would have to share its connection.
+        """
+        computed = [name for name in names if self.fields[name].bulk]
+        unsupported = [name for name in computed if not hasattr(self.fields[name].bulk, 'column')]
+        if unsupported:
+            raise ValueError(f"Fields not available when streaming: {', '.join(unsupported)}")
+        columns = [self.fields[name].bulk.column(self.model).label(name) for name in computed]
+        return select(self.model, *columns).options(self.load_options(names))
+
+    def serialize_rows(self, rows, names):
+        """Serialize rows of ``stream_statement()``"""
+        return [self._row(row[0], names, lambda name, row=row: row._mapping[name]) for row in rows]
+
+    def _row(self, obj, names, computed):
+        row = {}
+        for name in names:
+            field = self.fields[name]
+            if field.bulk:
+                row[name] = computed(name)
+            elif field.getter:
+                row[name] = field.getter(obj)
+            else:
+                row[name] = getattr(obj, name)
+        return row
+
+
+def usernames_by(attribute):
+    """Bulk lookup of the author username through a ``user_id`` attribute"""
+    def lookup(objects):
+        user_ids = {getattr(obj, attribute) for obj in objects}
+        usernames = dict(db.session.query(User.id, User.username).filter(User.id.in_(user_ids)))
+        return {obj.id: usernames.get(getattr(obj, attribute)) for obj in objects}
+
+    def column(model):
+        return select(User.username).where(User.id == getattr(model, attribute)).scalar_subquery()
+
+    lookup.column = column
+    return lookup
+
+
+def counts_by(model, foreign_key):
+    """Bulk count of child rows per parent id, missing parents count as 0"""
+    def lookup(objects):
+        ids = [obj.id for obj in objects]
+        counts = dict(db.session.query(foreign_key, func.count(model.id))
+                      .filter(foreign_key.in_(ids))
+                      .group_by(foreign_key))
+        return {obj_id: counts.get(obj_id, 0) for obj_id in ids}
+
+    def column(parent):
+        return (select(func.count(model.id)).where(foreign_key == parent.id)
+                .correlate(parent).scalar_subquery())
+
+    lookup.column = column
+    return lookup
@@ -1,8 +1,7 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, TextAreaField, SelectField, PasswordField, SubmitField
-from wtforms.validators import DataRequired, Email, Length, ValidationError
+from wtforms import StringField, TextAreaField, SelectField, PasswordField, SubmitField, FloatField
+from wtforms.validators import DataRequired, Email, Length, NumberRange, Optional
 from wtforms.widgets import TextArea
-from models import User
 
 
 class LoginForm(FlaskForm):
@@ -17,23 +16,26 @@ class RegisterForm(FlaskForm):
     password = PasswordField('Password', validators=[DataRequired(), Length(min=6)])
     submit = SubmitField('Register')
 
-    def validate_username(self, username):
-        user = User.query.filter_by(username=username.data).first()
-        if user:
-            raise ValidationError('This username is taken. Choose another one.')
-
-    def validate_email(self, email):
-        user = User.query.filter_by(email=email.data).first()
-        if user:
-            raise ValidationError('This email is taken. Choose another one.')
+    # Taken usernames and emails are reported by register() from the
+    # IntegrityError, so a successful registration is a single INSERT
 
 
 class PostForm(FlaskForm):
     title = StringField('Title', validators=[DataRequired(), Length(min=5, max=100)])
     content = TextAreaField('Content', validators=[DataRequired(), Length(min=10)],
                             widget=TextArea(), render_kw={"rows": 6})
+    latitude = FloatField('Latitude', validators=[Optional(), NumberRange(min=-90, max=90)])
+    longitude = FloatField('Longitude', validators=[Optional(), NumberRange(min=-180, max=180)])
     submit = SubmitField('Save')
 
+    def validate(self, extra_validators=None):
+        if not super().validate(extra_validators):
+            return False
+        if (self.latitude.data is None) != (self.longitude.data is None):
+            self.longitude.errors.append('Enter both latitude and longitude or neither.')
+            return False
+        return True
+
 
 class CommentForm(FlaskForm):
     content = TextAreaField('Comment', validators=[DataRequired(), Length(min=5)],
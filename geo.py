@@ -0,0 +1,137 @@
+import math
+
+from sqlalchemy import and_, func, or_, select
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+# ~1 m cells, enough to tell posts apart
+GEOHASH_PRECISION = 10
+
+
+def encode_geohash(latitude, longitude, precision=GEOHASH_PRECISION):
+    """Geohash of a point, nearby points share long prefixes"""
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        interval, coordinate = (lon_range, longitude) if even else (lat_range, latitude)
+        middle = (interval[0] + interval[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[value])
+            bits = value = 0
+    return ''.join(chars)
+
+
+def cell_size(precision):
+    """(height, width) in degrees of the geohash cells of a precision"""
+    lon_bits = math.ceil(5 * precision / 2)
+    lat_bits = 5 * precision // 2
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits
+
+
+def parse_bbox(raw):
+    """west,south,east,north -> tuple of floats, raises ValueError"""
+    try:
+        west, south, east, north = (float(value) for value in raw.split(','))
+    except (AttributeError, ValueError):
+        raise ValueError('bbox must be west,south,east,north in degrees')
+    if not (-90 <= south <= north <= 90 and -180 <= west <= 180 and -180 <= east <= 180):
+        raise ValueError('bbox is out of range or south is above north')
+    return west, south, east, north
+
+
+def _split(bbox):
+    """A bbox crossing the antimeridian (west > east) becomes two"""
+    west, south, east, north = bbox
+    if west <= east:
+        return [bbox]
+    return [(west, south, 180.0, north), (-180.0, south, east, north)]
+
+
+def _cells(bbox, precision):
+    west, south, east, north = bbox
+    height, width = cell_size(precision)
+    rows = range(int((south + 90) // height), int(min(north + 90, 180 - 1e-9) // height) + 1)
+    columns = range(int((west + 180) // width), int(min(east + 180, 360 - 1e-9) // width) + 1)
+    return rows, columns, height, width
+
+
+def _successor(prefix):
+    """Smallest geohash after every geohash starting with ``prefix``"""
+    while prefix:
+        position = BASE32.index(prefix[-1])
+        if position + 1 < len(BASE32):
+            return prefix[:-1] + BASE32[position + 1]
+        prefix = prefix[:-1]
+    return None
+
+
+def cover(bbox, max_cells=32):
+    """Geohash ranges [low, high) covering a bbox, high None means unbounded.
+
+    Uses the finest precision that needs at most ``max_cells`` cells and
+    merges cells that are next to each other in geohash order, so each
+    range is one index range scan.
+    """
+    prefixes = set()
+    for part in _split(bbox):
+        precision = 1
+        while precision < GEOHASH_PRECISION:
+            rows, columns, height, width = _cells(part, precision + 1)
+            if len(rows) * len(columns) > max_cells:
+                break
+            precision += 1
+        rows, columns, height, width = _cells(part, precision)
+        for row in rows:
+            for column in columns:
+                prefixes.add(encode_geohash(-90 + (row + 0.5) * height, -180 + (column + 0.5) * width, precision))
+
+    ranges = []
+    for prefix in sorted(prefixes):
+        high = _successor(prefix)
+        if ranges and ranges[-1][1] == prefix:
+            ranges[-1][1] = high
+        else:
+            ranges.append([prefix, high])
+    return [tuple(bounds) for bounds in ranges]
+
+
+def within(model, bbox, max_cells=32):
+    """Condition selecting the rows of ``model`` inside a bbox through its
+    geohash index, then exactly by latitude and longitude"""
+    geohash = model.geohash
+    ranges = or_(*[and_(geohash >= low, geohash < high) if high else geohash >= low
+                   for low, high in cover(bbox, max_cells)])
+    exact = []
+    for west, south, east, north in _split(bbox):
+        exact.append(and_(model.latitude.between(south, north), model.longitude.between(west, east)))
+    return and_(ranges, or_(*exact))
+
+
+def cluster_precision(zoom, clusters_per_tile=4):
+    """Geohash precision whose cells are about a quarter of a 256px map
+    tile wide at a web map zoom level"""
+    lon_bits = zoom + int(math.log2(clusters_per_tile))
+    for precision in range(1, GEOHASH_PRECISION + 1):
+        if math.ceil(5 * precision / 2) >= lon_bits:
+            return precision
+    return GEOHASH_PRECISION
+
+
+def clusters(session, model, bbox, zoom, max_cells=32):
+    """Markers grouped by geohash cell at a zoom level, computed in the
+    database: (cell, count, mean latitude, mean longitude, lowest id)"""
+    cell = func.substr(model.geohash, 1, cluster_precision(zoom))
+    return session.execute(
+        select(cell, func.count(model.id), func.avg(model.latitude), func.avg(model.longitude), func.min(model.id))
+        .where(within(model, bbox, max_cells))
+        .group_by(cell)).all()
@@ -1,9 +1,11 @@
-from main import app
+from main import create_app
 from models import db, User, Post, Comment
 from sqlalchemy import create_engine, text
 from urllib.parse import urlparse
 import time
 
+app = create_app()
+
 
 def check_database_exists(uri):
     parsed = urlparse(uri)
@@ -0,0 +1,120 @@
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+from flask import make_response
+from flask.json.provider import JSONProvider
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the stdlib encoder is the fallback
+    orjson = None
+
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS if orjson else 0
+
+
+def _default(obj):
+    """Handle the types the stdlib encoder does not know about"""
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if hasattr(obj, '__html__'):
+        return str(obj.__html__())
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def _orjson_default(obj):
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if hasattr(obj, '__html__'):
+        return str(obj.__html__())
+    raise TypeError
+
+
+def stdlib_dumps_bytes(obj):
+    return json.dumps(obj, default=_default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def orjson_dumps_bytes(obj):
+    return orjson.dumps(obj, default=_orjson_default, option=ORJSON_OPTIONS)
+
+
+BACKENDS = {
+    'stdlib': (stdlib_dumps_bytes, json.loads),
+}
+if orjson is not None:
+    BACKENDS['orjson'] = (orjson_dumps_bytes, orjson.loads)
+
+_dumps_bytes, _loads = BACKENDS.get('orjson', BACKENDS['stdlib'])
+backend_name = 'orjson' if orjson is not None else 'stdlib'
+
+
+def use_backend(name):
+    """Select the JSON backend: 'auto', 'orjson' or 'stdlib'"""
+    global _dumps_bytes, _loads, backend_name
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'stdlib'
+    if name not in BACKENDS:
+        raise ValueError(f'JSON backend {name!r} is not available')
+    _dumps_bytes, _loads = BACKENDS[name]
+    backend_name = name
+    return name
+
+
+def dumps_bytes(obj):
+    """Serialize to UTF-8 encoded JSON, datetimes become ISO 8601 strings"""
+    return _dumps_bytes(obj)
+
+
+def dumps(obj):
+    """Serialize to a JSON string"""
+    return _dumps_bytes(obj).decode('utf-8')
+
+
+def loads(data):
+    """Parse JSON from str or bytes"""
+    return _loads(data)
+
+
+class FastJSONProvider(JSONProvider):
+    """Flask JSON provider backed by the selected encoder"""
+
+    mimetype = 'application/json'
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            # Callers such as the session serializer pass stdlib options
+            kwargs.setdefault('default', _default)
+            return json.dumps(obj, **kwargs)
+        return dumps(obj)
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            # object_hook and friends are only understood by the stdlib decoder
+            return json.loads(s, **kwargs)
+        return loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps_bytes(obj), mimetype=self.mimetype)
+
+
+def output_json(data, code, headers=None):
+    """Flask-RESTful representation for application/json"""
+    response = make_response(dumps_bytes(data), code)
+    response.headers['Content-Type'] = 'application/json'
+    response.headers.extend(headers or {})
+    return response
+
+
+def init_json_backend(app, restful_api):
+    """Install the fast JSON backend for jsonify and Flask-RESTful"""
+    name = use_backend(app.config.get('JSON_BACKEND', 'auto'))
+    app.json = FastJSONProvider(app)
+    restful_api.representations['application/json'] = output_json
+    return name
@@ -0,0 +1,194 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+
+# Attributes every LogRecord has, anything else came in through ``extra``
+STANDARD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line with the ``extra`` fields of the call"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'thread': record.threadName,
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in STANDARD_ATTRIBUTES)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a fraction of the records of chosen loggers.
+
+    Rates apply to a logger and its children, the most specific name
+    wins. Warnings and errors are never dropped.
+    """
+
+    def __init__(self, rates=None):
+        super().__init__()
+        self.rates = dict(rates or {})
+        self.dropped = 0
+        self._cache = {}
+
+    def rate_for(self, name):
+        rate = self._cache.get(name)
+        if rate is None:
+            rate, candidate = 1.0, name
+            while candidate:
+                if candidate in self.rates:
+                    rate = self.rates[candidate]
+                    break
+                candidate = candidate.rpartition('.')[0]
+            self._cache[name] = rate
+        return rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rate_for(record.name)
+        if rate >= 1 or random.random() < rate:
+            return True
+        self.dropped += 1
+        return False
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records when the queue is full instead of
+    blocking the caller, so a slow log destination never stalls requests
+    or the event loop"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._exception_formatter = logging.Formatter()
+
+    def prepare(self, record):
+        # Resolve the message and traceback now, the arguments may change
+        # before the listener gets to them, but keep the fields separate
+        # instead of baking them into one preformatted line
+        record = copy.copy(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self._exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def parse_sample_rates(raw):
+    """'socketio.message=0.1,socketio.chat=0.05' -> {name: rate}"""
+    rates = {}
+    for item in (raw or '').split(','):
+        if item.strip():
+            name, _, rate = item.partition('=')
+            rates[name.strip()] = min(1.0, max(0.0, float(rate)))
+    return rates
+
+
+class LogPipeline:
+    """Root logger -> bounded queue -> listener thread -> real handlers.
+
+    Logging calls from request threads, Socket.IO handlers and the
+    aiohttp event loop only format the message and put the record on
+    the queue; writing to stderr or files happens in the listener
+    thread. The queue and listener are recreated in forked workers.
+    """
+
+    def __init__(self, handlers, sample_rates=None, queue_size=10000):
+        self.handlers = handlers
+        self.queue_size = queue_size
+        self.sampling = SamplingFilter(sample_rates)
+        self.handler = DroppingQueueHandler(queue.Queue(queue_size))
+        self.handler.addFilter(self.sampling)
+        self.listener = None
+
+    def start(self):
+        self.listener = logging.handlers.QueueListener(self.handler.queue, *self.handlers,
+                                                       respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        """Write out what is still queued and stop the listener thread"""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def restart_after_fork(self):
+        # The listener thread does not exist in the child and the queue's
+        # lock may have been held at fork time
+        self.handler.queue = queue.Queue(self.queue_size)
+        self.listener = None
+        self.start()
+
+    def stats(self):
+        return {
+            'queued': self.handler.queue.qsize(),
+            'dropped_full': self.handler.dropped,
+            'dropped_sampled': self.sampling.dropped,
+        }
+
+
+pipeline = None
+_lock = threading.Lock()
+
+
+def init_logging(config):
+    """Route the root logger through the queue pipeline once per process.
+
+    ``config`` is the Flask app config or the aiohttp settings dict.
+    """
+    global pipeline
+    with _lock:
+        if pipeline is not None:
+            return pipeline
+
+        formatter = (JsonFormatter() if config.get('LOG_FORMAT', 'json') == 'json'
+                     else logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+        handlers = [logging.StreamHandler(sys.stderr)]
+        if config.get('LOG_FILE'):
+            handlers.append(logging.FileHandler(config['LOG_FILE'], encoding='utf-8', delay=True))
+        for handler in handlers:
+            handler.setFormatter(formatter)
+        if config.get('LOG_ACTIVITY_FILE'):
+            # The async service's activity log keeps its own JSON lines file
+            activity = logging.FileHandler(config['LOG_ACTIVITY_FILE'], encoding='utf-8', delay=True)
+            activity.addFilter(logging.Filter('async.activity'))
+            activity.setFormatter(JsonFormatter())
+            handlers.append(activity)
+
+        level = logging.getLevelName(str(config.get('LOG_LEVEL', 'INFO')).upper())
+        pipeline = LogPipeline(handlers, parse_sample_rates(config.get('LOG_SAMPLE_RATES')),
+                               config.get('LOG_QUEUE_SIZE', 10000))
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(pipeline.handler)
+        root.setLevel(level)
+
+        pipeline.start()
+        atexit.register(pipeline.stop)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=pipeline.restart_after_fork)
+        return pipeline
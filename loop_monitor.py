@@ -0,0 +1,69 @@
+import asyncio
+import collections
+import time
+
+from metrics import event_loop_lag, event_loop_lag_histogram, registry
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up a task that sleeps ``interval``.
+
+    A handler that blocks the loop (sync I/O, heavy CPU) delays every wake-up,
+    so the lag shows blocking calls no matter which handler made them.
+    """
+
+    def __init__(self, interval=0.1, window=600):
+        self.interval = interval
+        self.samples = collections.deque(maxlen=window)
+        self._task = None
+        registry.add_collector(self.collect)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self.samples.append(lag)
+            event_loop_lag_histogram.observe(lag)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def percentiles(self):
+        """Lag quantiles and maximum over the sample window, in seconds"""
+        samples = sorted(self.samples)
+        if not samples:
+            return {}
+        result = {str(q): samples[min(len(samples) - 1, int(q * len(samples)))] for q in QUANTILES}
+        result['max'] = samples[-1]
+        return result
+
+    def collect(self):
+        for quantile, value in self.percentiles().items():
+            event_loop_lag.set(value, quantile=quantile)
+
+    def snapshot(self):
+        return {
+            'running': self.running,
+            'interval_ms': self.interval * 1000,
+            'samples': len(self.samples),
+            'lag_ms': {quantile: round(value * 1000, 3) for quantile, value in self.percentiles().items()},
+            'checked_at': time.time()
+        }
@@ -0,0 +1,421 @@
+import bisect
+import fcntl
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import Response, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+SQL_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+ARCHIVE_FILE = 'metrics-archive.json'
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Base class for labelled metrics, values are kept per label tuple"""
+
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def snapshot(self):
+        """[label values, value] pairs, the form kept in the worker files"""
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def combine(self, totals, snapshot):
+        """Add the values of another process to ``totals``"""
+        for key, value in snapshot:
+            key = tuple(key)
+            totals[key] = totals.get(key, 0) + value
+
+    def render(self, values):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for key, value in sorted(values.items()):
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        """For totals counted elsewhere and copied in by a collector"""
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Gauge(Metric):
+    """``aggregate`` is how the values of several worker processes add up,
+    'sum' or 'max'"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), aggregate='sum'):
+        super().__init__(name, documentation, labelnames)
+        self.aggregate = aggregate
+
+    def combine(self, totals, snapshot):
+        if self.aggregate == 'sum':
+            return super().combine(totals, snapshot)
+        for key, value in snapshot:
+            key = tuple(key)
+            totals[key] = max(totals[key], value) if key in totals else value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][position] += 1
+            state[1] += value
+            state[2] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), [list(state[0]), state[1], state[2]]] for key, state in self._values.items()]
+
+    def combine(self, totals, snapshot):
+        for key, (counts, total, count) in snapshot:
+            key = tuple(key)
+            state = totals.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0, 0])
+            state[0] = [mine + theirs for mine, theirs in zip(state[0], counts)]
+            state[1] += total
+            state[2] += count
+
+    def render(self, values):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames + ('le',), key + (_format_value(bound),))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {total!r}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class MetricsRegistry:
+    """Holds the metrics of this process and renders the Prometheus text format.
+
+    With ``directory`` set, every worker process writes its values to a
+    file there (``dump``, every few seconds and when it exits) and any
+    worker renders the values of all of them added up. Counters and
+    histograms of exited workers are folded into an archive file
+    (``archive``), so totals never go back when workers are replaced;
+    gauges only count the workers that are alive.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self.directory = None
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), aggregate='sum'):
+        return self._register(Gauge(name, documentation, labelnames, aggregate))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """Register a callable that refreshes gauges right before rendering"""
+        self._collectors.append(collector)
+
+    def _collect(self):
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception:
+                pass
+        return {metric.name: metric.snapshot() for metric in self._metrics}
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f'metrics-{pid}.json')
+
+    @contextmanager
+    def _locked(self, operation):
+        # Readers must not see an exited worker both in its file and in the archive
+        with open(os.path.join(self.directory, 'metrics.lock'), 'a') as lock:
+            fcntl.flock(lock, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def _write(path, data):
+        temporary = f'{path}.{os.getpid()}.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(data, f)
+        os.replace(temporary, path)
+
+    def dump(self):
+        """Write this process's values for the other workers to render"""
+        if self.directory:
+            self._write(self._path(os.getpid()), self._collect())
+
+    def start_dumping(self, interval=5):
+        """Dump every ``interval`` seconds from a background thread"""
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.dump()
+                except OSError:
+                    pass
+
+        threading.Thread(target=run, name='metrics-dump', daemon=True).start()
+
+    def archive(self, pid):
+        """Fold the counters and histograms of an exited worker into the archive"""
+        path = self._path(pid)
+        if not self.directory or not os.path.exists(path):
+            return
+        archive_path = os.path.join(self.directory, ARCHIVE_FILE)
+        with self._locked(fcntl.LOCK_EX):
+            archived, exited = self._read(archive_path), self._read(path)
+            data = {}
+            for metric in self._metrics:
+                if metric.kind != 'gauge':
+                    totals = {}
+                    metric.combine(totals, archived.get(metric.name, []))
+                    metric.combine(totals, exited.get(metric.name, []))
+                    data[metric.name] = [[list(key), value] for key, value in totals.items()]
+            self._write(archive_path, data)
+            os.remove(path)
+
+    def clear_directory(self):
+        """Remove the files of a previous server run"""
+        for name in os.listdir(self.directory):
+            if name.startswith('metrics-') and name.endswith(('.json', '.tmp')):
+                os.remove(os.path.join(self.directory, name))
+
+    def _processes(self):
+        """Snapshots of the other processes and whether their gauges count"""
+        own = os.path.basename(self._path(os.getpid()))
+        with self._locked(fcntl.LOCK_SH):
+            for name in os.listdir(self.directory):
+                if name == ARCHIVE_FILE:
+                    yield self._read(os.path.join(self.directory, name)), False
+                elif name.startswith('metrics-') and name.endswith('.json') and name != own:
+                    yield self._read(os.path.join(self.directory, name)), _alive(int(name[8:-5]))
+
+    def render(self):
+        snapshots = [(self._collect(), True)]
+        if self.directory:
+            snapshots.extend(self._processes())
+        lines = []
+        for metric in self._metrics:
+            totals = {}
+            for snapshot, live in snapshots:
+                if live or metric.kind != 'gauge':
+                    metric.combine(totals, snapshot.get(metric.name, []))
+            lines.extend(metric.render(totals))
+        return '\n'.join(lines) + '\n'
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+registry = MetricsRegistry()
+
+http_requests = registry.counter(
+    'http_requests_total', 'HTTP requests by route, method and status', ('app', 'route', 'method', 'status'))
+http_latency = registry.histogram(
+    'http_request_duration_seconds', 'HTTP request latency by route', ('app', 'route', 'method'))
+http_in_flight = registry.gauge(
+    'http_requests_in_flight', 'HTTP requests currently being served', ('app',))
+sql_queries = registry.histogram(
+    'http_request_sql_queries', 'SQL queries executed per HTTP request', ('route',),
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200))
+sql_request_time = registry.histogram(
+    'http_request_sql_duration_seconds', 'SQL time spent per HTTP request', ('route',))
+sql_duration = registry.histogram(
+    'sql_query_duration_seconds', 'Duration of single SQL statements', (), buckets=SQL_BUCKETS)
+socketio_events = registry.counter(
+    'socketio_events_total', 'Socket.IO events received by event name', ('event',))
+db_pool_checked_out = registry.gauge(
+    'db_pool_checked_out_connections', 'Connections currently checked out of the pool', ('pool',))
+db_pool_checkouts = registry.counter(
+    'db_pool_checkouts_total', 'Connections handed out by the pool', ('pool',))
+db_pool_wait = registry.counter(
+    'db_pool_checkout_wait_seconds_total', 'Total time spent waiting for a pooled connection', ('pool',))
+event_loop_lag = registry.gauge(
+    'event_loop_lag_seconds', 'Event loop lag quantiles over the recent sample window', ('quantile',),
+    aggregate='max')
+event_loop_lag_histogram = registry.histogram(
+    'event_loop_lag_observed_seconds', 'Event loop lag of each sample', (), buckets=SQL_BUCKETS)
+external_circuit_open = registry.gauge(
+    'external_circuit_open', 'Whether the circuit to the external API is open (1) or not (0)', ('circuit',),
+    aggregate='max')
+admission_in_flight = registry.gauge(
+    'admission_in_flight_requests', 'Admitted requests in flight by route class', ('app', 'route_class'))
+admission_rejected = registry.counter(
+    'admission_rejected_requests_total', 'Requests shed by admission control by route class', ('app', 'route_class'))
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    # A failed statement never reaches after_cursor_execute
+    started = context.connection.info.get('query_started') if context.connection is not None else None
+    if started:
+        started.pop()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_started'].pop()
+    elapsed = time.perf_counter() - started
+    sql_duration.observe(elapsed)
+    if has_app_context() and 'metrics_sql_count' in g:
+        g.metrics_sql_count += 1
+        g.metrics_sql_time += elapsed
+
+
+def count_socketio_event(event_name):
+    """Decorator counting calls of a Socket.IO handler"""
+    def decorator(handler):
+        @wraps(handler)
+        def counted(*args, **kwargs):
+            socketio_events.inc(event=event_name)
+            return handler(*args, **kwargs)
+        return counted
+    return decorator
+
+
+def _flask_route():
+    return request.url_rule.rule if request.url_rule else '<unmatched>'
+
+
+def init_metrics(app, db=None):
+    """Instrument the Flask app and expose /metrics"""
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_started = time.perf_counter()
+        g.metrics_sql_count = 0
+        g.metrics_sql_time = 0.0
+        http_in_flight.inc(app='flask')
+
+    @app.after_request
+    def record_request_metrics(response):
+        g.metrics_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def finish_request_metrics(exc):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return
+        http_in_flight.dec(app='flask')
+        route = _flask_route()
+        status = g.pop('metrics_status', 500)
+        http_latency.observe(time.perf_counter() - started, app='flask', route=route, method=request.method)
+        http_requests.inc(app='flask', route=route, method=request.method, status=status)
+        sql_queries.observe(g.pop('metrics_sql_count', 0), route=route)
+        sql_request_time.observe(g.pop('metrics_sql_time', 0.0), route=route)
+
+    if db is not None:
+        from db_routing import get_pool_status
+
+        def collect_pool_metrics():
+            with app.app_context():
+                for name, pool in get_pool_status(db).items():
+                    db_pool_checked_out.set(pool['checked_out'] or 0, pool=name)
+                    db_pool_checkouts.set(pool['checkouts'], pool=name)
+                    db_pool_wait.set(pool['wait_total_ms'] / 1000, pool=name)
+
+        registry.add_collector(collect_pool_metrics)
+
+    def metrics_view():
+        """Prometheus metrics of this process, or of all workers with a metrics directory"""
+        return Response(registry.render(), content_type=CONTENT_TYPE)
+
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
+    return registry
@@ -0,0 +1,57 @@
+"""on delete cascade for posts and comments
+
+Revision ID: 7a3e9c1f5b2d
+Revises: 4cb4b6e7852e
+Create Date: 2026-10-19 03:30:12.418020
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7a3e9c1f5b2d'
+down_revision = '4cb4b6e7852e'
+branch_labels = None
+depends_on = None
+
+# (table, column, referred table)
+FOREIGN_KEYS = [
+    ('posts', 'user_id', 'users'),
+    ('comments', 'post_id', 'posts'),
+    ('comments', 'user_id', 'users'),
+]
+
+# The initial schema created the foreign keys without names: MySQL named
+# them itself (posts_ibfk_1, ...) and SQLite has no names at all. The
+# convention gives the unnamed SQLite keys a name inside batch mode, on
+# MySQL the real names are looked up.
+NAMING_CONVENTION = {'fk': 'fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s'}
+
+
+def _constraint_name(table, column):
+    inspector = sa.inspect(op.get_bind())
+    for foreign_key in inspector.get_foreign_keys(table):
+        if foreign_key['constrained_columns'] == [column]:
+            return foreign_key['name'] or f'fk_{table}_{column}_{foreign_key["referred_table"]}'
+    return None
+
+
+def _replace_foreign_keys(ondelete):
+    for table in ('posts', 'comments'):
+        keys = [(column, referred) for name, column, referred in FOREIGN_KEYS if name == table]
+        old_names = {column: _constraint_name(table, column) for column, referred in keys}
+        with op.batch_alter_table(table, schema=None, naming_convention=NAMING_CONVENTION) as batch_op:
+            for column, referred in keys:
+                if old_names[column]:
+                    batch_op.drop_constraint(old_names[column], type_='foreignkey')
+                batch_op.create_foreign_key(f'fk_{table}_{column}_{referred}', referred,
+                                            [column], ['id'], ondelete=ondelete)
+
+
+def upgrade():
+    _replace_foreign_keys('CASCADE')
+
+
+def downgrade():
+    _replace_foreign_keys(None)
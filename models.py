@@ -1,8 +1,32 @@
+import sqlite3
+
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import validates
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
+from db_routing import RoutingSession
+from geo import encode_geohash
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+
+@event.listens_for(Engine, 'connect')
+def _enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    """SQLite only enforces foreign keys (and ON DELETE CASCADE) when asked to"""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
 
-db = SQLAlchemy()
+# Number of characters of the content shown on list pages
+EXCERPT_LENGTH = 150
+
+
+def make_excerpt(content):
+    """Build the stored excerpt for a post body"""
+    return (content or '')[:EXCERPT_LENGTH]
 
 
 class User(db.Model):
@@ -13,10 +37,16 @@ class User(db.Model):
     email = db.Column(db.String(120), unique=True, nullable=False, index=True)
     password_hash = db.Column(db.String(255), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    # Authors with too many followers or posts are not fanned out to
+    # timelines, their posts are pulled when a timeline is read
+    timeline_pull = db.Column(db.Boolean, default=False, nullable=False)
 
-    # Relationships
-    posts = db.relationship('Post', backref='author', lazy=True, cascade='all, delete-orphan')
-    comments = db.relationship('Comment', backref='author', lazy=True, cascade='all, delete-orphan')
+    # Relationships, children are deleted by ON DELETE CASCADE in the
+    # database instead of being loaded and deleted one by one
+    posts = db.relationship('Post', backref='author', lazy=True, cascade='all, delete-orphan',
+                            passive_deletes=True)
+    comments = db.relationship('Comment', backref='author', lazy=True, cascade='all, delete-orphan',
+                               passive_deletes=True)
 
     def set_password(self, password):
         """Set password hash"""
@@ -32,18 +62,48 @@ class User(db.Model):
 
 class Post(db.Model):
     __tablename__ = 'posts'
+    __table_args__ = (
+        # Posts of an author, newest first (timelines, purge)
+        db.Index('ix_posts_user_created', 'user_id', 'created_at', 'id'),
+        # Map viewport queries scan geohash ranges
+        db.Index('ix_posts_geohash', 'geohash'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
     content = db.Column(db.Text, nullable=False)
+    excerpt = db.Column(db.String(EXCERPT_LENGTH))
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+    # Optional location, the geohash is derived from it
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+    geohash = db.Column(db.String(12))
+
     # Foreign key
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
 
     # Relationships
-    comments = db.relationship('Comment', backref='post', lazy=True, cascade='all, delete-orphan')
+    comments = db.relationship('Comment', backref='post', lazy=True, cascade='all, delete-orphan',
+                               passive_deletes=True)
+
+    @validates('content')
+    def update_excerpt(self, key, content):
+        """Keep the excerpt in sync whenever the content is set"""
+        self.excerpt = make_excerpt(content)
+        return content
+
+    @validates('latitude', 'longitude')
+    def update_geohash(self, key, value):
+        """Keep the geohash in sync with the coordinates"""
+        latitude = value if key == 'latitude' else self.latitude
+        longitude = value if key == 'longitude' else self.longitude
+        if latitude is None or longitude is None:
+            self.geohash = None
+        else:
+            self.geohash = encode_geohash(latitude, longitude)
+        return value
 
     def __repr__(self):
         return f'<Post {self.title}>'
@@ -51,14 +111,86 @@ class Post(db.Model):
 
 class Comment(db.Model):
     __tablename__ = 'comments'
+    __table_args__ = (
+        # Comment pages of a post, newest first
+        db.Index('ix_comments_post_created', 'post_id', 'created_at', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
 
     # Foreign keys
-    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id', ondelete='CASCADE'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
 
     def __repr__(self):
-        return f'<Comment {self.id}>'
\ No newline at end of file
+        return f'<Comment {self.id}>'
+
+
+class Follow(db.Model):
+    """``follower_id`` follows the posts of ``followed_id``"""
+    __tablename__ = 'follows'
+    __table_args__ = (
+        # Followers of an author, for the fan-out of new posts
+        db.Index('ix_follows_followed', 'followed_id', 'follower_id'),
+    )
+
+    follower_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    followed_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+
+# Analytics rollups, kept up to date by the write hooks in analytics.py
+
+class ActivityRollup(db.Model):
+    """Posts and comments created per hour and per day"""
+    __tablename__ = 'activity_rollups'
+
+    granularity = db.Column(db.String(4), primary_key=True)  # 'hour' or 'day'
+    metric = db.Column(db.String(20), primary_key=True)
+    bucket_start = db.Column(db.DateTime, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class AuthorActivity(db.Model):
+    """Posts and comments of each author per day"""
+    __tablename__ = 'author_activity'
+
+    day = db.Column(db.Date, primary_key=True)
+    user_id = db.Column(db.Integer, primary_key=True)
+    posts = db.Column(db.Integer, nullable=False, default=0)
+    comments = db.Column(db.Integer, nullable=False, default=0)
+
+
+class PostCommentCount(db.Model):
+    """Current number of comments of each post"""
+    __tablename__ = 'post_comment_counts'
+
+    post_id = db.Column(db.Integer, primary_key=True)
+    comments = db.Column(db.Integer, nullable=False, default=0)
+
+
+class CommentCountBucket(db.Model):
+    """Number of posts per comments-per-post range"""
+    __tablename__ = 'comment_count_buckets'
+
+    bucket = db.Column(db.String(12), primary_key=True)
+    posts = db.Column(db.Integer, nullable=False, default=0)
+
+
+class Change(db.Model):
+    """Change log of users, posts and comments, kept by the hooks in changefeed.py"""
+    __tablename__ = 'changes'
+    __table_args__ = (
+        # Compaction looks up the latest entry of each entity
+        db.Index('ix_changes_entity', 'entity', 'entity_id', 'id'),
+        # Ids must never be reused, clients keep them in their cursors
+        {'sqlite_autoincrement': True},
+    )
+
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)
+    entity = db.Column(db.String(10), nullable=False)  # 'user', 'post' or 'comment'
+    entity_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(6), nullable=False)  # 'create', 'update' or 'delete'
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
@@ -0,0 +1,71 @@
+import base64
+import json
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+from sqlalchemy.types import DateTime, Integer
+
+
+def encode_cursor(values):
+    """Opaque cursor for the sort key values of the last item of a page"""
+    raw = json.dumps([value.isoformat() if isinstance(value, datetime) else value for value in values])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, columns):
+    """Sort key values of a cursor, raises ValueError for malformed cursors"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError) as e:
+        raise ValueError('Invalid cursor') from e
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise ValueError('Invalid cursor')
+    return [_decode_value(column, value) for column, value in zip(columns, values)]
+
+
+def _decode_value(column, value):
+    # The JSON may hold anything, a value of the wrong type would only
+    # fail later as a TypeError in the comparison
+    if isinstance(column.type, DateTime):
+        if isinstance(value, str):
+            try:
+                parsed = datetime.fromisoformat(value)
+            except ValueError:
+                parsed = None
+            # Timestamps are stored naive, an offset would not compare
+            if parsed is not None and parsed.tzinfo is None:
+                return parsed
+    elif isinstance(column.type, Integer):
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value
+    elif isinstance(value, str):
+        return value
+    raise ValueError('Invalid cursor')
+
+
+def after_cursor(columns, values):
+    """Rows that come after ``values`` in descending ``columns`` order.
+
+    Spelled out as (a < x) OR (a = x AND b < y) rather than a row value
+    comparison, so MySQL can use the index on the sort columns.
+    """
+    conditions = []
+    for position, column in enumerate(columns):
+        equal = [columns[i] == values[i] for i in range(position)]
+        conditions.append(and_(*equal, column < values[position]))
+    return or_(*conditions)
+
+
+def paginate_desc(query, columns, cursor=None, limit=20):
+    """Keyset page of ``query`` ordered by ``columns`` descending.
+
+    The last column must be unique (usually the primary key). Returns the
+    items and the cursor of the next page, None on the last page.
+    """
+    if cursor:
+        query = query.filter(after_cursor(columns, decode_cursor(cursor, columns)))
+    items = query.order_by(*[column.desc() for column in columns]).limit(limit + 1).all()
+    if len(items) <= limit:
+        return items, None
+    items = items[:limit]
+    return items, encode_cursor([getattr(items[-1], column.key) for column in columns])
@@ -0,0 +1,114 @@
+import threading
+import time
+
+from sqlalchemy import delete, func, select
+
+from analytics import forget_comments, forget_posts
+from autocomplete import remove_after_commit
+from changefeed import log_changes
+from models import db, User, Post, Comment
+from shared_cache import POST_NAMESPACE, invalidate_after_commit
+from tiles import invalidate_after_commit as invalidate_tiles_after_commit
+from timeline import remove_author_after_commit
+
+# user id -> progress of purges started in this process
+purges = {}
+_purges_lock = threading.Lock()
+
+
+def _delete_comments(condition, chunk_size, pause):
+    """Delete matching comments ``chunk_size`` at a time, one short transaction each"""
+    deleted = 0
+    while True:
+        rows = db.session.execute(select(Comment.id, Comment.post_id, Comment.user_id, Comment.created_at)
+                                  .where(condition).limit(chunk_size)).all()
+        if not rows:
+            return deleted
+        ids = [row[0] for row in rows]
+        db.session.execute(delete(Comment).where(Comment.id.in_(ids)))
+        forget_comments(db.session.connection(), [row[1:] for row in rows])
+        log_changes(db.session.connection(), 'comment', ids, 'delete')
+        invalidate_after_commit(db.session, POST_NAMESPACE, {row[1] for row in rows})
+        db.session.commit()
+        deleted += len(rows)
+        if pause:
+            time.sleep(pause)
+
+
+def purge_user(user_id, chunk_size=1000, pause=0.0, progress=None):
+    """Delete a user with everything they wrote in small transactions.
+
+    Comments go first, then the posts chunk by chunk together with the
+    comments on them, and the user row last, so ON DELETE CASCADE has
+    nothing left to do and no transaction holds locks for long.
+    """
+    progress = progress if progress is not None else {}
+    progress.update({'comments': 0, 'posts': 0, 'done': False})
+
+    progress['comments'] += _delete_comments(Comment.user_id == user_id, chunk_size, pause)
+    # Applied with the next commit, the posts disappear from the followers'
+    # timelines before they are deleted
+    remove_author_after_commit(db.session, user_id)
+    while True:
+        rows = db.session.execute(select(Post.id, Post.user_id, Post.created_at, Post.latitude, Post.longitude)
+                                  .where(Post.user_id == user_id).limit(chunk_size)).all()
+        if not rows:
+            break
+        post_ids = [row[0] for row in rows]
+        progress['comments'] += _delete_comments(Comment.post_id.in_(post_ids), chunk_size, pause)
+        forget_posts(db.session.connection(), [row[:3] for row in rows])
+        log_changes(db.session.connection(), 'post', post_ids, 'delete')
+        invalidate_after_commit(db.session, POST_NAMESPACE, post_ids)
+        remove_after_commit(db.session, 'posts', post_ids)
+        invalidate_tiles_after_commit(db.session, [row[3:] for row in rows])
+        db.session.execute(delete(Post).where(Post.id.in_(post_ids)))
+        db.session.commit()
+        progress['posts'] += len(post_ids)
+
+    user = db.session.get(User, user_id)
+    if user is not None:
+        db.session.delete(user)
+        db.session.commit()
+    progress['done'] = True
+    return progress
+
+
+def owned_rows(user_id):
+    """Number of posts and comments a user owns"""
+    posts = db.session.scalar(select(func.count(Post.id)).where(Post.user_id == user_id))
+    comments = db.session.scalar(select(func.count(Comment.id)).where(Comment.user_id == user_id))
+    return posts + comments
+
+
+def start_purge(app, user_id):
+    """Purge a user in a background thread, returns False if already running"""
+    with _purges_lock:
+        if purges.get(user_id, {}).get('done') is False:
+            return False
+        progress = purges[user_id] = {'done': False, 'started_at': time.time()}
+
+    def run():
+        with app.app_context():
+            try:
+                purge_user(user_id, app.config.get('PURGE_CHUNK_SIZE', 1000),
+                           app.config.get('PURGE_PAUSE_SECONDS', 0.0), progress)
+            except Exception as e:
+                db.session.rollback()
+                progress.update({'done': True, 'error': str(e)})
+                app.logger.exception('Purge of user %s failed', user_id)
+
+    threading.Thread(target=run, name=f'purge-user-{user_id}', daemon=True).start()
+    return True
+
+
+def delete_user(app, user):
+    """Delete a small user right away, purge a large one in the background.
+
+    Returns True when the user is already deleted.
+    """
+    if owned_rows(user.id) <= app.config.get('PURGE_SYNC_LIMIT', 1000):
+        db.session.delete(user)
+        db.session.commit()
+        return True
+    start_purge(app, user.id)
+    return False
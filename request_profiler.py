@@ -0,0 +1,196 @@
+import cProfile
+import hashlib
+import hmac
+import json
+import logging
+import os
+import pstats
+import random
+import re
+import threading
+import time
+
+logger = logging.getLogger('request_profiler')
+
+PROFILE_HEADER = 'X-Profile-Token'
+SESSION_KEY = 'profile_requests'
+TOKEN_MAX_AGE = 300
+
+# Only one request per process is profiled at a time, concurrent requests
+# that would be sampled are simply served without the profiler
+_profile_lock = threading.Lock()
+
+
+def make_profile_token(secret, timestamp=None):
+    """Header value that asks the server to profile a request"""
+    timestamp = str(int(timestamp if timestamp is not None else time.time()))
+    signature = hmac.new(secret.encode(), timestamp.encode(), hashlib.sha256).hexdigest()
+    return f'{timestamp}.{signature}'
+
+
+def verify_profile_token(token, secret, max_age=TOKEN_MAX_AGE):
+    if not token or '.' not in token:
+        return False
+    timestamp, signature = token.split('.', 1)
+    if not timestamp.isdigit() or abs(time.time() - int(timestamp)) > max_age:
+        return False
+    expected = hmac.new(secret.encode(), timestamp.encode(), hashlib.sha256).hexdigest()
+    return hmac.compare_digest(signature, expected)
+
+
+def should_profile(token, secret, sample_rate, forced=False):
+    """Profile on a valid signed header, an admin toggle or a random sample"""
+    if forced or verify_profile_token(token, secret):
+        return True
+    return sample_rate > 0 and random.random() < sample_rate
+
+
+class ProfileStore:
+    """Directory of .prof files (pstats format) that keeps the newest ``max_files``"""
+
+    def __init__(self, directory, max_files=100):
+        self.directory = directory
+        self.max_files = max_files
+
+    def save(self, profiler, app_name, method, path, duration):
+        os.makedirs(self.directory, exist_ok=True)
+        slug = re.sub(r'[^A-Za-z0-9]+', '-', path).strip('-')[:60] or 'root'
+        name = f'{time.time_ns()}_{app_name}_{method}_{slug}'
+        profiler.dump_stats(os.path.join(self.directory, name + '.prof'))
+        meta = {
+            'name': name,
+            'app': app_name,
+            'method': method,
+            'path': path,
+            'duration_ms': round(duration * 1000, 2),
+            'created_at': time.strftime('%Y-%m-%d %H:%M:%S')
+        }
+        with open(os.path.join(self.directory, name + '.json'), 'w') as f:
+            json.dump(meta, f)
+        self._rotate()
+        return name
+
+    def _names(self):
+        try:
+            files = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted((f[:-5] for f in files if f.endswith('.prof')), reverse=True)
+
+    def _rotate(self):
+        for name in self._names()[self.max_files:]:
+            for extension in ('.prof', '.json'):
+                try:
+                    os.remove(os.path.join(self.directory, name + extension))
+                except FileNotFoundError:
+                    pass
+
+    def list(self, limit=50):
+        """Metadata of the newest profiles"""
+        profiles = []
+        for name in self._names()[:limit]:
+            try:
+                with open(os.path.join(self.directory, name + '.json')) as f:
+                    profiles.append(json.load(f))
+            except (FileNotFoundError, ValueError):
+                profiles.append({'name': name})
+        return profiles
+
+    def path_of(self, name):
+        if not re.fullmatch(r'[\w.-]+', name):
+            return None
+        path = os.path.join(self.directory, name + '.prof')
+        return path if os.path.exists(path) else None
+
+    def top_functions(self, name, limit=25):
+        """Functions of a profile sorted by cumulative time"""
+        path = self.path_of(name)
+        if path is None:
+            return None
+        stats = pstats.Stats(path).stats
+        rows = []
+        for (filename, line, function), (primitive_calls, calls, total, cumulative, callers) in stats.items():
+            rows.append({
+                'function': function,
+                'location': f'{filename}:{line}',
+                'calls': calls,
+                'total_ms': round(total * 1000, 3),
+                'cumulative_ms': round(cumulative * 1000, 3)
+            })
+        rows.sort(key=lambda row: row['cumulative_ms'], reverse=True)
+        return rows[:limit]
+
+
+def store_from_config(config):
+    return ProfileStore(config.get('PROFILE_DIR', 'profiles'), config.get('PROFILE_MAX_FILES', 100))
+
+
+def _profile_secret(config):
+    return config.get('PROFILE_SECRET') or config['SECRET_KEY']
+
+
+def init_request_profiler(app):
+    """Profile selected Flask requests with cProfile and keep them in PROFILE_DIR"""
+    from flask import g, request, session
+
+    store = store_from_config(app.config)
+    app.extensions['request_profiler'] = store
+
+    @app.before_request
+    def start_request_profile():
+        if not should_profile(request.headers.get(PROFILE_HEADER), _profile_secret(app.config),
+                              app.config.get('PROFILE_SAMPLE_RATE', 0.0), session.get(SESSION_KEY)):
+            return
+        if not _profile_lock.acquire(blocking=False):
+            return
+        g.request_profile = (cProfile.Profile(), time.perf_counter())
+        g.request_profile[0].enable()
+
+    @app.teardown_request
+    def finish_request_profile(exc):
+        profile = g.pop('request_profile', None)
+        if profile is None:
+            return
+        profiler, started = profile
+        profiler.disable()
+        _profile_lock.release()
+        try:
+            store.save(profiler, 'flask', request.method, request.path, time.perf_counter() - started)
+        except OSError as e:
+            app.logger.warning('Could not save request profile: %s', e)
+
+    return store
+
+
+def make_profile_middleware(config):
+    """aiohttp middleware with the same selection rules as the Flask hook.
+
+    The profiler sees everything the event loop runs while the request is
+    awaited, including other requests served at the same time.
+    """
+    from aiohttp import web
+
+    store = store_from_config(config)
+    secret = _profile_secret(config)
+    sample_rate = config.get('PROFILE_SAMPLE_RATE', 0.0)
+
+    @web.middleware
+    async def profile_middleware(request, handler):
+        if not should_profile(request.headers.get(PROFILE_HEADER), secret, sample_rate):
+            return await handler(request)
+        if not _profile_lock.acquire(blocking=False):
+            return await handler(request)
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            return await handler(request)
+        finally:
+            profiler.disable()
+            _profile_lock.release()
+            try:
+                store.save(profiler, 'aiohttp', request.method, request.path, time.perf_counter() - started)
+            except OSError as e:
+                logger.warning('Could not save request profile: %s', e)
+
+    return profile_middleware
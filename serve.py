@@ -0,0 +1,107 @@
+import multiprocessing
+import os
+import tempfile
+
+from gunicorn.app.base import BaseApplication
+
+from metrics import registry
+from models import db
+
+
+def default_workers(app):
+    # Socket.IO polling requests of one session must reach the process that
+    # did the handshake, gunicorn hands them to any worker
+    if 'socketio' in app.extensions:
+        return 1
+    return multiprocessing.cpu_count() * 2 + 1
+
+
+def post_fork(server, worker):
+    """Drop connections inherited from the master, each worker opens its own"""
+    app = server.app.application
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+    if registry.directory:
+        registry.start_dumping(app.config.get('METRICS_DUMP_SECONDS', 5))
+
+
+def worker_exit(server, worker):
+    """Leave the final metrics of a worker for the others to render"""
+    registry.dump()
+
+
+def child_exit(server, worker):
+    registry.archive(worker.pid)
+
+
+class ServeApplication(BaseApplication):
+    """Gunicorn application that serves an already created Flask app.
+
+    The app is built once in the master and shared by the forked workers
+    (preload), gthread workers keep Socket.IO's threading mode working.
+    """
+
+    def __init__(self, application, options=None):
+        self.application = application
+        self.options = options or {}
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            if key in self.cfg.settings and value is not None:
+                self.cfg.set(key.lower(), value)
+
+    def load(self):
+        return self.application
+
+
+def run_server(app, bind=None, workers=None, threads=None, max_requests=None,
+               max_requests_jitter=None, timeout=None, graceful_timeout=None):
+    """Run ``app`` on a pre-forked gunicorn server"""
+    config = app.config
+    workers = workers or config.get('SERVE_WORKERS') or default_workers(app)
+
+    if workers > 1 and 'socketio' in app.extensions:
+        raise SystemExit("❌ Socket.IO needs a single worker: its polling requests would land on "
+                         "other workers. Serve it from one process and run the others with "
+                         "SOCKETIO_ENABLED=0")
+    if workers > 1 and config.get('TIMELINE_BACKEND', 'memory') == 'memory':
+        print(f"⚠️  Several workers with the memory timeline store: a new post reaches the other "
+              f"workers' timelines after up to {config.get('TIMELINE_MAX_AGE_SECONDS', 300)}s")
+
+    threads = threads or config.get('SERVE_THREADS', 32)
+    if workers > 1:
+        # Any worker answers /metrics for all of them
+        registry.directory = config.get('METRICS_DIR') or tempfile.mkdtemp(prefix='metrics-')
+        os.makedirs(registry.directory, exist_ok=True)
+        registry.clear_directory()
+    admission = app.extensions.get('admission')
+    if admission is not None:
+        admission.capacity = min(config.get('ADMISSION_CAPACITY', 64), threads)
+
+    options = {
+        'bind': bind or config.get('SERVE_BIND', '0.0.0.0:5000'),
+        'workers': workers,
+        'worker_class': 'gthread',
+        'threads': threads,
+        'preload_app': True,
+        'max_requests': max_requests if max_requests is not None else config.get('SERVE_MAX_REQUESTS', 10000),
+        'max_requests_jitter': (max_requests_jitter if max_requests_jitter is not None
+                                else config.get('SERVE_MAX_REQUESTS_JITTER', 1000)),
+        'timeout': timeout or config.get('SERVE_TIMEOUT', 60),
+        'graceful_timeout': graceful_timeout or config.get('SERVE_GRACEFUL_TIMEOUT', 30),
+        'post_fork': post_fork,
+        'worker_exit': worker_exit,
+        'child_exit': child_exit,
+        'accesslog': '-',
+    }
+
+    print(f"🚀 Serving on http://{options['bind']} with {options['workers']} workers "
+          f"x {options['threads']} threads")
+    ServeApplication(app, options).run()
+
+
+if __name__ == '__main__':
+    from main import create_app
+    run_server(create_app())
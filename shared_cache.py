@@ -0,0 +1,583 @@
+import collections
+import json
+import os
+import pickle
+import socketserver
+import threading
+import time
+import uuid
+
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+
+from commit_hooks import after_commit, on_cascade, on_commit
+from models import User, Post, Comment
+
+try:
+    import redis
+except ImportError:  # redis is optional, without CACHE_URL the shared level is in-process
+    redis = None
+
+MISSING = object()
+CHANNEL = 'cache-invalidate'
+
+
+class MemoryBackend:
+    """Shared level for a single process (development, tests), with
+    in-process pub/sub"""
+
+    errors = ()
+
+    def __init__(self):
+        self._data = {}
+        self._subscribers = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def _live(self, key):
+        entry = self._data.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+            del self._data[key]
+            return None
+        return entry
+
+    def get(self, key):
+        with self._lock:
+            entry = self._live(key)
+            return entry[0] if entry else None
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+
+    def set_many(self, mapping, ttl):
+        with self._lock:
+            for key, value in mapping.items():
+                self._data[key] = (value, time.monotonic() + ttl)
+
+    def add(self, key, value, ttl):
+        """Set only if the key does not exist, True when it was set"""
+        with self._lock:
+            if self._live(key):
+                return False
+            self._data[key] = (value, time.monotonic() + ttl)
+            return True
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def publish(self, channel, message):
+        for callback in list(self._subscribers[channel]):
+            callback(message)
+
+    def subscribe(self, channel, on_message, on_reset):
+        self._subscribers[channel].append(on_message)
+
+    def close(self):
+        self._subscribers.clear()
+
+    def reset_after_fork(self):
+        pass
+
+
+class RedisBackend:
+    """Redis (or LocalCacheServer) as the shared level, invalidations
+    are received by a subscriber thread"""
+
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError('CACHE_URL needs the redis package (pip install redis)')
+        self.url = url
+        self.errors = (redis.RedisError,)
+        self.client = self._connect()
+        self._subscription = None
+        self._pubsub = None
+        self._stopped = threading.Event()
+
+    def _connect(self, socket_timeout=1.0):
+        # A slow or unreachable server costs a request at most a second
+        return redis.Redis.from_url(self.url, socket_connect_timeout=1.0, socket_timeout=socket_timeout)
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value, ttl):
+        self.client.set(key, value, px=max(1, int(ttl * 1000)))
+
+    def set_many(self, mapping, ttl):
+        pipeline = self.client.pipeline(transaction=False)
+        for key, value in mapping.items():
+            pipeline.set(key, value, px=max(1, int(ttl * 1000)))
+        pipeline.execute()
+
+    def add(self, key, value, ttl):
+        return bool(self.client.set(key, value, px=max(1, int(ttl * 1000)), nx=True))
+
+    def delete(self, *keys):
+        self.client.delete(*keys)
+
+    def publish(self, channel, message):
+        self.client.publish(channel, message)
+
+    def subscribe(self, channel, on_message, on_reset):
+        self._subscription = (channel, on_message, on_reset)
+        self._stopped.clear()
+        threading.Thread(target=self._listen, name='cache-invalidations', daemon=True).start()
+
+    def _listen(self):
+        channel, on_message, on_reset = self._subscription
+        while not self._stopped.is_set():
+            try:
+                # No read timeout, the subscription is idle between writes
+                self._pubsub = self._connect(socket_timeout=None).pubsub(ignore_subscribe_messages=True)
+                self._pubsub.subscribe(channel)
+                # Invalidations sent while we were not subscribed are lost
+                on_reset()
+                for message in self._pubsub.listen():
+                    if message['type'] == 'message':
+                        on_message(message['data'])
+            except (redis.RedisError, OSError, ValueError):
+                if not self._stopped.is_set():
+                    time.sleep(1)
+
+    def close(self):
+        self._stopped.set()
+        if self._pubsub is not None:
+            try:
+                self._pubsub.close()
+            except (redis.RedisError, OSError):
+                pass
+
+    def reset_after_fork(self):
+        # Sockets and the subscriber thread belong to the parent
+        self.client = self._connect()
+        self._pubsub = None
+        if self._subscription is not None:
+            self.subscribe(*self._subscription)
+
+
+class TwoLevelCache:
+    """Values cached in a per-process LRU (L1) in front of a shared
+    backend (L2).
+
+    ``delete`` removes a key from L2 and publishes it, every process
+    drops it from its L1. L1 entries also expire after ``l1_ttl`` in
+    case a message is lost. ``delete`` also leaves a tombstone with its
+    time in L2 for ``lock_timeout`` seconds, a load that started before it
+    does not keep its possibly stale value. Concurrent misses for one key load it once:
+    threads of a process wait for the first one, other processes wait
+    for the holder of a lock in L2 to store the value.
+
+    Values are pickled into L2 and shared between callers from L1, treat
+    them as read-only.
+    """
+
+    def __init__(self, backend=None, l1_max_entries=10000, l1_ttl=30, default_ttl=300,
+                 lock_timeout=10, prefix='cache:'):
+        self.backend = backend or MemoryBackend()
+        self.l1_max_entries = l1_max_entries
+        self.l1_ttl = l1_ttl
+        self.default_ttl = default_ttl
+        self.lock_timeout = lock_timeout
+        self.lock_poll_interval = 0.05
+        self.prefix = prefix
+        # Tells our own invalidation messages apart from other processes'
+        self.instance_id = uuid.uuid4().hex
+        self._l1 = collections.OrderedDict()
+        self._inflight = {}
+        self._stats = collections.defaultdict(collections.Counter)
+        self._lock = threading.Lock()
+        self.backend.subscribe(CHANNEL, self._on_message, self.clear_local)
+
+    def use_backend(self, backend):
+        """Switch to another shared backend, dropping what L1 holds"""
+        self.backend.close()
+        self.backend = backend
+        self.clear_local()
+        backend.subscribe(CHANNEL, self._on_message, self.clear_local)
+
+    def _key(self, namespace, key):
+        return f'{self.prefix}{namespace}:{key}'
+
+    def _backend_call(self, namespace, method, *args):
+        try:
+            return getattr(self.backend, method)(*args)
+        except self.backend.errors:
+            # Fail open, the loader still answers while L2 is down
+            self._stats[namespace]['errors'] += 1
+            return MISSING
+
+    def _l1_get(self, namespace, key):
+        with self._lock:
+            entry = self._l1.get((namespace, key))
+            if entry is None:
+                return MISSING
+            if entry[1] <= time.monotonic():
+                del self._l1[(namespace, key)]
+                return MISSING
+            self._l1.move_to_end((namespace, key))
+            self._stats[namespace]['l1_hits'] += 1
+            return entry[0]
+
+    def _l1_put(self, namespace, key, value, ttl):
+        with self._lock:
+            self._l1[(namespace, key)] = (value, time.monotonic() + min(ttl, self.l1_ttl))
+            self._l1.move_to_end((namespace, key))
+            while len(self._l1) > self.l1_max_entries:
+                self._l1.popitem(last=False)
+
+    def get(self, namespace, key, default=None):
+        """Cached value or ``default``, without loading"""
+        key = str(key)
+        value = self._l1_get(namespace, key)
+        if value is not MISSING:
+            return value
+        data = self._backend_call(namespace, 'get', self._key(namespace, key))
+        if data is None or data is MISSING:
+            self._stats[namespace]['misses'] += 1
+            return default
+        self._stats[namespace]['l2_hits'] += 1
+        value = pickle.loads(data)
+        self._l1_put(namespace, key, value, self.default_ttl)
+        return value
+
+    def set(self, namespace, key, value, ttl=None):
+        key = str(key)
+        ttl = ttl or self.default_ttl
+        self._backend_call(namespace, 'set', self._key(namespace, key), pickle.dumps(value), ttl)
+        self._l1_put(namespace, key, value, ttl)
+        self._publish(namespace, [key])
+
+    def get_or_set(self, namespace, key, loader, ttl=None):
+        """Cached value, calling ``loader()`` once on a miss"""
+        key = str(key)
+        value = self._l1_get(namespace, key)
+        if value is not MISSING:
+            return value
+
+        with self._lock:
+            flight = self._inflight.get((namespace, key))
+            leader = flight is None
+            if leader:
+                flight = self._inflight[(namespace, key)] = {'done': threading.Event(), 'invalidated': False}
+        if not leader:
+            self._stats[namespace]['waits'] += 1
+            if flight['done'].wait(self.lock_timeout) and 'value' in flight:
+                return flight['value']
+            return loader()
+
+        try:
+            flight['value'] = self._load(namespace, key, loader, ttl or self.default_ttl, flight)
+            return flight['value']
+        finally:
+            with self._lock:
+                self._inflight.pop((namespace, key), None)
+            flight['done'].set()
+
+    def _load(self, namespace, key, loader, ttl, flight):
+        stats = self._stats[namespace]
+        shared_key = self._key(namespace, key)
+        data = self._backend_call(namespace, 'get', shared_key)
+        if data is not None and data is not MISSING:
+            stats['l2_hits'] += 1
+            value = pickle.loads(data)
+            self._l1_put(namespace, key, value, ttl)
+            return value
+        stats['misses'] += 1
+
+        lock_key = shared_key + ':lock'
+        locked = self._backend_call(namespace, 'add', lock_key, uuid.uuid4().hex.encode(), self.lock_timeout)
+        if locked is False:
+            # Another process is loading it, wait for its result
+            stats['waits'] += 1
+            deadline = time.monotonic() + self.lock_timeout
+            while time.monotonic() < deadline:
+                time.sleep(self.lock_poll_interval)
+                data = self._backend_call(namespace, 'get', shared_key)
+                if data is not None and data is not MISSING:
+                    value = pickle.loads(data)
+                    self._l1_put(namespace, key, value, ttl)
+                    return value
+
+        try:
+            started = time.time()
+            value = loader()
+            stats['loads'] += 1
+            # Written while we were loading, what we read may be stale
+            if not flight['invalidated']:
+                self._backend_call(namespace, 'set', shared_key, pickle.dumps(value), ttl)
+                # The invalidation message may not have arrived yet, the
+                # tombstone is written before the key is deleted
+                deleted_at = self._backend_call(namespace, 'get', shared_key + ':deleted')
+                if deleted_at is not None and deleted_at is not MISSING and float(deleted_at) >= started:
+                    self._backend_call(namespace, 'delete', shared_key)
+                else:
+                    self._l1_put(namespace, key, value, ttl)
+            return value
+        finally:
+            if locked is True:
+                self._backend_call(namespace, 'delete', lock_key)
+
+    def delete(self, namespace, *keys):
+        """Remove keys here, from L2 and from every process's L1"""
+        keys = [str(key) for key in keys]
+        if not keys:
+            return
+        deleted_at = repr(time.time()).encode()
+        self._backend_call(namespace, 'set_many', {self._key(namespace, key) + ':deleted': deleted_at
+                                                   for key in keys}, self.lock_timeout)
+        self._backend_call(namespace, 'delete', *[self._key(namespace, key) for key in keys])
+        self._evict(namespace, keys)
+        self._publish(namespace, keys)
+
+    def _publish(self, namespace, keys):
+        self._backend_call(namespace, 'publish', CHANNEL, json.dumps([self.instance_id, namespace, keys]))
+
+    def _on_message(self, message):
+        sender, namespace, keys = json.loads(message)
+        if sender != self.instance_id:
+            self._evict(namespace, keys)
+
+    def _evict(self, namespace, keys):
+        with self._lock:
+            for key in keys:
+                self._l1.pop((namespace, key), None)
+                flight = self._inflight.get((namespace, key))
+                if flight is not None:
+                    flight['invalidated'] = True
+            self._stats[namespace]['invalidations'] += len(keys)
+
+    def clear_local(self):
+        with self._lock:
+            self._l1.clear()
+            for flight in self._inflight.values():
+                flight['invalidated'] = True
+
+    def reset_after_fork(self):
+        self.instance_id = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self.clear_local()
+        self.backend.reset_after_fork()
+
+    def stats(self):
+        """Hits, misses and hit ratio per namespace"""
+        with self._lock:
+            result = {}
+            for namespace, counts in list(self._stats.items()):
+                hits = counts['l1_hits'] + counts['l2_hits']
+                lookups = hits + counts['misses']
+                result[namespace] = {**counts, 'hit_ratio': round(hits / lookups, 4) if lookups else None}
+            return {'l1_entries': len(self._l1), 'namespaces': result}
+
+
+shared_cache = TwoLevelCache()
+
+
+class _RespHandler(socketserver.StreamRequestHandler):
+    """One client connection of LocalCacheServer"""
+
+    def handle(self):
+        self.send_lock = threading.Lock()
+        self.channels = set()
+        try:
+            while True:
+                command = self._read_command()
+                if command is None:
+                    break
+                self.server.execute(self, command)
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            self.server.unsubscribe(self, list(self.channels))
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def send(self, reply):
+        with self.send_lock:
+            self.wfile.write(reply)
+
+
+def _resp(value):
+    if value is None:
+        return b'$-1\r\n'
+    if isinstance(value, int):
+        return b':%d\r\n' % value
+    if isinstance(value, list):
+        return b'*%d\r\n' % len(value) + b''.join(_resp(item) for item in value)
+    if isinstance(value, str):
+        value = value.encode()
+    return b'$%d\r\n%s\r\n' % (len(value), value)
+
+
+class LocalCacheServer(socketserver.ThreadingTCPServer):
+    """Stand-in for Redis in tests and local multi-worker runs.
+
+    Speaks the Redis protocol for the commands RedisBackend uses (GET,
+    SET with PX/EX/NX, DEL, PUBLISH, SUBSCRIBE), so workers started with
+    CACHE_URL=<server.url> share it exactly as they would share Redis.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        super().__init__((host, port), _RespHandler)
+        self.data = {}
+        self.subscribers = collections.defaultdict(set)
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'redis://{host}:{port}/0'
+
+    def start(self):
+        """Serve in a background thread"""
+        threading.Thread(target=self.serve_forever, name='local-cache-server', daemon=True).start()
+        return self
+
+    def _live(self, key):
+        entry = self.data.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+            del self.data[key]
+            return None
+        return entry
+
+    def execute(self, client, command):
+        name, args = command[0].upper(), command[1:]
+        if name == b'PING':
+            client.send(b'+PONG\r\n')
+        elif name == b'GET':
+            with self.lock:
+                entry = self._live(args[0])
+            client.send(_resp(entry[0] if entry else None))
+        elif name == b'SET':
+            client.send(self._set(args))
+        elif name == b'DEL':
+            with self.lock:
+                removed = sum(self._live(key) is not None and self.data.pop(key) is not None for key in args)
+            client.send(_resp(removed))
+        elif name == b'PUBLISH':
+            with self.lock:
+                receivers = list(self.subscribers.get(args[0], ()))
+            for receiver in receivers:
+                try:
+                    receiver.send(_resp([b'message', args[0], args[1]]))
+                except OSError:
+                    pass
+            client.send(_resp(len(receivers)))
+        elif name == b'SUBSCRIBE':
+            for channel in args:
+                with self.lock:
+                    self.subscribers[channel].add(client)
+                client.channels.add(channel)
+                client.send(_resp([b'subscribe', channel, len(client.channels)]))
+        elif name == b'UNSUBSCRIBE':
+            for channel in args or list(client.channels):
+                self.unsubscribe(client, [channel])
+                client.send(_resp([b'unsubscribe', channel, len(client.channels)]))
+        elif name in (b'FLUSHDB', b'FLUSHALL'):
+            with self.lock:
+                self.data.clear()
+            client.send(b'+OK\r\n')
+        elif name in (b'SELECT', b'CLIENT'):
+            client.send(b'+OK\r\n')
+        else:
+            client.send(b"-ERR unknown command '%s'\r\n" % name)
+
+    def _set(self, args):
+        key, value, options = args[0], args[1], [option.upper() for option in args[2:]]
+        expires_at = None
+        for unit, scale in ((b'EX', 1), (b'PX', 0.001)):
+            if unit in options:
+                expires_at = time.monotonic() + int(options[options.index(unit) + 1]) * scale
+        with self.lock:
+            if b'NX' in options and self._live(key) is not None:
+                return b'$-1\r\n'
+            self.data[key] = (value, expires_at)
+        return b'+OK\r\n'
+
+    def unsubscribe(self, client, channels):
+        with self.lock:
+            for channel in channels:
+                self.subscribers[channel].discard(client)
+                client.channels.discard(channel)
+
+
+# Cached API responses of single posts, dropped when the post, its
+# comments or its author's name change
+POST_NAMESPACE = 'post'
+
+
+def invalidate_after_commit(session, namespace, keys):
+    """Delete keys from the cache once the session's transaction commits"""
+    after_commit(session, 'shared_cache', [(namespace, key) for key in keys])
+
+
+def _posts_of_users(session, user_ids):
+    """Posts the users wrote or commented on, their representations show the usernames"""
+    return set(session.scalars(select(Post.id).where(Post.user_id.in_(user_ids)).union(
+        select(Comment.post_id).where(Comment.user_id.in_(user_ids)))))
+
+
+@on_cascade
+def _cascaded_posts(session, cascade):
+    invalidate_after_commit(session, POST_NAMESPACE, cascade.affected_post_ids())
+
+
+@event.listens_for(Session, 'after_flush')
+def _changed_posts(session, flush_context):
+    post_ids = set()
+    renamed = []
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Post):
+            post_ids.add(obj.id)
+        elif isinstance(obj, Comment):
+            post_ids.add(obj.post_id)
+        elif isinstance(obj, User) and obj in session.dirty and inspect(obj).attrs.username.history.deleted:
+            renamed.append(obj.id)
+    if renamed:
+        post_ids.update(_posts_of_users(session, renamed))
+    if post_ids:
+        invalidate_after_commit(session, POST_NAMESPACE, post_ids)
+
+
+@on_commit('shared_cache')
+def _apply_invalidations(items):
+    keys = collections.defaultdict(set)
+    for namespace, key in items:
+        keys[namespace].add(key)
+    for namespace in keys:
+        shared_cache.delete(namespace, *keys[namespace])
+
+
+_fork_hook_registered = False
+
+
+def init_shared_cache(app):
+    """Configure the cache from the app config, CACHE_URL (redis://...)
+    makes the shared level and invalidations work across processes"""
+    global _fork_hook_registered
+    url = app.config.get('CACHE_URL')
+    if url and getattr(shared_cache.backend, 'url', None) != url:
+        shared_cache.use_backend(RedisBackend(url))
+    shared_cache.l1_max_entries = app.config.get('CACHE_L1_MAX_ENTRIES', 10000)
+    shared_cache.l1_ttl = app.config.get('CACHE_L1_SECONDS', 30)
+    shared_cache.default_ttl = app.config.get('CACHE_DEFAULT_SECONDS', 300)
+    shared_cache.lock_timeout = app.config.get('CACHE_LOCK_SECONDS', 10)
+    if not _fork_hook_registered and hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=shared_cache.reset_after_fork)
+        _fork_hook_registered = True
+    return shared_cache
@@ -0,0 +1,203 @@
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_app_context, render_template, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('sql_profiler')
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+PLACEHOLDER = r'(?:\?|%s|%\(\w+\)s|:\w+)'
+LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+IN_LIST_RE = re.compile(r'\(\s*' + PLACEHOLDER + r'(?:\s*,\s*' + PLACEHOLDER + r')*\s*\)')
+
+_slow_query_seconds = 0.2
+_recorders = []
+_recorders_lock = threading.Lock()
+
+
+def normalize_statement(statement):
+    """Reduce a statement to its shape: literals and IN lists become placeholders"""
+    statement = ' '.join(statement.split())
+    statement = LITERAL_RE.sub('?', statement)
+    return IN_LIST_RE.sub('(?)', statement)
+
+
+def _caller_location():
+    """First frame of our own code that led to the query"""
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if (filename.startswith(PROJECT_DIR) and 'site-packages' not in filename
+                and filename != __file__):
+            return f'{os.path.relpath(filename, PROJECT_DIR)}:{frame.f_lineno}'
+        frame = frame.f_back
+    return None
+
+
+class QueryRecorder:
+    """Collects executed statements and groups them by normalized shape"""
+
+    def __init__(self):
+        self.queries = []
+
+    def record(self, statement, duration, location):
+        self.queries.append((statement, duration, location))
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def total_time(self):
+        return sum(duration for statement, duration, location in self.queries)
+
+    def groups(self):
+        """Statement shapes with their count and timings, most frequent first"""
+        grouped = {}
+        for statement, duration, location in self.queries:
+            shape = normalize_statement(statement)
+            group = grouped.setdefault(shape, {
+                'statement': shape,
+                'count': 0,
+                'total_time': 0.0,
+                'max_time': 0.0,
+                'locations': []
+            })
+            group['count'] += 1
+            group['total_time'] += duration
+            group['max_time'] = max(group['max_time'], duration)
+            if location and location not in group['locations']:
+                group['locations'].append(location)
+        return sorted(grouped.values(), key=lambda group: (-group['count'], -group['total_time']))
+
+    def n_plus_one(self, threshold):
+        """Statement shapes repeated at least ``threshold`` times"""
+        return [group for group in self.groups() if group['count'] >= threshold]
+
+    def slow(self, threshold_seconds):
+        """Single statements slower than the threshold"""
+        return [(statement, duration, location) for statement, duration, location in self.queries
+                if duration >= threshold_seconds]
+
+    def report(self):
+        lines = [f'{self.count} queries in {self.total_time * 1000:.1f} ms']
+        for group in self.groups():
+            where = f" at {', '.join(group['locations'])}" if group['locations'] else ''
+            lines.append(f"  {group['count']:>4} x {group['total_time'] * 1000:8.1f} ms  "
+                         f"{group['statement'][:200]}{where}")
+        return '\n'.join(lines)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+@contextmanager
+def record_queries():
+    """Record every statement executed inside the block (any thread)"""
+    recorder = QueryRecorder()
+    with _recorders_lock:
+        _recorders.append(recorder)
+    try:
+        yield recorder
+    finally:
+        with _recorders_lock:
+            _recorders.remove(recorder)
+
+
+@contextmanager
+def query_budget(max_queries, max_repeats=None):
+    """Fail if the block runs more than ``max_queries`` statements, or any
+    statement shape more than ``max_repeats`` times, for use in tests::
+
+        with query_budget(3):
+            client.get('/posts')
+    """
+    with record_queries() as recorder:
+        yield recorder
+    if recorder.count > max_queries:
+        raise QueryBudgetExceeded(f'Query budget of {max_queries} exceeded\n{recorder.report()}')
+    if max_repeats is not None and recorder.n_plus_one(max_repeats + 1):
+        raise QueryBudgetExceeded(f'A statement ran more than {max_repeats} times\n{recorder.report()}')
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('profiler_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    # A failed statement never reaches after_cursor_execute
+    started = context.connection.info.get('profiler_started') if context.connection is not None else None
+    if started:
+        started.pop()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info['profiler_started'].pop()
+
+    request_recorder = g.get('sql_recorder') if has_app_context() else None
+    if request_recorder is None and not _recorders:
+        if duration >= _slow_query_seconds:
+            logger.warning('Slow query (%.1f ms): %s', duration * 1000, ' '.join(statement.split())[:500])
+        return
+
+    location = _caller_location()
+    if request_recorder is not None:
+        request_recorder.record(statement, duration, location)
+    elif duration >= _slow_query_seconds:
+        logger.warning('Slow query (%.1f ms): %s', duration * 1000, ' '.join(statement.split())[:500])
+    for recorder in list(_recorders):
+        recorder.record(statement, duration, location)
+
+
+def init_sql_profiler(app):
+    """Slow query logging everywhere, per-request N+1 detection when enabled"""
+    global _slow_query_seconds
+    _slow_query_seconds = app.config.get('SQL_SLOW_QUERY_MS', 200) / 1000
+    threshold = app.config.get('SQL_N_PLUS_ONE_THRESHOLD', 5)
+    enabled = app.config.get('SQL_PROFILER_ENABLED') or app.debug
+
+    if not enabled:
+        return False
+
+    @app.before_request
+    def start_sql_profile():
+        g.sql_recorder = QueryRecorder()
+
+    @app.after_request
+    def finish_sql_profile(response):
+        recorder = g.pop('sql_recorder', None)
+        if recorder is None:
+            return response
+
+        repeated = recorder.n_plus_one(threshold)
+        slow = recorder.slow(_slow_query_seconds)
+        for group in repeated:
+            app.logger.warning('Possible N+1 on %s %s: %d x %s (at %s)', request.method, request.path,
+                               group['count'], group['statement'][:300], ', '.join(group['locations']) or '?')
+        for statement, duration, location in slow:
+            app.logger.warning('Slow query on %s %s (%.1f ms at %s): %s', request.method, request.path,
+                               duration * 1000, location or '?', ' '.join(statement.split())[:500])
+
+        show_panel = app.config.get('SQL_PROFILER_PANEL', app.debug)
+        if (show_panel and response.mimetype == 'text/html' and not response.direct_passthrough
+                and 'Content-Encoding' not in response.headers):
+            panel = render_template('sql_profiler_panel.html', recorder=recorder,
+                                    groups=recorder.groups(), repeated=repeated, slow=slow,
+                                    threshold=threshold)
+            body = response.get_data(as_text=True)
+            if '</body>' in body:
+                response.set_data(body.replace('</body>', panel + '</body>', 1))
+        return response
+
+    return True
@@ -0,0 +1,56 @@
+from flask import Response, stream_with_context
+
+from models import db
+from json_backend import dumps
+
+STREAM_FORMATS = ('json', 'ndjson')
+DEFAULT_CHUNK_SIZE = 500
+
+
+def iter_chunks(statement, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield lists of rows from a server-side cursor, ``chunk_size`` at a time"""
+    result = db.session.execute(
+        statement.execution_options(stream_results=True, yield_per=chunk_size)
+    )
+    try:
+        for chunk in result.partitions():
+            yield chunk
+    finally:
+        result.close()
+
+
+def _json_array(chunks, serialize_chunk):
+    yield '['
+    first = True
+    for chunk in chunks:
+        rows = serialize_chunk(chunk)
+        if not rows:
+            continue
+        body = ','.join(dumps(row) for row in rows)
+        yield body if first else ',' + body
+        first = False
+    yield ']'
+
+
+def _ndjson(chunks, serialize_chunk):
+    for chunk in chunks:
+        rows = serialize_chunk(chunk)
+        if rows:
+            yield ''.join(dumps(row) + '\n' for row in rows)
+
+
+def stream_response(statement, serialize_chunk, fmt='json', chunk_size=DEFAULT_CHUNK_SIZE):
+    """Stream the rows selected by ``statement`` as a JSON array or NDJSON.
+
+    Rows are pulled from the database in chunks, ``serialize_chunk`` turns
+    each chunk into a list of dicts and the chunk is written out right away,
+    so memory stays flat no matter how many rows the statement returns.
+    ``serialize_chunk`` must not query: the connection is busy with the open
+    cursor, select everything the rows need in ``statement``.
+    """
+    chunks = iter_chunks(statement, chunk_size)
+    if fmt == 'ndjson':
+        body, mimetype = _ndjson(chunks, serialize_chunk), 'application/x-ndjson'
+    else:
+        body, mimetype = _json_array(chunks, serialize_chunk), 'application/json'
+    return Response(stream_with_context(body), mimetype=mimetype)
@@ -0,0 +1,110 @@
+import collections
+import os
+import threading
+import time
+
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+
+class FragmentCache:
+    """Rendered template fragments, least recently used evicted first.
+
+    Keys contain the version of what the fragment shows (e.g. id and
+    ``updated_at``), so changed content gets a new key instead of an
+    invalidation; old entries age out by LRU or after ``max_age``.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, max_age=3600):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[1] <= self.max_age:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, html):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (html, time.monotonic())
+            self.size += len(html)
+            while self.size > self.max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        html, stored_at = self._entries.pop(key)
+        self.size -= len(html)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses}
+
+
+fragment_cache = FragmentCache()
+
+
+class FragmentCacheExtension(Extension):
+    """``{% cache key, ... [unless condition] %}...{% endcache %}``
+
+    Caches the rendered body under the template, the tag's line and the
+    key values. Bodies that depend on the viewer (owner buttons, CSRF
+    tokens) are rendered normally when the ``unless`` condition is true.
+    """
+
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        site = nodes.Const(f'{parser.name}:{lineno}')
+        keys = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            keys.append(parser.parse_expression())
+        skip = nodes.Const(False)
+        if parser.stream.skip_if('name:unless'):
+            skip = parser.parse_expression()
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(self.call_method('_cached', [site, nodes.List(keys), skip]),
+                               [], [], body).set_lineno(lineno)
+
+    def _cached(self, site, keys, skip, caller):
+        if skip:
+            return caller()
+        key = (site,) + tuple(keys)
+        html = fragment_cache.get(key)
+        if html is None:
+            html = str(caller())
+            fragment_cache.put(key, html)
+        return Markup(html)
+
+
+def init_template_cache(app):
+    """Compiled templates in a bytecode cache directory shared by all
+    workers and restarts, and the ``{% cache %}`` tag for fragments"""
+    directory = app.config.get('JINJA_BYTECODE_CACHE_DIR') or os.path.join(app.instance_path, 'jinja_cache')
+    os.makedirs(directory, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+
+    fragment_cache.max_bytes = app.config.get('FRAGMENT_CACHE_MAX_BYTES', 16 * 1024 * 1024)
+    fragment_cache.max_age = app.config.get('FRAGMENT_CACHE_SECONDS', 3600)
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    return directory
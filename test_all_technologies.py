@@ -42,7 +42,11 @@ class TechnologyTester:
             self.print_result("Flask Posts Page", response.status_code == 200)
 
             response = requests.get(f"{self.base_url}/map")
-            self.print_result("Folium Map Integration", response.status_code == 200)
+            self.print_result("Map Page", response.status_code == 200)
+
+            response = requests.get(f"{self.base_url}/api/tiles/0/0/0.geojson")
+            self.print_result("GeoJSON Map Tiles", response.status_code == 200 and
+                              response.json().get('type') == 'FeatureCollection')
 
             response = requests.get(f"{self.base_url}/websocket")
             self.print_result("Flask-SocketIO Test Page", response.status_code == 200)
@@ -152,6 +156,16 @@ class TechnologyTester:
             response = requests.get(f"{self.base_url}/api/posts")
             self.print_result("RESTful - Get Posts", response.status_code == 200)
 
+            # Test autocomplete
+            response = requests.get(f"{self.base_url}/api/autocomplete", params={'q': 'fl'})
+            self.print_result("RESTful - Autocomplete",
+                              response.status_code == 200 and 'results' in response.json())
+
+            # Test shared cache statistics
+            response = requests.get(f"{self.base_url}/api/cache/stats")
+            self.print_result("RESTful - Cache Stats",
+                              response.status_code == 200 and 'namespaces' in response.json())
+
             # Test technology overview
             response = requests.get(f"{self.base_url}/api/test/technologies")
             if response.status_code == 200:
@@ -195,6 +209,17 @@ class TechnologyTester:
                     self.print_result("Async - Health Check", False,
                                       f"Connection failed: {str(e)}")
 
+                # Test readiness check
+                try:
+                    async with session.get(f"{self.async_url}/async/ready") as resp:
+                        data = await resp.json()
+                        lag = data.get('checks', {}).get('event_loop', {}).get('lag_ms', {})
+                        self.print_result("Async - Readiness Check", resp.status == 200,
+                                          f"Status: {data.get('status')}, loop lag p99: {lag.get('0.99')} ms")
+                except Exception as e:
+                    self.print_result("Async - Readiness Check", False,
+                                      f"Connection failed: {str(e)}")
+
                 # Test async posts
                 try:
                     async with session.get(f"{self.async_url}/async/posts") as resp:
@@ -0,0 +1,108 @@
+import os
+import tempfile
+
+import pytest
+
+TEST_DIR = tempfile.mkdtemp(prefix='flask-project-tests-')
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(TEST_DIR, 'test.db'))
+os.environ.setdefault('DATABASE_REPLICA_URLS', '')
+os.environ.setdefault('PROFILE_DIR', os.path.join(TEST_DIR, 'profiles'))
+os.environ.setdefault('JINJA_BYTECODE_CACHE_DIR', os.path.join(TEST_DIR, 'jinja_cache'))
+os.environ.setdefault('LOG_ACTIVITY_FILE', os.path.join(TEST_DIR, 'async_logs.txt'))
+
+from config import Config  # noqa: E402
+
+
+class TestConfig(Config):
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    ADMISSION_ENABLED = False
+    COMPRESS_ENABLED = False
+
+
+@pytest.fixture(scope='session')
+def app():
+    from main import create_app
+    from models import db
+
+    app = create_app(TestConfig)
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+@pytest.fixture(autouse=True)
+def database(app):
+    """Empty tables and in-process caches for every test"""
+    from autocomplete import autocomplete
+    from availability import availability
+    from models import db
+    from shared_cache import MemoryBackend, shared_cache
+    from template_cache import fragment_cache
+    from tiles import tile_cache
+    from timeline import MemoryTimelineStore, timelines
+
+    with app.app_context():
+        for table in reversed(db.metadata.sorted_tables):
+            db.session.execute(table.delete())
+        db.session.commit()
+    autocomplete._built_at = None
+    autocomplete._pending = None
+    availability.filters = None
+    availability._built_at = None
+    availability._last_change_id = 0
+    shared_cache.use_backend(MemoryBackend())
+    fragment_cache.clear()
+    tile_cache.clear()
+    timelines.store = MemoryTimelineStore()
+    with app.app_context():
+        yield db
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture(scope='session')
+def password_hash():
+    """Hash of the password '123456', hashing is slow on purpose"""
+    from werkzeug.security import generate_password_hash
+    return generate_password_hash('123456')
+
+
+@pytest.fixture
+def users(database, password_hash):
+    """An admin with five posts and a blogger who commented on the first one"""
+    from models import User, Post, Comment
+
+    admin = User(username='admin', email='admin@example.com', password_hash=password_hash)
+    blogger = User(username='blogger', email='blogger@example.com', password_hash=password_hash)
+    database.session.add_all([admin, blogger])
+    database.session.commit()
+    posts = [Post(title=f'Flask post {number}', content='Post content ' * 20, user_id=admin.id)
+             for number in range(5)]
+    database.session.add_all(posts)
+    database.session.commit()
+    database.session.add_all([Comment(content=f'Comment {number}', post_id=posts[0].id, user_id=blogger.id)
+                              for number in range(3)])
+    database.session.commit()
+    return admin.id, blogger.id
+
+
+@pytest.fixture
+def login(client):
+    """Log the test client in through the form"""
+    def login(username='admin', password='123456'):
+        return client.post('/login', data={'username': username, 'password': password})
+    return login
+
+
+@pytest.fixture
+def api_headers(client):
+    """Authorization headers of a JWT for the given user"""
+    def api_headers(username='admin', password='123456'):
+        response = client.post('/api/auth/login', json={'username': username, 'password': password})
+        return {'Authorization': f"Bearer {response.get_json()['access_token']}"}
+    return api_headers
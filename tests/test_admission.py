@@ -0,0 +1,70 @@
+import threading
+import time
+
+from admission import AdmissionController, classify, controller_from_config
+
+
+def test_classify():
+    assert classify('GET', '/posts') == 'read'
+    assert classify('POST', '/posts/create') == 'write'
+    assert classify('POST', '/login') == 'login'
+    assert classify('GET', '/api/posts', {'stream': 'json'}) == 'batch'
+    assert classify('GET', '/metrics') is None
+
+
+def test_class_limits_follow_the_shares():
+    controller = AdmissionController(capacity=10)
+    assert [controller.limit(name) for name in ('read', 'login', 'write', 'batch')] == [10, 5, 6, 2]
+    assert all(controller.acquire('batch') for _ in range(2))
+    assert not controller.acquire('batch')
+    assert controller.snapshot()['classes']['batch']['rejected'] == 1
+
+
+def test_writes_are_shed_before_reads():
+    controller = AdmissionController(capacity=10, max_wait_ms={'read': 0, 'write': 0})
+    assert all(controller.acquire('write') for _ in range(6))
+    assert not controller.acquire('write')
+    assert all(controller.acquire('read') for _ in range(4))
+    assert not controller.acquire('read')
+
+
+def test_slow_reads_shrink_the_other_classes():
+    controller = AdmissionController(capacity=10, latency_target=0.1)
+    for _ in range(30):
+        controller.acquire('read')
+        controller.release('read', 1.0)
+    assert controller.limit('write') < 6
+    assert controller.limit('read') == 10
+
+
+def test_release_wakes_a_read_queued_behind_a_write():
+    controller = AdmissionController(capacity=10, max_wait_ms={'read': 2000, 'write': 2000})
+    assert all(controller.acquire('write') for _ in range(6))
+    assert all(controller.acquire('read') for _ in range(4))
+    results = {}
+
+    def acquire(name):
+        results[name] = controller.acquire(name)
+
+    # The write waits first and stays at its limit after the release
+    waiting_write = threading.Thread(target=acquire, args=('write',))
+    waiting_write.start()
+    time.sleep(0.05)
+    waiting_read = threading.Thread(target=acquire, args=('read',))
+    waiting_read.start()
+    time.sleep(0.05)
+    controller.release('read', 0.01)
+    waiting_read.join(1)
+    assert results.get('read') is True
+    assert 'write' not in results
+    for name in ['read'] * 4 + ['write']:
+        controller.release(name, 0.01)
+    waiting_write.join(1)
+    assert results.get('write') is True
+
+
+def test_capacity_is_capped_by_the_threads():
+    config = {'ADMISSION_CAPACITY': 64}
+    assert controller_from_config(config, 'test', threads=32).capacity == 32
+    assert controller_from_config(config, 'test', threads=100).capacity == 64
+    assert controller_from_config(config, 'test').capacity == 64
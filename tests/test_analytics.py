@@ -0,0 +1,38 @@
+import pytest
+
+from analytics import parse_window, rebuild_rollups
+from models import User, Post, Comment, ActivityRollup, AuthorActivity, PostCommentCount, CommentCountBucket
+
+ROLLUPS = (ActivityRollup, AuthorActivity, PostCommentCount, CommentCountBucket)
+
+
+def snapshot(database):
+    """Rollup rows without the ones whose counters dropped to zero"""
+    counters = ('count', 'posts', 'comments')
+    return {model.__tablename__: sorted(tuple(row) for row in database.session.execute(model.__table__.select())
+                                        if any(row._mapping.get(name) for name in counters))
+            for model in ROLLUPS}
+
+
+def test_incremental_rollups_match_a_rebuild(database, users):
+    admin_id, blogger_id = users
+    database.session.add_all([Comment(content='More', post_id=post_id, user_id=admin_id) for post_id in (1, 2, 2)])
+    database.session.commit()
+    database.session.delete(database.session.get(Comment, 1))
+    database.session.delete(database.session.get(Post, 3))
+    database.session.commit()
+    database.session.delete(database.session.get(User, blogger_id))
+    database.session.commit()
+
+    incremental = snapshot(database)
+    rebuild_rollups()
+    assert incremental == snapshot(database)
+
+
+@pytest.mark.parametrize('args', [
+    {'granularity': 'hour', 'from': '2026-01-01', 'to': '2026-03-01'},
+    {'granularity': 'day', 'from': '2016-01-01', 'to': '2026-01-01'},
+])
+def test_window_is_capped(args):
+    with pytest.raises(ValueError, match='Window too large'):
+        parse_window(args)
@@ -0,0 +1,40 @@
+import threading
+from datetime import datetime
+
+from autocomplete import PrefixIndex, autocomplete
+
+
+def wait_for_rebuild():
+    for thread in threading.enumerate():
+        if thread.name == 'autocomplete-rebuild':
+            thread.join(5)
+
+
+def test_first_search_reads_the_database_while_building(users):
+    expected = ['Flask post 4', 'Flask post 3']
+    assert [text for _, text, _ in autocomplete.search('flask', limit=2)] == expected
+    wait_for_rebuild()
+    assert autocomplete._built_at is not None
+    assert [text for _, text, _ in autocomplete.search('flask', limit=2)] == expected
+
+
+def test_changes_committed_during_a_rebuild_are_kept(users):
+    autocomplete._pending = []
+    autocomplete.apply([('upsert', 'posts', 99, 'Zebra crossing', datetime.utcnow())])
+    autocomplete.rebuild()
+    assert [entity_id for entity_id, _, _ in autocomplete.search('zebra')] == [99]
+    assert autocomplete._pending is None
+
+
+def test_large_prefix_results_are_cached_until_a_write():
+    index = PrefixIndex(scan_threshold=3)
+    for number in range(5):
+        index.add(number, f'Flask tips {number}', number)
+    assert [entity_id for entity_id, _, _ in index.search('flask t', limit=2)] == [4, 3]
+    assert 'flask t' in index._cache
+    index.add(10, 'Flask tricks', 10)
+    assert 'flask t' not in index._cache
+    assert [entity_id for entity_id, _, _ in index.search('flask t', limit=2)] == [10, 4]
+    # Narrow prefixes are scanned
+    assert [entity_id for entity_id, _, _ in index.search('flask tr')] == [10]
+    assert 'flask tr' not in index._cache
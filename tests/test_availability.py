@@ -0,0 +1,40 @@
+import threading
+
+from sqlalchemy import insert
+
+from availability import availability
+from changefeed import log_changes
+from models import User
+
+
+def wait_for_rebuild():
+    for thread in threading.enumerate():
+        if thread.name == 'availability-rebuild':
+            thread.join(5)
+
+
+def test_first_build_runs_in_the_background(users):
+    assert availability.is_available('username', 'newcomer')
+    assert not availability.is_available('username', 'admin')
+    wait_for_rebuild()
+    assert availability.filters is not None
+    negatives = availability.negatives
+    assert availability.is_available('username', 'newcomer')
+    assert availability.negatives == negatives + 1
+
+
+def test_registration_by_another_process_is_seen(database, users, password_hash):
+    availability.rebuild()
+    assert availability.is_available('username', 'remote')
+
+    # Written outside this process's session hooks, as another worker would
+    connection = database.session.connection()
+    result = connection.execute(insert(User.__table__).values(
+        username='remote', email='remote@example.com', password_hash=password_hash))
+    log_changes(connection, 'user', result.inserted_primary_key, 'create')
+    database.session.commit()
+    assert availability.filters['username'].might_contain('remote') is False
+
+    availability._synced_at = 0
+    assert not availability.is_available('username', 'remote')
+    assert not availability.is_available('email', 'remote@example.com')
@@ -0,0 +1,42 @@
+import base64
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from models import Post
+from pagination import encode_cursor
+
+
+def raw_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+
+@pytest.mark.parametrize('since', [
+    'WzEsIDVd',
+    'not base64!',
+    raw_cursor([1]),
+    raw_cursor(['1', '2026-01-01T00:00:00']),
+    raw_cursor([1, 5]),
+    raw_cursor([1, None]),
+    raw_cursor([1, '2026-01-01T00:00:00Z']),
+])
+def test_malformed_cursor_is_a_bad_request(client, users, since):
+    response = client.get('/api/changes', query_string={'since': since})
+    assert response.status_code == 400
+    assert response.get_json()['message'] == 'Invalid cursor'
+
+
+def test_expired_cursor(client, users):
+    since = encode_cursor([1, datetime.utcnow() - timedelta(days=365)])
+    assert client.get('/api/changes', query_string={'since': since}).status_code == 410
+
+
+def test_sync_follows_the_cursor(client, users, database):
+    first = client.get('/api/changes').get_json()
+    assert {(change['entity'], change['op']) for change in first['changes']} >= {('post', 'create')}
+
+    database.session.delete(database.session.get(Post, 2))
+    database.session.commit()
+    second = client.get('/api/changes', query_string={'since': first['next_cursor']}).get_json()
+    assert [(change['entity'], change['id'], change['op']) for change in second['changes']] == [('post', 2, 'delete')]
@@ -0,0 +1,42 @@
+from flask import Response, g, stream_with_context
+
+from db_routing import use_primary, use_replica
+
+
+def test_route_is_released_after_the_view(app):
+    @use_replica
+    def view():
+        return {'route': g.get('db_route')}
+
+    with app.test_request_context():
+        assert view() == {'route': 'replica'}
+        assert g.get('db_route') is None
+
+
+def test_streamed_response_keeps_the_route(app):
+    routes = []
+
+    @use_replica
+    def view():
+        def generate():
+            routes.append(g.get('db_route'))
+            yield '[]'
+        return Response(stream_with_context(generate()))
+
+    with app.test_request_context():
+        response = view()
+        assert response.get_data() == b'[]'
+        assert routes == ['replica']
+        response.close()
+        assert g.get('db_route') is None
+
+
+def test_use_primary_restores_the_route(app):
+    @use_replica
+    def view():
+        with use_primary():
+            inside = g.get('db_route')
+        return inside, g.get('db_route')
+
+    with app.test_request_context():
+        assert view() == (None, 'replica')
@@ -0,0 +1,39 @@
+import os
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from metrics import MetricsRegistry
+
+
+def test_failed_statement_does_not_leak_start_times(database):
+    connection = database.session.connection()
+    with pytest.raises(OperationalError):
+        connection.execute(text('SELECT * FROM missing_table'))
+    assert connection.info.get('query_started') == []
+    assert connection.info.get('profiler_started') == []
+    database.session.rollback()
+
+
+def test_workers_are_added_up(tmp_path):
+    registry = MetricsRegistry()
+    registry.directory = str(tmp_path)
+    requests = registry.counter('requests_total', 'Requests', ('status',))
+    in_flight = registry.gauge('in_flight', 'In flight')
+    requests.inc(status=200)
+    in_flight.inc()
+
+    # Another worker, alive, that dumped its values
+    other = os.getppid()
+    registry._write(registry._path(other), {'requests_total': [[['200'], 2]], 'in_flight': [[[], 3]]})
+    rendered = registry.render()
+    assert 'requests_total{status="200"} 3' in rendered
+    assert 'in_flight 4' in rendered
+
+    # The worker exits, its requests stay counted and its gauge is dropped
+    registry.archive(other)
+    rendered = registry.render()
+    assert 'requests_total{status="200"} 3' in rendered
+    assert 'in_flight 1' in rendered
+    assert not os.path.exists(registry._path(other))
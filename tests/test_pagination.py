@@ -0,0 +1,52 @@
+import base64
+import json
+from datetime import datetime
+
+import pytest
+
+from models import Comment
+from pagination import decode_cursor, encode_cursor
+
+COLUMNS = (Comment.created_at, Comment.id)
+
+
+def raw_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+
+MALFORMED = [
+    'not base64!',
+    raw_cursor({'created_at': '2026-01-01T00:00:00'}),
+    raw_cursor(['2026-01-01T00:00:00']),
+    raw_cursor([1, 2]),
+    raw_cursor(['2026-01-01T00:00:00', '5']),
+    raw_cursor(['2026-01-01T00:00:00', True]),
+    raw_cursor(['yesterday', 5]),
+    raw_cursor(['2026-01-01T00:00:00+02:00', 5]),
+    raw_cursor([None, 5]),
+]
+
+
+def test_cursor_round_trip():
+    values = [datetime(2026, 1, 31, 12, 30, 5, 123), 42]
+    assert decode_cursor(encode_cursor(values), COLUMNS) == values
+
+
+@pytest.mark.parametrize('cursor', MALFORMED)
+def test_malformed_cursor_raises_value_error(cursor):
+    with pytest.raises(ValueError, match='Invalid cursor'):
+        decode_cursor(cursor, COLUMNS)
+
+
+@pytest.mark.parametrize('cursor', MALFORMED)
+@pytest.mark.parametrize('url', ['/api/posts/1/comments', '/posts/1', '/posts/1/comments'])
+def test_malformed_cursor_is_a_bad_request(client, users, url, cursor):
+    assert client.get(url, query_string={'cursor': cursor}).status_code == 400
+
+
+def test_comment_pages_follow_the_cursor(client, users):
+    first = client.get('/api/posts/1/comments?limit=2').get_json()
+    second = client.get('/api/posts/1/comments', query_string={'limit': 2, 'cursor': first['next_cursor']})
+    ids = [comment['id'] for comment in first['comments'] + second.get_json()['comments']]
+    assert ids == [3, 2, 1]
+    assert second.get_json()['next_cursor'] is None
@@ -0,0 +1,55 @@
+import pytest
+
+from models import User, Post, Comment, Follow
+from sql_profiler import query_budget
+
+
+@pytest.fixture
+def many_posts(database, users, password_hash):
+    """Posts by several authors with comments by several users, so a
+    query per row would show up as repeated statements"""
+    admin_id, blogger_id = users
+    authors = [User(username=f'author{number}', email=f'author{number}@example.com', password_hash=password_hash)
+               for number in range(5)]
+    database.session.add_all(authors)
+    database.session.commit()
+    posts = [Post(title=f'Post {number}', content='Text ' * 50, user_id=authors[number % 5].id)
+             for number in range(20)]
+    database.session.add_all(posts)
+    database.session.commit()
+    database.session.add_all([Comment(content='Nice', post_id=post.id, user_id=authors[number % 5].id)
+                              for number, post in enumerate(posts) for _ in range(2)])
+    database.session.add_all([Follow(follower_id=admin_id, followed_id=author.id) for author in authors])
+    database.session.commit()
+
+
+@pytest.mark.parametrize('url, budget', [
+    ('/', 4),
+    ('/posts', 3),
+    ('/posts/1', 5),
+    ('/posts/1/comments', 2),
+    ('/timeline', 4),
+])
+def test_pages(client, login, many_posts, url, budget):
+    login()
+    client.get(url)
+    with query_budget(budget, max_repeats=1):
+        assert client.get(url).status_code == 200
+
+
+@pytest.mark.parametrize('url, budget, repeats', [
+    ('/api/posts', 3, 1),
+    ('/api/posts?fields=id,author,comments_count,comments', 5, 2),
+    ('/api/posts/1/comments', 3, 1),
+    ('/api/users', 1, 1),
+])
+def test_api(client, api_headers, many_posts, url, budget, repeats):
+    headers = api_headers()
+    with query_budget(budget, max_repeats=repeats):
+        assert client.get(url, headers=headers).status_code == 200
+
+
+def test_cached_post_needs_no_query(client, many_posts):
+    client.get('/api/posts/1')
+    with query_budget(0):
+        assert client.get('/api/posts/1').status_code == 200
@@ -0,0 +1,40 @@
+import pytest
+
+from models import Post
+from shared_cache import MemoryBackend, TwoLevelCache
+
+
+@pytest.fixture
+def backend():
+    return MemoryBackend()
+
+
+def test_delete_reaches_other_processes(backend):
+    first, second = TwoLevelCache(backend), TwoLevelCache(backend)
+    assert first.get_or_set('post', 1, lambda: 'old') == 'old'
+    assert second.get_or_set('post', 1, lambda: 'other') == 'old'
+
+    first.delete('post', 1)
+    assert second.get_or_set('post', 1, lambda: 'new') == 'new'
+
+
+def test_load_started_before_delete_is_not_kept(backend, monkeypatch):
+    cache, writer = TwoLevelCache(backend), TwoLevelCache(backend)
+    # The invalidation message has not arrived when the load finishes
+    monkeypatch.setattr(backend, 'publish', lambda channel, message: None)
+
+    def load():
+        writer.delete('post', 1)
+        return 'stale'
+
+    assert cache.get_or_set('post', 1, load) == 'stale'
+    assert cache.get('post', 1) is None
+    assert cache.get_or_set('post', 1, lambda: 'fresh') == 'fresh'
+    assert writer.get('post', 1) == 'fresh'
+
+
+def test_post_update_drops_cached_representation(client, database, users):
+    assert client.get('/api/posts/1').get_json()['title'] == 'Flask post 0'
+    database.session.get(Post, 1).title = 'Renamed'
+    database.session.commit()
+    assert client.get('/api/posts/1').get_json()['title'] == 'Renamed'
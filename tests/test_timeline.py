@@ -0,0 +1,44 @@
+from sqlalchemy import delete
+
+from models import User, Post, Follow
+from purge import purge_user
+from timeline import timelines
+
+
+def test_deleted_user_timeline_is_forgotten(database, users):
+    admin_id, blogger_id = users
+    database.session.add(Follow(follower_id=blogger_id, followed_id=admin_id))
+    database.session.commit()
+    timelines.page(blogger_id)
+    assert timelines.store.has(blogger_id)
+
+    database.session.delete(database.session.get(User, blogger_id))
+    database.session.commit()
+    assert not timelines.store.has(blogger_id)
+
+
+def test_page_skips_deleted_posts(database, users):
+    admin_id, blogger_id = users
+    database.session.add(Follow(follower_id=blogger_id, followed_id=admin_id))
+    database.session.commit()
+    timelines.page(blogger_id)
+    # A bulk delete leaves the entries in the stored timeline
+    database.session.execute(delete(Post).where(Post.id.in_([4, 5])))
+    database.session.commit()
+
+    posts, cursor = timelines.page(blogger_id, limit=2)
+    assert [post.id for post in posts] == [3, 2]
+    posts, cursor = timelines.page(blogger_id, cursor, limit=2)
+    assert [post.id for post in posts] == [1]
+    assert cursor is None
+
+
+def test_purge_removes_posts_from_timelines(database, users):
+    admin_id, blogger_id = users
+    database.session.add(Follow(follower_id=blogger_id, followed_id=admin_id))
+    database.session.commit()
+    timelines.page(blogger_id)
+
+    purge_user(admin_id, chunk_size=2)
+    assert timelines.store.page(blogger_id) == ([], False)
+    assert timelines.page(blogger_id) == ([], None)
@@ -0,0 +1,150 @@
+import collections
+import math
+import threading
+import time
+
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+
+from commit_hooks import after_commit, on_cascade, on_commit
+from geo import clusters
+from json_backend import dumps_bytes
+from models import db, Post
+
+MAX_ZOOM = 22
+# Web Mercator stops at about 85.05 degrees
+MAX_LATITUDE = math.degrees(math.atan(math.sinh(math.pi)))
+
+
+def tile_bbox(z, x, y):
+    """(west, south, east, north) of a z/x/y web map tile"""
+    n = 2 ** z
+
+    def latitude(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    return x / n * 360 - 180, latitude(y + 1), (x + 1) / n * 360 - 180, latitude(y)
+
+
+def tile_of(latitude, longitude, z):
+    """(x, y) of the tile containing a point at zoom ``z``"""
+    n = 2 ** z
+    latitude = max(-MAX_LATITUDE, min(MAX_LATITUDE, latitude))
+    x = int((longitude + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(latitude))) / math.pi) / 2 * n)
+    return min(x, n - 1), min(y, n - 1)
+
+
+def render_tile(z, x, y):
+    """GeoJSON of the posts in a tile, clustered for its zoom level"""
+    rows = clusters(db.session, Post, tile_bbox(z, x, y), z)
+    titles = dict(db.session.execute(select(Post.id, Post.title).where(
+        Post.id.in_([first_id for cell, count, lat, lon, first_id in rows if count == 1]))).all())
+    features = []
+    for cell, count, latitude, longitude, first_id in rows:
+        properties = {'count': count}
+        if count == 1:
+            properties.update({'post_id': first_id, 'title': titles.get(first_id)})
+        features.append({
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [longitude, latitude]},
+            'properties': properties
+        })
+    return dumps_bytes({'type': 'FeatureCollection', 'features': features})
+
+
+class TileCache:
+    """Rendered tiles by (z, x, y), least recently used evicted first.
+
+    Tiles are dropped when a geotagged post in them changes in this
+    process, and expire after ``max_age`` seconds for changes made by
+    other processes.
+    """
+
+    def __init__(self, max_tiles=10000, max_age=60):
+        self.max_tiles = max_tiles
+        self.max_age = max_age
+        self._tiles = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._tiles.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[1] > self.max_age:
+                del self._tiles[key]
+                return None
+            self._tiles.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, body):
+        with self._lock:
+            self._tiles[key] = (body, time.monotonic())
+            self._tiles.move_to_end(key)
+            while len(self._tiles) > self.max_tiles:
+                self._tiles.popitem(last=False)
+
+    def invalidate(self, points):
+        """Drop the tiles of every zoom level containing these points"""
+        keys = {(z,) + tile_of(latitude, longitude, z) for latitude, longitude in points
+                for z in range(MAX_ZOOM + 1)}
+        with self._lock:
+            for key in keys:
+                self._tiles.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+
+
+tile_cache = TileCache()
+
+
+def _old_location(post):
+    state = inspect(post)
+    old = []
+    for name in ('latitude', 'longitude'):
+        history = state.attrs[name].history
+        old.append(history.deleted[0] if history.deleted else getattr(post, name))
+    return tuple(old)
+
+
+@event.listens_for(Session, 'after_flush')
+def _track_moved_posts(session, flush_context):
+    points = []
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Post):
+            points.extend([(obj.latitude, obj.longitude), _old_location(obj)])
+    invalidate_after_commit(session, points)
+
+
+def invalidate_after_commit(session, points):
+    """Drop the tiles of (latitude, longitude) points once the session commits"""
+    after_commit(session, 'tiles', [point for point in points if None not in point])
+
+
+@on_cascade
+def _cascaded_posts(session, cascade):
+    invalidate_after_commit(session, [(row.latitude, row.longitude) for row in cascade.posts])
+
+
+@on_commit('tiles')
+def _invalidate_tiles(points):
+    tile_cache.invalidate(set(points))
+
+
+def get_tile(z, x, y):
+    """Tile body from the cache, rendered on a miss"""
+    body = tile_cache.get((z, x, y))
+    if body is None:
+        body = render_tile(z, x, y)
+        tile_cache.put((z, x, y), body)
+    return body
+
+
+def init_tiles(app):
+    """Configure the tile cache from the app config"""
+    tile_cache.max_tiles = app.config.get('TILE_CACHE_MAX_TILES', 10000)
+    tile_cache.max_age = app.config.get('TILE_CACHE_SECONDS', 60)
+    return tile_cache
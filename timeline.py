@@ -0,0 +1,298 @@
+import abc
+import bisect
+import collections
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, func, select, update
+from sqlalchemy.orm import Session, defer, selectinload
+from werkzeug.utils import import_string
+
+from commit_hooks import after_commit, on_cascade, on_commit
+from models import db, User, Post, Follow
+from pagination import after_cursor, decode_cursor, encode_cursor
+
+CURSOR_COLUMNS = (Post.created_at, Post.id)
+
+
+class TimelineStore(abc.ABC):
+    """Storage of the precomputed home timelines.
+
+    A timeline is a bounded list of ``(created_at, post id, author id)``
+    entries. Backends only need to be correct for the users they hold,
+    a user the store does not know is rebuilt from the database.
+    """
+
+    @abc.abstractmethod
+    def has(self, user_id):
+        """Whether the store holds a current timeline of the user"""
+
+    @abc.abstractmethod
+    def load(self, user_id, entries):
+        """Replace the whole timeline of a user"""
+
+    @abc.abstractmethod
+    def push(self, user_ids, entry):
+        """Add an entry to the timelines of the users the store holds"""
+
+    @abc.abstractmethod
+    def add(self, user_id, entries):
+        """Merge entries into a user's timeline (e.g. after a follow)"""
+
+    @abc.abstractmethod
+    def remove_author(self, user_id, author_id):
+        """Drop an author's entries from a user's timeline (after an unfollow)"""
+
+    @abc.abstractmethod
+    def page(self, user_id, before=None, limit=20):
+        """Newest entries older than ``before`` = (created_at, post id) and
+        whether older entries were dropped to keep the list bounded"""
+
+    @abc.abstractmethod
+    def forget(self, user_id):
+        """Drop a user's timeline"""
+
+
+class MemoryTimelineStore(TimelineStore):
+    """Timelines in this process, least recently read users are evicted.
+
+    Every worker process has its own copy and fan-out only reaches the
+    copy of the worker that handled the new post. The other workers show
+    it once their copy is rebuilt, up to ``max_age`` seconds later. With
+    several workers, lower TIMELINE_MAX_AGE_SECONDS or configure a
+    TimelineStore that is shared between them.
+    """
+
+    def __init__(self, max_length=800, max_users=100000, max_age=300):
+        self.max_length = max_length
+        self.max_users = max_users
+        self.max_age = max_age
+        # user id -> [entries oldest first, truncated, built at]
+        self._timelines = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, user_id):
+        timeline = self._timelines.get(user_id)
+        if timeline is None:
+            return None
+        if time.monotonic() - timeline[2] > self.max_age:
+            del self._timelines[user_id]
+            return None
+        return timeline
+
+    def _trim(self, timeline):
+        excess = len(timeline[0]) - self.max_length
+        if excess > 0:
+            del timeline[0][:excess]
+            timeline[1] = True
+
+    def has(self, user_id):
+        with self._lock:
+            return self._get(user_id) is not None
+
+    def load(self, user_id, entries):
+        timeline = [sorted(entries), False, time.monotonic()]
+        # The loader asks for max_length + 1 entries to know whether there are more
+        self._trim(timeline)
+        with self._lock:
+            self._timelines[user_id] = timeline
+            self._timelines.move_to_end(user_id)
+            while len(self._timelines) > self.max_users:
+                self._timelines.popitem(last=False)
+
+    def push(self, user_ids, entry):
+        with self._lock:
+            for user_id in user_ids:
+                timeline = self._get(user_id)
+                if timeline is not None:
+                    bisect.insort(timeline[0], entry)
+                    self._trim(timeline)
+
+    def add(self, user_id, entries):
+        with self._lock:
+            timeline = self._get(user_id)
+            if timeline is not None:
+                timeline[0] = sorted(set(timeline[0]).union(entries))
+                self._trim(timeline)
+
+    def remove_author(self, user_id, author_id):
+        with self._lock:
+            timeline = self._get(user_id)
+            if timeline is not None:
+                timeline[0] = [entry for entry in timeline[0] if entry[2] != author_id]
+
+    def page(self, user_id, before=None, limit=20):
+        with self._lock:
+            timeline = self._get(user_id)
+            if timeline is None:
+                return [], False
+            self._timelines.move_to_end(user_id)
+            entries = timeline[0]
+            end = bisect.bisect_left(entries, tuple(before)) if before else len(entries)
+            return entries[max(0, end - limit):end][::-1], timeline[1]
+
+    def forget(self, user_id):
+        with self._lock:
+            self._timelines.pop(user_id, None)
+
+
+BACKENDS = {
+    'memory': MemoryTimelineStore,
+}
+
+
+class TimelineService:
+    """Home timelines of followed authors, filled by fan-out on write.
+
+    A new post is pushed to the timeline of every follower of its author.
+    Authors with more than ``fanout_limit`` followers, or more than
+    ``prolific_posts_per_day`` posts a day, are switched to pull: their
+    posts are read from the database together with the stored timeline.
+    """
+
+    def __init__(self, store=None, fanout_limit=1000, prolific_posts_per_day=50):
+        self.store = store or MemoryTimelineStore()
+        self.fanout_limit = fanout_limit
+        self.prolific_posts_per_day = prolific_posts_per_day
+
+    def fan_out(self, connection, post):
+        """Followers to push a new post to, None when the author is on pull"""
+        author = connection.execute(select(User.timeline_pull).where(User.id == post.user_id)).scalar()
+        if author:
+            return None
+        followers = connection.scalars(select(Follow.follower_id).where(Follow.followed_id == post.user_id)
+                                       .limit(self.fanout_limit + 1)).all()
+        recent_posts = connection.scalar(select(func.count(Post.id)).where(
+            Post.user_id == post.user_id, Post.created_at >= datetime.utcnow() - timedelta(days=1)))
+        if len(followers) > self.fanout_limit or recent_posts > self.prolific_posts_per_day:
+            # Posts already pushed stay in the timelines, reads drop duplicates
+            connection.execute(update(User).where(User.id == post.user_id).values(timeline_pull=True))
+            return None
+        return followers
+
+    def _latest(self, conditions, before=None, limit=20):
+        query = (select(Post.created_at, Post.id, Post.user_id).join(Follow, Follow.followed_id == Post.user_id)
+                 .join(User, User.id == Post.user_id).where(*conditions))
+        if before:
+            query = query.where(after_cursor(CURSOR_COLUMNS, before))
+        return [tuple(row) for row in db.session.execute(
+            query.order_by(Post.created_at.desc(), Post.id.desc()).limit(limit))]
+
+    def ensure_built(self, user_id):
+        if not self.store.has(user_id):
+            max_length = getattr(self.store, 'max_length', 800)
+            self.store.load(user_id, self._latest((Follow.follower_id == user_id, User.timeline_pull.is_(False)),
+                                                  limit=max_length + 1))
+
+    def follow(self, user_id, author_id):
+        """Follow an author, returns False if already followed"""
+        if db.session.get(Follow, (user_id, author_id)) is not None:
+            return False
+        db.session.add(Follow(follower_id=user_id, followed_id=author_id))
+        db.session.commit()
+        if self.store.has(user_id):
+            self.store.add(user_id, self._latest((Follow.follower_id == user_id, Post.user_id == author_id,
+                                                  User.timeline_pull.is_(False)),
+                                                 limit=getattr(self.store, 'max_length', 800)))
+        return True
+
+    def unfollow(self, user_id, author_id):
+        """Stop following an author, returns False if not followed"""
+        follow = db.session.get(Follow, (user_id, author_id))
+        if follow is None:
+            return False
+        db.session.delete(follow)
+        db.session.commit()
+        self.store.remove_author(user_id, author_id)
+        return True
+
+    def _entries(self, user_id, before, limit):
+        stored, truncated = self.store.page(user_id, before, limit)
+        following = (Follow.follower_id == user_id,)
+        entries = stored + self._latest(following + (User.timeline_pull.is_(True),), before, limit)
+        if truncated and len(stored) < limit:
+            # Past the end of the bounded list everything comes from the database
+            entries += self._latest(following, stored[-1][:2] if stored else before, limit)
+        return sorted({entry[1]: entry for entry in entries}.values(), reverse=True)[:limit]
+
+    def page(self, user_id, cursor=None, limit=20):
+        """Posts of one timeline page, newest first, and the next page cursor.
+
+        Raises ValueError for malformed cursors.
+        """
+        before = decode_cursor(cursor, CURSOR_COLUMNS) if cursor else None
+        self.ensure_built(user_id)
+        page = []
+        while True:
+            entries = self._entries(user_id, before, limit + 1)
+            posts = {post.id: post for post in Post.query.options(defer(Post.content), selectinload(Post.author))
+                     .filter(Post.id.in_([entry[1] for entry in entries[:limit]]))}
+            # Deleted posts are still in the stored timelines, the page is
+            # filled up with the entries after them
+            for index, entry in enumerate(entries[:limit]):
+                if entry[1] in posts:
+                    page.append(posts[entry[1]])
+                    if len(page) == limit:
+                        more = index + 1 < len(entries)
+                        return page, encode_cursor(entry[:2]) if more else None
+            if len(entries) <= limit:
+                return page, None
+            before = entries[limit - 1][:2]
+
+
+timelines = TimelineService()
+
+
+@event.listens_for(Session, 'after_flush')
+def _fan_out_new_posts(session, flush_context):
+    pushes = []
+    for obj in session.new:
+        if isinstance(obj, Post):
+            followers = timelines.fan_out(session.connection(), obj)
+            if followers:
+                pushes.append((followers, (obj.created_at, obj.id, obj.user_id)))
+    after_commit(session, 'timeline', pushes)
+
+
+@on_commit('timeline')
+def _push_to_timelines(pushes):
+    for followers, entry in pushes:
+        timelines.store.push(followers, entry)
+
+
+def remove_author_after_commit(session, author_id):
+    """Drop an author's entries from their followers' timelines once the session commits"""
+    followers = session.connection().scalars(select(Follow.follower_id).where(Follow.followed_id == author_id)).all()
+    after_commit(session, 'timeline_remove_author', [(follower, author_id) for follower in followers])
+
+
+@on_cascade
+def _forget_deleted_users(session, cascade):
+    after_commit(session, 'timeline_forget', cascade.user_ids)
+    for user_id in cascade.user_ids:
+        remove_author_after_commit(session, user_id)
+
+
+@on_commit('timeline_forget')
+def _forget_timelines(user_ids):
+    for user_id in user_ids:
+        timelines.store.forget(user_id)
+
+
+@on_commit('timeline_remove_author')
+def _remove_authors(items):
+    for user_id, author_id in items:
+        timelines.store.remove_author(user_id, author_id)
+
+
+def init_timeline(app):
+    """Configure the timeline backend from the app config"""
+    backend = app.config.get('TIMELINE_BACKEND', 'memory')
+    store_class = BACKENDS[backend] if backend in BACKENDS else import_string(backend)
+    timelines.store = store_class(max_length=app.config.get('TIMELINE_MAX_LENGTH', 800),
+                                  max_users=app.config.get('TIMELINE_MAX_USERS', 100000),
+                                  max_age=app.config.get('TIMELINE_MAX_AGE_SECONDS', 300))
+    timelines.fanout_limit = app.config.get('TIMELINE_FANOUT_LIMIT', 1000)
+    timelines.prolific_posts_per_day = app.config.get('TIMELINE_PROLIFIC_POSTS_PER_DAY', 50)
+    return timelines
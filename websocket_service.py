@@ -1,6 +1,15 @@
+from flask import request
 from flask_socketio import SocketIO, emit, send
 from datetime import datetime
 import json
+import logging
+from metrics import count_socketio_event
+
+# One logger per event so LOG_SAMPLE_RATES can thin out the busy ones
+connection_logger = logging.getLogger('socketio.connection')
+message_logger = logging.getLogger('socketio.message')
+chat_logger = logging.getLogger('socketio.chat')
+test_data_logger = logging.getLogger('socketio.test_data')
 
 
 def init_socketio(app):
@@ -8,27 +17,31 @@ def init_socketio(app):
     socketio = SocketIO(
         app,
         cors_allowed_origins="*",
-        async_mode='threading'  # Use threading mode for better compatibility
+        async_mode='threading',  # Use threading mode for better compatibility
+        message_queue=app.config.get('SOCKETIO_MESSAGE_QUEUE')
     )
 
     @socketio.on('connect')
-    def handle_connect():
+    @count_socketio_event('connect')
+    def handle_connect(auth=None):
         """Handle client connection"""
-        print(f"📡 Client connected: {datetime.utcnow()}")
+        connection_logger.info('Client connected', extra={'sid': request.sid})
         emit('status', {
             'message': 'Connected to Flask-SocketIO server',
             'timestamp': datetime.utcnow().isoformat()
         })
 
     @socketio.on('disconnect')
+    @count_socketio_event('disconnect')
     def handle_disconnect():
         """Handle client disconnection"""
-        print(f"🔚 Client disconnected: {datetime.utcnow()}")
+        connection_logger.info('Client disconnected', extra={'sid': request.sid})
 
     @socketio.on('message')
+    @count_socketio_event('message')
     def handle_message(data):
         """Handle incoming messages"""
-        print(f"📨 Received message: {data}")
+        message_logger.info('Received message', extra={'sid': request.sid, 'data': data})
 
         response = {
             'type': 'echo',
@@ -40,9 +53,10 @@ def init_socketio(app):
         emit('message_response', response)
 
     @socketio.on('chat_message')
+    @count_socketio_event('chat_message')
     def handle_chat_message(data):
         """Handle chat messages"""
-        print(f"💬 Chat message: {data}")
+        chat_logger.info('Chat message', extra={'sid': request.sid, 'data': data})
 
         # Send to all connected clients
         response = {
@@ -55,9 +69,10 @@ def init_socketio(app):
         emit('chat_response', response, broadcast=True)
 
     @socketio.on('test_data')
+    @count_socketio_event('test_data')
     def handle_test_data(data):
         """Handle test data processing"""
-        print(f"🧪 Test data: {data}")
+        test_data_logger.info('Test data', extra={'sid': request.sid, 'data': data})
 
         # Process data
         processed_data = {
@@ -71,6 +86,7 @@ def init_socketio(app):
         emit('test_response', processed_data)
 
     @socketio.on('ping')
+    @count_socketio_event('ping')
     def handle_ping():
         """Handle ping requests"""
         emit('pong', {'timestamp': datetime.utcnow().isoformat()})